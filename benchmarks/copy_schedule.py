@@ -0,0 +1,89 @@
+"""
+Simulate copying closures to a fleet of machines with skewed closure
+sizes and link speeds, in machine order and as scheduled by
+nixops.scheduling from noisy estimates, and fail if the schedule does
+not get close to the best possible total time.
+
+Usage: python benchmarks/copy_schedule.py [--machines N] [--workers N]
+       [--noise FACTOR] [--seed N]
+"""
+
+import argparse
+import random
+import sys
+from typing import Dict, List, NamedTuple
+
+from nixops.scheduling import simulate
+
+# Highest acceptable ratio of the scheduled total time to the lower bound
+# (the longest copy, or all copies spread perfectly over the workers).
+THRESHOLD = 1.25
+
+
+class Copy(NamedTuple):
+    name: str
+    size: int
+    throughput: float
+
+
+def fleet(count: int, rng: random.Random) -> List[Copy]:
+    """Machines with mostly small closure deltas on mostly fast links."""
+    copies = []
+    for i in range(count):
+        size = int(rng.paretovariate(1.2) * 20 * 1024 * 1024)
+        throughput = rng.choice([100.0, 100.0, 100.0, 10.0, 1.0]) * 1024 * 1024
+        copies.append(Copy("machine-{0}".format(i), size, throughput))
+    return copies
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--machines", type=int, default=200, help="number of machines")
+    parser.add_argument("--workers", type=int, default=5, help="concurrent copies")
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=2.0,
+        help="estimates are off by up to FACTOR either way",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    copies = fleet(args.machines, rng)
+    estimates: Dict[str, float] = {
+        c.name: c.size / c.throughput * args.noise ** rng.uniform(-1, 1) for c in copies
+    }
+
+    def duration(c: Copy) -> float:
+        return c.size / c.throughput
+
+    lower_bound = max(
+        max(duration(c) for c in copies),
+        sum(duration(c) for c in copies) / args.workers,
+    )
+    fifo = simulate(copies, duration, args.workers)
+    scheduled = simulate(
+        copies, duration, args.workers, cost=lambda c: estimates[c.name]
+    )
+
+    ratio = scheduled / lower_bound
+    ok = ratio <= THRESHOLD and scheduled <= fifo
+    print(
+        "{0} machines, {1} workers: in order {2:.0f} s, scheduled {3:.0f} s, "
+        "lower bound {4:.0f} s (ratio {5:.2f}, threshold {6:.2f}) {7}".format(
+            args.machines,
+            args.workers,
+            fifo,
+            scheduled,
+            lower_bound,
+            ratio,
+            THRESHOLD,
+            "ok" if ok else "FAIL",
+        )
+    )
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+Measure how long it takes to build machine definitions from the
+evaluated network, as done for every machine on every evaluation, and
+fail if it regresses.
+
+Usage: python benchmarks/machine_definitions.py [--count N] [--scale FACTOR]
+"""
+
+import argparse
+import sys
+import time
+from typing import Any, Dict
+
+from nixops.backends import MachineDefinition, MachineOptions
+from nixops.resources import ResourceEval
+
+# Threshold in microseconds per machine definition.  Use --scale on slow
+# machines rather than changing it.
+THRESHOLD_US = 250
+
+
+class BenchmarkDefinition(MachineDefinition):
+    config: MachineOptions
+
+    @classmethod
+    def get_type(cls) -> str:
+        return "benchmark"
+
+
+def machine_eval(i: int) -> Dict[str, Any]:
+    """The evaluated attributes of a machine, as produced by Nix."""
+    return {
+        "targetEnv": "benchmark",
+        "targetHost": "machine-{0}.example.org".format(i),
+        "targetPort": 22,
+        "alwaysActivate": True,
+        "owners": ["alice@example.org"],
+        "hasFastConnection": False,
+        "keys": {
+            name: {
+                "text": "secret",
+                "keyFile": None,
+                "keyCommand": None,
+                "name": name,
+                "path": "/run/keys/" + name,
+                "destDir": "/run/keys",
+                "user": "root",
+                "group": "root",
+                "permissions": "0600",
+            }
+            for name in ("ssl-key", "ssl-cert", "api-token")
+        },
+        "nixosRelease": "21.05",
+        "targetUser": None,
+        "sshOptions": ["-o", "ServerAliveInterval=30"],
+        "privilegeEscalationCommand": ["sudo", "-H", "--"],
+        "provisionSSHKey": True,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--count", type=int, default=10000, help="number of machine definitions"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="number of runs")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="scale the threshold by FACTOR"
+    )
+    args = parser.parse_args()
+
+    evals = [machine_eval(i) for i in range(args.count)]
+
+    best = float("inf")
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        for i, config in enumerate(evals):
+            BenchmarkDefinition("machine-{0}".format(i), ResourceEval(config))
+        best = min(best, time.perf_counter() - start)
+
+    per_machine = best / args.count * 1e6
+    threshold = THRESHOLD_US * args.scale
+    status = "ok" if per_machine <= threshold else "FAIL"
+    print(
+        "{0} machine definitions: {1:.2f} s, {2:.1f} us each "
+        "(threshold {3:.0f} us) {4}".format(
+            args.count, best, per_machine, threshold, status
+        )
+    )
+    return 0 if per_machine <= threshold else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Measure the startup time of the nixops command line with
+‘python -X importtime’, and fail if it regresses.
+
+Two phases are measured:
+
+  parse     importing everything needed to parse the command line of a
+            core subcommand.  This must not import the bulk of NixOps,
+            nor, if only NixOps' own plugin is installed, any plugin.
+
+  dispatch  additionally importing the implementation of the subcommand.
+
+Usage: python benchmarks/startup.py [--runs N] [--scale FACTOR]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# Thresholds in milliseconds of total import time.  Use --scale on slow
+# machines rather than changing them.
+THRESHOLDS: Dict[str, float] = {
+    "parse": 50,
+    "dispatch": 250,
+}
+
+# Modules that must not be imported just to parse the command line.
+FORBIDDEN_AT_PARSE = [
+    "nixops.script_defs",
+    "nixops.deployment",
+    "nixops.backends",
+    "nixops.resources",
+    "nixops.plugins",
+    "pluggy",
+    "prettytable",
+    "typeguard",
+]
+
+PHASES: Dict[str, str] = {
+    "parse": "from nixops.args import parse_args; parse_args({argv!r})",
+    "dispatch": (
+        "from nixops.args import parse_args; args = parse_args({argv!r}); "
+        "import importlib; importlib.import_module(args.op.module)"
+    ),
+}
+
+COMMANDS: List[List[str]] = [["ssh", "machine"], ["list"]]
+
+
+def measure(code: str) -> Tuple[float, List[str]]:
+    """Return the total import time in ms and the imported modules."""
+    # Measure with up-to-date bytecode, as in an installed NixOps.
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    )
+    total_us = 0
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        total_us += int(self_us)
+        modules.append(name.strip())
+    return total_us / 1000, modules
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5, help="runs per measurement")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="scale the thresholds by FACTOR"
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for command in COMMANDS:
+        for phase, template in PHASES.items():
+            code = template.format(argv=command)
+            # The first run may have to write bytecode.
+            results = [measure(code) for _ in range(args.runs + 1)][1:]
+            best = min(ms for ms, _ in results)
+            threshold = THRESHOLDS[phase] * args.scale
+            status = "ok" if best <= threshold else "FAIL"
+            failed |= best > threshold
+            print(
+                "{0:<10} {1:<8} {2:7.1f} ms (threshold {3:.0f} ms) {4}".format(
+                    " ".join(command), phase, best, threshold, status
+                )
+            )
+
+            if phase == "parse":
+                modules = results[0][1]
+                for module in FORBIDDEN_AT_PARSE:
+                    if module in modules:
+                        print("  FAIL: parsing imports {0}".format(module))
+                        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -245,6 +245,13 @@ in rec {
 
   };
 
+  # The network attributes along with the files they were read from, so
+  # that NixOps can cache them.
+  networkInfo = {
+    inherit (info) network;
+    files = map (n: toString n._file) networks;
+  };
+
   # Phase 2: build complete machine configurations.
   machines = { names }:
     let nodes' = lib.filterAttrs (n: v: lib.elem n names) nodes; in
@@ -257,6 +264,18 @@ in rec {
         '') nodes'))}
       '';
 
+  # The store paths of the configurations of the given machines, without
+  # building them.
+  toplevels = { names }:
+    lib.mapAttrs (n: v: v.config.system.build.toplevel.outPath)
+      (lib.filterAttrs (n: v: lib.elem n names) nodes);
+
+  # The derivations of the configurations of the given machines, for
+  # building them elsewhere.
+  toplevelDrvs = { names }:
+    lib.mapAttrs (n: v: v.config.system.build.toplevel.drvPath)
+      (lib.filterAttrs (n: v: lib.elem n names) nodes);
+
 
   # Function needed to calculate the nixops arguments. This should work even when arguments
   # are not set yet, so we fake arguments to be able to evaluate the require attribute of
@@ -31,25 +31,29 @@ if __name__.split(".")[-1] == "__main__":
         setup_debugger()
 
 
-from nixops.parallel import MultipleExceptions
-from nixops.script_defs import setup_logging
-from nixops.evaluation import NixEvalError
-from nixops.script_defs import error
-from nixops.args import parser
-import nixops
+# Keep the imports needed to parse the command line to a minimum: the
+# subcommands import what they need when they run.
+from nixops.args import parse_args
 
 
 def main() -> None:
 
     if os.path.basename(sys.argv[0]) == "charon":
+        import nixops.ansi
+
         sys.stderr.write(
             nixops.ansi.ansi_warn("warning: ‘charon’ is now called ‘nixops’") + "\n"
         )
 
-    args = parser.parse_args()
-    setup_logging(args)
+    args = parse_args()
 
+    from nixops.script_defs import setup_logging, error
+    from nixops.parallel import MultipleExceptions
+    from nixops.evaluation import NixEvalError
     from nixops.exceptions import NixError
+    import nixops.deployment
+
+    setup_logging(args)
 
     try:
         nixops.deployment.DEBUG = args.debug
@@ -1,656 +1,1122 @@
-from argparse import ArgumentParser, _SubParsersAction, SUPPRESS, REMAINDER
-from nixops.script_defs import (
-    add_subparser,
-    op_list_deployments,
-    op_create,
-    op_modify,
-    op_clone,
-    op_delete,
-    op_info,
-    op_check,
-    op_set_args,
-    op_deploy,
-    add_common_deployment_options,
-    op_send_keys,
-    op_destroy,
-    op_delete_resources,
-    op_stop,
-    op_start,
-    op_reboot,
-    op_show_arguments,
-    op_show_physical,
-    op_ssh,
-    op_ssh_for_each,
-    op_scp,
-    op_mount,
-    op_rename,
-    op_backup,
-    op_backup_status,
-    op_remove_backup,
-    op_clean_backups,
-    op_restore,
-    op_show_option,
-    op_list_generations,
-    op_rollback,
-    op_delete_generation,
-    op_show_console_output,
-    op_dump_nix_paths,
-    op_export,
-    op_import,
-    op_edit,
-    op_copy_closure,
-    op_list_plugins,
-    parser_plugin_hooks,
-    op_unlock,
-)
-
-# Set up the parser.
-parser = ArgumentParser(description="NixOS cloud deployment tool", prog="nixops")
-parser.add_argument("--version", action="version", version="NixOps @version@")
-parser.add_argument(
-    "--pdb", action="store_true", help="Invoke pdb on unhandled exception"
-)
-
-subparsers: _SubParsersAction = parser.add_subparsers(
-    help="sub-command help", metavar="operation", required=True
-)
-
-subparser = add_subparser(subparsers, "list", help="list all known deployments")
-subparser.set_defaults(op=op_list_deployments)
-
-subparser = add_subparser(subparsers, "create", help="create a new deployment")
-subparser.set_defaults(op=op_create)
-subparser.add_argument(
-    "--name", "-n", dest="name", metavar="NAME", help=SUPPRESS
-)  # obsolete, use -d instead
-
-subparser = add_subparser(subparsers, "modify", help="modify an existing deployment")
-subparser.set_defaults(op=op_modify)
-subparser.add_argument(
-    "--name", "-n", dest="name", metavar="NAME", help="new symbolic name of deployment"
-)
-
-subparser = add_subparser(subparsers, "clone", help="clone an existing deployment")
-subparser.set_defaults(op=op_clone)
-subparser.add_argument(
-    "--name",
-    "-n",
-    dest="name",
-    metavar="NAME",
-    help="symbolic name of the cloned deployment",
-)
-
-subparser = add_subparser(subparsers, "delete", help="delete a deployment")
-subparser.add_argument(
-    "--force", action="store_true", help="force deletion even if resources still exist"
-)
-subparser.add_argument("--all", action="store_true", help="delete all deployments")
-subparser.set_defaults(op=op_delete)
-
-subparser = add_subparser(subparsers, "info", help="show the state of the deployment")
-subparser.set_defaults(op=op_info)
-subparser.add_argument("--all", action="store_true", help="show all deployments")
-subparser.add_argument(
-    "--plain", action="store_true", help="do not pretty-print the output"
-)
-subparser.add_argument(
-    "--no-eval",
-    action="store_true",
-    help="do not evaluate the deployment specification",
-)
-
-subparser = add_subparser(
-    subparsers,
-    "check",
-    help="check the state of the machines in the network"
-    " (note that this might alter the internal nixops state to consolidate with the real state of the resource)",
-)
-subparser.set_defaults(op=op_check)
-subparser.add_argument("--all", action="store_true", help="check all deployments")
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="check only the specified machines",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="check all except the specified machines",
-)
-
-subparser = add_subparser(
-    subparsers,
-    "set-args",
-    help="persistently set arguments to the deployment specification",
-)
-subparser.set_defaults(op=op_set_args)
-subparser.add_argument(
-    "--arg",
-    nargs=2,
-    action="append",
-    dest="args",
-    metavar=("NAME", "VALUE"),
-    help="pass a Nix expression value",
-)
-subparser.add_argument(
-    "--argstr",
-    nargs=2,
-    action="append",
-    dest="argstrs",
-    metavar=("NAME", "VALUE"),
-    help="pass a string value",
-)
-subparser.add_argument(
-    "--unset",
-    nargs=1,
-    action="append",
-    dest="unset",
-    metavar="NAME",
-    help="unset previously set argument",
-)
-
-
-subparser = add_subparser(subparsers, "deploy", help="deploy the network configuration")
-subparser.set_defaults(op=op_deploy)
-subparser.add_argument(
-    "--kill-obsolete", "-k", action="store_true", help="kill obsolete virtual machines"
-)
-subparser.add_argument(
-    "--dry-run", action="store_true", help="evaluate and print what would be built"
-)
-subparser.add_argument(
-    "--dry-activate",
-    action="store_true",
-    help="show what will be activated on the machines in the network",
-)
-subparser.add_argument(
-    "--test",
-    action="store_true",
-    help="build and activate the new configuration; do not enable it in the bootloader. Rebooting the system will roll back automatically.",
-)
-subparser.add_argument(
-    "--boot",
-    action="store_true",
-    help="build the new configuration and enable it in the bootloader; do not activate it. Upon reboot, the system will use the new configuration.",
-)
-subparser.add_argument(
-    "--repair", action="store_true", help="use --repair when calling nix-build (slow)"
-)
-subparser.add_argument(
-    "--evaluate-only", action="store_true", help="only call nix-instantiate and exit"
-)
-subparser.add_argument(
-    "--plan-only",
-    action="store_true",
-    help="show the diff between the configuration and the state and exit",
-)
-subparser.add_argument(
-    "--build-only",
-    action="store_true",
-    help="build only; do not perform deployment actions",
-)
-subparser.add_argument(
-    "--create-only", action="store_true", help="exit after creating missing machines"
-)
-subparser.add_argument(
-    "--copy-only", action="store_true", help="exit after copying closures"
-)
-subparser.add_argument(
-    "--allow-recreate",
-    action="store_true",
-    help="recreate resources machines that have disappeared",
-)
-subparser.add_argument(
-    "--always-activate",
-    action="store_true",
-    help="activate unchanged configurations as well",
-)
-add_common_deployment_options(subparser)
-
-subparser = add_subparser(subparsers, "send-keys", help="send encryption keys")
-subparser.set_defaults(op=op_send_keys)
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="send keys to only the specified machines",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="send keys to all except the specified machines",
-)
-
-subparser = add_subparser(
-    subparsers, "destroy", help="destroy all resources in the specified deployment"
-)
-subparser.set_defaults(op=op_destroy)
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="destroy only the specified machines",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="destroy all except the specified machines",
-)
-subparser.add_argument(
-    "--wipe", action="store_true", help="securely wipe data on the machines"
-)
-subparser.add_argument("--all", action="store_true", help="destroy all deployments")
-
-subparser = add_subparser(
-    subparsers,
-    "delete-resources",
-    help="deletes the resource from the local NixOps state file.",
-)
-subparser.set_defaults(op=op_delete_resources)
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="RESOURCE-NAME",
-    help="delete only the specified resources",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="RESOURCE-NAME",
-    help="delete all resources except the specified resources",
-)
-
-subparser = add_subparser(
-    subparsers, "stop", help="stop all virtual machines in the network"
-)
-subparser.set_defaults(op=op_stop)
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="stop only the specified machines",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="stop all except the specified machines",
-)
-
-subparser = add_subparser(
-    subparsers, "start", help="start all virtual machines in the network"
-)
-subparser.set_defaults(op=op_start)
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="start only the specified machines",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="start all except the specified machines",
-)
-
-subparser = add_subparser(
-    subparsers, "reboot", help="reboot all virtual machines in the network"
-)
-subparser.set_defaults(op=op_reboot)
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="reboot only the specified machines",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="reboot all except the specified machines",
-)
-subparser.add_argument(
-    "--no-wait", action="store_true", help="do not wait until the machines are up again"
-)
-subparser.add_argument(
-    "--rescue",
-    action="store_true",
-    help="reboot machines into the rescue system" " (if available)",
-)
-subparser.add_argument(
-    "--hard",
-    action="store_true",
-    help="send a hard reset (power switch) to the machines" " (if available)",
-)
-
-subparser = add_subparser(
-    subparsers, "show-arguments", help="print the arguments to the network expressions"
-)
-subparser.set_defaults(op=op_show_arguments)
-
-subparser = add_subparser(
-    subparsers, "show-physical", help="print the physical network expression"
-)
-subparser.add_argument(
-    "--backup",
-    dest="backupid",
-    default=None,
-    help="print physical network expression for given backup id",
-)
-subparser.set_defaults(op=op_show_physical)
-
-subparser = add_subparser(
-    subparsers, "ssh", help="login on the specified machine via SSH"
-)
-subparser.set_defaults(op=op_ssh)
-subparser.add_argument("machine", metavar="MACHINE", help="identifier of the machine")
-subparser.add_argument(
-    "args",
-    metavar="SSH_ARGS",
-    nargs=REMAINDER,
-    help="SSH flags and/or command",
-)
-subparser.add_argument(
-    "--now",
-    dest="now",
-    action="store_true",
-    help="do not acquire a lock before fetching the state",
-)
-
-subparser = add_subparser(
-    subparsers, "ssh-for-each", help="execute a command on each machine via SSH"
-)
-subparser.set_defaults(op=op_ssh_for_each)
-subparser.add_argument(
-    "args", metavar="ARG", nargs="*", help="additional arguments to SSH"
-)
-subparser.add_argument("--parallel", "-p", action="store_true", help="run in parallel")
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="run command only on the specified machines",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="run command on all except the specified machines",
-)
-subparser.add_argument(
-    "--all", action="store_true", help="run ssh-for-each for all deployments"
-)
-
-subparser = add_subparser(
-    subparsers, "scp", help="copy files to or from the specified machine via scp"
-)
-subparser.set_defaults(op=op_scp)
-subparser.add_argument(
-    "--from",
-    dest="scp_from",
-    action="store_true",
-    help="copy a file from specified machine",
-)
-subparser.add_argument(
-    "--to", dest="scp_to", action="store_true", help="copy a file to specified machine"
-)
-subparser.add_argument("machine", metavar="MACHINE", help="identifier of the machine")
-subparser.add_argument("source", metavar="SOURCE", help="source file location")
-subparser.add_argument("destination", metavar="DEST", help="destination file location")
-
-subparser = add_subparser(
-    subparsers,
-    "mount",
-    help="mount a directory from the specified machine into the local filesystem",
-)
-subparser.set_defaults(op=op_mount)
-subparser.add_argument(
-    "machine",
-    metavar="MACHINE[:PATH]",
-    help="identifier of the machine, optionally followed by a path",
-)
-subparser.add_argument("destination", metavar="PATH", help="local path")
-subparser.add_argument(
-    "--sshfs-option",
-    "-o",
-    action="append",
-    metavar="OPTIONS",
-    help="mount options passed to sshfs",
-)
-
-subparser = add_subparser(subparsers, "rename", help="rename machine in network")
-subparser.set_defaults(op=op_rename)
-subparser.add_argument(
-    "current_name", metavar="FROM", help="current identifier of the machine"
-)
-subparser.add_argument("new_name", metavar="TO", help="new identifier of the machine")
-
-subparser = add_subparser(
-    subparsers,
-    "backup",
-    help="make snapshots of persistent disks in network (currently EC2-only)",
-)
-subparser.set_defaults(op=op_backup)
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="perform backup actions on the specified machines only",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="do not perform backup actions on the specified machines",
-)
-subparser.add_argument(
-    "--freeze",
-    dest="freeze_fs",
-    action="store_true",
-    help="freeze filesystems for non-root filesystems that support this (e.g. xfs)",
-)
-subparser.add_argument(
-    "--force",
-    dest="force",
-    action="store_true",
-    help="start new backup even if previous is still running",
-)
-subparser.add_argument(
-    "--devices",
-    nargs="+",
-    metavar="DEVICE-NAME",
-    help="only backup the specified devices",
-)
-
-subparser = add_subparser(subparsers, "backup-status", help="get status of backups")
-subparser.set_defaults(op=op_backup_status)
-subparser.add_argument(
-    "backupid", default=None, nargs="?", help="use specified backup in stead of latest"
-)
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="perform backup actions on the specified machines only",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="do not perform backup actions on the specified machines",
-)
-subparser.add_argument(
-    "--wait",
-    dest="wait",
-    action="store_true",
-    help="wait until backup is finished",
-)
-subparser.add_argument(
-    "--latest",
-    dest="latest",
-    action="store_true",
-    help="show status of latest backup only",
-)
-
-subparser = add_subparser(subparsers, "remove-backup", help="remove a given backup")
-subparser.set_defaults(op=op_remove_backup)
-subparser.add_argument("backupid", metavar="BACKUP-ID", help="backup ID to remove")
-subparser.add_argument(
-    "--keep-physical",
-    dest="keep_physical",
-    action="store_true",
-    help="do not remove the physical backups, only remove backups from nixops state",
-)
-
-subparser = add_subparser(subparsers, "clean-backups", help="remove old backups")
-subparser.set_defaults(op=op_clean_backups)
-subparser.add_argument(
-    "--keep", dest="keep", type=int, help="number of backups to keep around"
-)
-subparser.add_argument(
-    "--keep-days",
-    metavar="N",
-    dest="keep_days",
-    type=int,
-    help="keep backups newer than N days",
-)
-subparser.add_argument(
-    "--keep-physical",
-    dest="keep_physical",
-    action="store_true",
-    help="do not remove the physical backups, only remove backups from nixops state",
-)
-
-subparser = add_subparser(
-    subparsers,
-    "restore",
-    help="restore machines based on snapshots of persistent disks in network (currently EC2-only)",
-)
-subparser.set_defaults(op=op_restore)
-subparser.add_argument(
-    "--backup-id", default=None, help="use specified backup in stead of latest"
-)
-subparser.add_argument(
-    "--include",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="perform backup actions on the specified machines only",
-)
-subparser.add_argument(
-    "--exclude",
-    nargs="+",
-    metavar="MACHINE-NAME",
-    help="do not perform backup actions on the specified machines",
-)
-subparser.add_argument(
-    "--devices",
-    nargs="+",
-    metavar="DEVICE-NAME",
-    help="only restore the specified devices",
-)
-
-subparser = add_subparser(
-    subparsers, "show-option", help="print the value of a configuration option"
-)
-subparser.set_defaults(op=op_show_option)
-subparser.add_argument("machine", metavar="MACHINE", help="identifier of the machine")
-subparser.add_argument("option", metavar="OPTION", help="option name")
-subparser.add_argument(
-    "--include-physical",
-    action="store_true",
-    help="include the physical specification in the evaluation",
-)
-
-subparser = add_subparser(
-    subparsers,
-    "list-generations",
-    help="list previous configurations to which you can roll back",
-)
-subparser.set_defaults(op=op_list_generations)
-
-subparser = add_subparser(
-    subparsers, "rollback", help="roll back to a previous configuration"
-)
-subparser.set_defaults(op=op_rollback)
-subparser.add_argument(
-    "generation",
-    type=int,
-    metavar="GENERATION",
-    help="number of the desired configuration (see ‘nixops list-generations’)",
-)
-add_common_deployment_options(subparser)
-
-subparser = add_subparser(
-    subparsers, "delete-generation", help="remove a previous configuration"
-)
-subparser.set_defaults(op=op_delete_generation)
-subparser.add_argument(
-    "generation",
-    type=int,
-    metavar="GENERATION",
-    help="number of the desired configuration (see ‘nixops list-generations’)",
-)
-add_common_deployment_options(subparser)
-
-subparser = add_subparser(
-    subparsers,
-    "show-console-output",
-    help="print the machine's console output on stdout",
-)
-subparser.set_defaults(op=op_show_console_output)
-subparser.add_argument("machine", metavar="MACHINE", help="identifier of the machine")
-add_common_deployment_options(subparser)
-
-subparser = add_subparser(
-    subparsers, "dump-nix-paths", help="dump Nix paths referenced in deployments"
-)
-subparser.add_argument(
-    "--all", action="store_true", help="dump Nix paths for all deployments"
-)
-subparser.set_defaults(op=op_dump_nix_paths)
-add_common_deployment_options(subparser)
-
-subparser = add_subparser(subparsers, "export", help="export the state of a deployment")
-subparser.add_argument("--all", action="store_true", help="export all deployments")
-subparser.set_defaults(op=op_export)
-
-subparser = add_subparser(
-    subparsers, "import", help="import deployments into the state file"
-)
-subparser.add_argument(
-    "--include-keys",
-    action="store_true",
-    help="import public SSH hosts keys to .ssh/known_hosts",
-)
-subparser.set_defaults(op=op_import)
-
-subparser = add_subparser(
-    subparsers, "edit", help="open the deployment specification in $EDITOR"
-)
-subparser.set_defaults(op=op_edit)
-
-subparser = add_subparser(
-    subparsers, "copy-closure", help="copy closure to a target machine"
-)
-subparser.add_argument("machine", help="identifier of the machine")
-subparser.add_argument("storepath", help="store path of the closure to be copied")
-subparser.set_defaults(op=op_copy_closure)
-
-subparser = subparsers.add_parser(
-    "list-plugins", help="list the available nixops plugins"
-)
-subparser.set_defaults(op=op_list_plugins)
-subparser.add_argument(
-    "--verbose", "-v", action="store_true", help="Provide extra plugin information"
-)
-subparser.add_argument("--debug", action="store_true", help="enable debug output")
-
-subparser = add_subparser(subparsers, "unlock", help="Force unlock the deployment lock")
-subparser.set_defaults(op=op_unlock)
-
-parser_plugin_hooks(parser, subparsers)
+"""
+The nixops command line parser.
+
+Building the parser must stay cheap: subcommands only import the module
+implementing them when they run, and only the parser of the requested
+subcommand is constructed.  Plugins are only loaded if plugins other
+than NixOps' own are installed, and only get the parsers of all the
+subcommands if one of them implements the ‘parser’ hook.
+"""
+
+import importlib
+import os
+import sys
+
+import nixops.cache
+from argparse import ArgumentParser, _SubParsersAction, Namespace, SUPPRESS, REMAINDER
+from typing import Any, Callable, Dict, List, Optional
+
+
+class LazyOp:
+    """A subcommand implementation that is imported when it is called."""
+
+    def __init__(self, name: str, module: str = "nixops.script_defs") -> None:
+        self.__name__ = name
+        self.module = module
+
+    def __call__(self, args: Namespace) -> Any:
+        return getattr(importlib.import_module(self.module), self.__name__)(args)
+
+    def __repr__(self) -> str:
+        return "<LazyOp {0}.{1}>".format(self.module, self.__name__)
+
+
+AddCommand = Callable[[_SubParsersAction], None]
+
+# The core subcommands, by name.
+_commands: Dict[str, AddCommand] = {}
+
+
+def _command(name: str) -> Callable[[AddCommand], AddCommand]:
+    def register(fun: AddCommand) -> AddCommand:
+        _commands[name] = fun
+        return fun
+
+    return register
+
+
+def add_subparser(
+    subparsers: _SubParsersAction, name: str, help: str
+) -> ArgumentParser:
+    subparser: ArgumentParser
+    subparser = subparsers.add_parser(name, help=help)
+    subparser.add_argument(
+        "--network",
+        dest="network_dir",
+        metavar="FILE",
+        default=os.getcwd(),
+        help="path to a directory containing either nixops.nix or flake.nix",
+    )
+    subparser.add_argument(
+        "--deployment",
+        "-d",
+        dest="deployment",
+        metavar="UUID_OR_NAME",
+        default=os.environ.get(
+            "NIXOPS_DEPLOYMENT", os.environ.get("CHARON_DEPLOYMENT", None)
+        ),
+        help="UUID or symbolic name of the deployment",
+    )
+    subparser.add_argument("--debug", action="store_true", help="enable debug output")
+    subparser.add_argument(
+        "--confirm",
+        action="store_true",
+        help="confirm dangerous operations; do not ask",
+    )
+
+    # Nix options that we pass along.
+    subparser.add_argument(
+        "-I",
+        nargs=1,
+        action="append",
+        dest="nix_path",
+        metavar="PATH",
+        help="append a directory to the Nix search path",
+    )
+    subparser.add_argument(
+        "--max-jobs",
+        "-j",
+        type=int,
+        metavar="N",
+        help="set maximum number of concurrent Nix builds",
+    )
+    subparser.add_argument(
+        "--cores",
+        type=int,
+        metavar="N",
+        help="sets the value of the NIX_BUILD_CORES environment variable in the invocation of builders",
+    )
+    subparser.add_argument(
+        "--keep-going", action="store_true", help="keep going after failed builds"
+    )
+    subparser.add_argument(
+        "--keep-failed",
+        "-K",
+        action="store_true",
+        help="keep temporary directories of failed builds",
+    )
+    subparser.add_argument(
+        "--show-trace",
+        action="store_true",
+        help="print a Nix stack trace if evaluation fails, or a python stack trace if nixops fails",
+    )
+    subparser.add_argument(
+        "--fallback", action="store_true", help="fall back on installation from source"
+    )
+    subparser.add_argument(
+        "--no-build-output",
+        action="store_true",
+        help="suppress output written by builders",
+    )
+    subparser.add_argument(
+        "--option",
+        nargs=2,
+        action="append",
+        dest="nix_options",
+        metavar=("NAME", "VALUE"),
+        help="set a Nix option",
+    )
+    subparser.add_argument(
+        "--read-only-mode",
+        action="store_true",
+        help="run Nix evaluations in read-only mode",
+    )
+
+    return subparser
+
+
+def add_common_deployment_options(subparser: ArgumentParser) -> None:
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="perform deployment actions on the specified machines only",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="do not perform deployment actions on the specified machines",
+    )
+    subparser.add_argument(
+        "--check",
+        action="store_true",
+        help="do not assume that the recorded state is correct",
+    )
+    subparser.add_argument(
+        "--allow-reboot", action="store_true", help="reboot machines if necessary"
+    )
+    subparser.add_argument(
+        "--force-reboot", action="store_true", help="reboot machines unconditionally"
+    )
+    subparser.add_argument(
+        "--max-concurrent-copy",
+        type=int,
+        default=5,
+        metavar="N",
+        help="maximum number of concurrent nix-copy-closure processes",
+    )
+    subparser.add_argument(
+        "--copy-method",
+        choices=["direct", "fanout", "tree"],
+        default="direct",
+        help="how to copy closures: with nix-copy-closure per machine (default),"
+        " by exporting each store path once and streaming it to every"
+        " machine that lacks it (does not use substitutes), or from this"
+        " machine to a few machines that copy it on to nearby machines"
+        " (requires SSH agent forwarding)",
+    )
+    subparser.add_argument(
+        "--tree-fanout",
+        type=int,
+        default=3,
+        metavar="N",
+        help="with --copy-method tree, the number of machines each machine"
+        " copies closures to",
+    )
+    subparser.add_argument(
+        "--probe-closures",
+        action="store_true",
+        help="before copying, ask every machine which paths of its closure it"
+        " lacks, rather than only asking machines last deployed with their new"
+        " configuration whether they still have it",
+    )
+    subparser.add_argument(
+        "--adaptive-copy",
+        action="store_true",
+        help="with --copy-method direct, copy to as many machines at a time"
+        " (up to --max-concurrent-copy) as the measured throughput and round"
+        " trip times allow, and decide compression and substitutes per machine"
+        " from the throughput of earlier copies to it",
+    )
+    subparser.add_argument(
+        "--max-copy-bandwidth",
+        type=float,
+        metavar="MIB",
+        help="with --adaptive-copy, keep the total copy throughput under MIB" " MiB/s",
+    )
+    subparser.add_argument(
+        "--max-concurrent-activate",
+        type=int,
+        default=-1,
+        metavar="N",
+        help="maximum number of concurrent machine activations (with"
+        " --plan-only, of resources planned at the same time, default 8)",
+    )
+    subparser.add_argument(
+        "--no-sync", action="store_true", help="do not flush buffers to disk"
+    )
+
+
+@_command("list")
+def _list(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(subparsers, "list", help="list all known deployments")
+    subparser.set_defaults(op=LazyOp("op_list_deployments"), syslog=False)
+
+
+@_command("create")
+def _create(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(subparsers, "create", help="create a new deployment")
+    subparser.set_defaults(op=LazyOp("op_create"))
+    subparser.add_argument(
+        "--name", "-n", dest="name", metavar="NAME", help=SUPPRESS
+    )  # obsolete, use -d instead
+
+
+@_command("modify")
+def _modify(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "modify", help="modify an existing deployment"
+    )
+    subparser.set_defaults(op=LazyOp("op_modify"))
+    subparser.add_argument(
+        "--name",
+        "-n",
+        dest="name",
+        metavar="NAME",
+        help="new symbolic name of deployment",
+    )
+
+
+@_command("clone")
+def _clone(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(subparsers, "clone", help="clone an existing deployment")
+    subparser.set_defaults(op=LazyOp("op_clone"))
+    subparser.add_argument(
+        "--name",
+        "-n",
+        dest="name",
+        metavar="NAME",
+        help="symbolic name of the cloned deployment",
+    )
+
+
+@_command("delete")
+def _delete(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(subparsers, "delete", help="delete a deployment")
+    subparser.add_argument(
+        "--force",
+        action="store_true",
+        help="force deletion even if resources still exist",
+    )
+    subparser.add_argument("--all", action="store_true", help="delete all deployments")
+    subparser.set_defaults(op=LazyOp("op_delete"))
+
+
+@_command("info")
+def _info(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "info", help="show the state of the deployment"
+    )
+    subparser.set_defaults(op=LazyOp("op_info"), syslog=False)
+    subparser.add_argument("--all", action="store_true", help="show all deployments")
+    subparser.add_argument(
+        "--plain", action="store_true", help="do not pretty-print the output"
+    )
+    subparser.add_argument(
+        "--no-eval",
+        action="store_true",
+        help="do not evaluate the deployment specification",
+    )
+
+
+@_command("check")
+def _check(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "check",
+        help="check the state of the machines in the network"
+        " (note that this might alter the internal nixops state to consolidate with the real state of the resource)",
+    )
+    subparser.set_defaults(op=LazyOp("op_check"))
+    subparser.add_argument("--all", action="store_true", help="check all deployments")
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="check only the specified machines",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="check all except the specified machines",
+    )
+
+
+@_command("set-args")
+def _set_args(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "set-args",
+        help="persistently set arguments to the deployment specification",
+    )
+    subparser.set_defaults(op=LazyOp("op_set_args"))
+    subparser.add_argument(
+        "--arg",
+        nargs=2,
+        action="append",
+        dest="args",
+        metavar=("NAME", "VALUE"),
+        help="pass a Nix expression value",
+    )
+    subparser.add_argument(
+        "--argstr",
+        nargs=2,
+        action="append",
+        dest="argstrs",
+        metavar=("NAME", "VALUE"),
+        help="pass a string value",
+    )
+    subparser.add_argument(
+        "--unset",
+        nargs=1,
+        action="append",
+        dest="unset",
+        metavar="NAME",
+        help="unset previously set argument",
+    )
+
+
+@_command("deploy")
+def _deploy(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "deploy", help="deploy the network configuration"
+    )
+    subparser.set_defaults(op=LazyOp("op_deploy"))
+    subparser.add_argument(
+        "--kill-obsolete",
+        "-k",
+        action="store_true",
+        help="kill obsolete virtual machines",
+    )
+    subparser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="evaluate and print what would be built, and estimate what would be"
+        " copied to each machine",
+    )
+    subparser.add_argument(
+        "--dry-activate",
+        action="store_true",
+        help="show what will be activated on the machines in the network",
+    )
+    subparser.add_argument(
+        "--test",
+        action="store_true",
+        help="build and activate the new configuration; do not enable it in the bootloader. Rebooting the system will roll back automatically.",
+    )
+    subparser.add_argument(
+        "--boot",
+        action="store_true",
+        help="build the new configuration and enable it in the bootloader; do not activate it. Upon reboot, the system will use the new configuration.",
+    )
+    subparser.add_argument(
+        "--repair",
+        action="store_true",
+        help="use --repair when calling nix-build (slow)",
+    )
+    subparser.add_argument(
+        "--evaluate-only",
+        action="store_true",
+        help="only call nix-instantiate and exit",
+    )
+    subparser.add_argument(
+        "--plan-only",
+        action="store_true",
+        help="show the diff between the configuration and the state and exit",
+    )
+    subparser.add_argument(
+        "--json",
+        action="store_true",
+        help="with --plan-only, also print the changes as JSON lines on stdout;"
+        " with --dry-run, print the transfer estimates as JSON lines",
+    )
+    subparser.add_argument(
+        "--build-only",
+        action="store_true",
+        help="build only; do not perform deployment actions",
+    )
+    subparser.add_argument(
+        "--distributed-build",
+        action="store_true",
+        help="build on the machines being deployed as well, as Nix remote"
+        " builders (needs a Nix daemon that trusts this user)",
+    )
+    subparser.add_argument(
+        "--build-on-target",
+        action="store_true",
+        help="copy the derivation of each machine configuration to its machine"
+        " and build or substitute it there, rather than building here and"
+        " copying the result",
+    )
+    subparser.add_argument(
+        "--build-per-machine",
+        action="store_true",
+        help="build the configuration of each machine separately, so that a"
+        " failing one does not stop the others, and start copying each as soon"
+        " as it is built",
+    )
+    subparser.add_argument(
+        "--max-concurrent-build",
+        type=int,
+        default=4,
+        metavar="N",
+        help="with --build-per-machine or --build-on-target, the maximum number"
+        " of configurations to build at the same time",
+    )
+    subparser.add_argument(
+        "--create-only",
+        action="store_true",
+        help="exit after creating missing machines",
+    )
+    subparser.add_argument(
+        "--copy-only", action="store_true", help="exit after copying closures"
+    )
+    subparser.add_argument(
+        "--allow-recreate",
+        action="store_true",
+        help="recreate resources machines that have disappeared",
+    )
+    subparser.add_argument(
+        "--always-activate",
+        action="store_true",
+        help="activate unchanged configurations as well",
+    )
+    add_common_deployment_options(subparser)
+
+    def check_args(args: Namespace) -> None:
+        if args.build_on_target:
+            for option, used in [
+                ("--copy-method", args.copy_method != "direct"),
+                ("--adaptive-copy", args.adaptive_copy),
+                ("--max-copy-bandwidth", args.max_copy_bandwidth is not None),
+                ("--distributed-build", args.distributed_build),
+                ("--build-per-machine", args.build_per_machine),
+            ]:
+                if used:
+                    subparser.error(
+                        "{0} cannot be used with --build-on-target".format(option)
+                    )
+        if args.json and not (args.plan_only or args.dry_run):
+            subparser.error("--json requires --plan-only or --dry-run")
+
+    subparser.set_defaults(check_args=check_args)
+
+
+@_command("send-keys")
+def _send_keys(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(subparsers, "send-keys", help="send encryption keys")
+    subparser.set_defaults(op=LazyOp("op_send_keys"))
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="send keys to only the specified machines",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="send keys to all except the specified machines",
+    )
+
+
+@_command("destroy")
+def _destroy(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "destroy", help="destroy all resources in the specified deployment"
+    )
+    subparser.set_defaults(op=LazyOp("op_destroy"))
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="destroy only the specified machines",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="destroy all except the specified machines",
+    )
+    subparser.add_argument(
+        "--wipe", action="store_true", help="securely wipe data on the machines"
+    )
+    subparser.add_argument("--all", action="store_true", help="destroy all deployments")
+
+
+@_command("delete-resources")
+def _delete_resources(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "delete-resources",
+        help="deletes the resource from the local NixOps state file.",
+    )
+    subparser.set_defaults(op=LazyOp("op_delete_resources"))
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="RESOURCE-NAME",
+        help="delete only the specified resources",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="RESOURCE-NAME",
+        help="delete all resources except the specified resources",
+    )
+
+
+@_command("stop")
+def _stop(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "stop", help="stop all virtual machines in the network"
+    )
+    subparser.set_defaults(op=LazyOp("op_stop"))
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="stop only the specified machines",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="stop all except the specified machines",
+    )
+
+
+@_command("start")
+def _start(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "start", help="start all virtual machines in the network"
+    )
+    subparser.set_defaults(op=LazyOp("op_start"))
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="start only the specified machines",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="start all except the specified machines",
+    )
+
+
+@_command("reboot")
+def _reboot(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "reboot", help="reboot all virtual machines in the network"
+    )
+    subparser.set_defaults(op=LazyOp("op_reboot"))
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="reboot only the specified machines",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="reboot all except the specified machines",
+    )
+    subparser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="do not wait until the machines are up again",
+    )
+    subparser.add_argument(
+        "--rescue",
+        action="store_true",
+        help="reboot machines into the rescue system" " (if available)",
+    )
+    subparser.add_argument(
+        "--hard",
+        action="store_true",
+        help="send a hard reset (power switch) to the machines" " (if available)",
+    )
+
+
+@_command("show-arguments")
+def _show_arguments(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "show-arguments",
+        help="print the arguments to the network expressions",
+    )
+    subparser.set_defaults(op=LazyOp("op_show_arguments"))
+
+
+@_command("show-physical")
+def _show_physical(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "show-physical", help="print the physical network expression"
+    )
+    subparser.add_argument(
+        "--backup",
+        dest="backupid",
+        default=None,
+        help="print physical network expression for given backup id",
+    )
+    subparser.set_defaults(op=LazyOp("op_show_physical"), syslog=False)
+
+
+@_command("ssh")
+def _ssh(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "ssh", help="login on the specified machine via SSH"
+    )
+    subparser.set_defaults(op=LazyOp("op_ssh"), syslog=False)
+    subparser.add_argument(
+        "machine", metavar="MACHINE", help="identifier of the machine"
+    )
+    subparser.add_argument(
+        "args",
+        metavar="SSH_ARGS",
+        nargs=REMAINDER,
+        help="SSH flags and/or command",
+    )
+    subparser.add_argument(
+        "--now",
+        dest="now",
+        action="store_true",
+        help="do not acquire a lock before fetching the state",
+    )
+
+
+@_command("ssh-for-each")
+def _ssh_for_each(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "ssh-for-each", help="execute a command on each machine via SSH"
+    )
+    subparser.set_defaults(op=LazyOp("op_ssh_for_each"), syslog=False)
+    subparser.add_argument(
+        "args", metavar="ARG", nargs="*", help="additional arguments to SSH"
+    )
+    subparser.add_argument(
+        "--parallel", "-p", action="store_true", help="run in parallel"
+    )
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="run command only on the specified machines",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="run command on all except the specified machines",
+    )
+    subparser.add_argument(
+        "--all", action="store_true", help="run ssh-for-each for all deployments"
+    )
+
+
+@_command("scp")
+def _scp(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "scp", help="copy files to or from the specified machine via scp"
+    )
+    subparser.set_defaults(op=LazyOp("op_scp"), syslog=False)
+    subparser.add_argument(
+        "--from",
+        dest="scp_from",
+        action="store_true",
+        help="copy a file from specified machine",
+    )
+    subparser.add_argument(
+        "--to",
+        dest="scp_to",
+        action="store_true",
+        help="copy a file to specified machine",
+    )
+    subparser.add_argument(
+        "machine", metavar="MACHINE", help="identifier of the machine"
+    )
+    subparser.add_argument("source", metavar="SOURCE", help="source file location")
+    subparser.add_argument(
+        "destination", metavar="DEST", help="destination file location"
+    )
+
+
+@_command("mount")
+def _mount(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "mount",
+        help="mount a directory from the specified machine into the local filesystem",
+    )
+    subparser.set_defaults(op=LazyOp("op_mount"), syslog=False)
+    subparser.add_argument(
+        "machine",
+        metavar="MACHINE[:PATH]",
+        help="identifier of the machine, optionally followed by a path",
+    )
+    subparser.add_argument("destination", metavar="PATH", help="local path")
+    subparser.add_argument(
+        "--sshfs-option",
+        "-o",
+        action="append",
+        metavar="OPTIONS",
+        help="mount options passed to sshfs",
+    )
+
+
+@_command("rename")
+def _rename(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(subparsers, "rename", help="rename machine in network")
+    subparser.set_defaults(op=LazyOp("op_rename"))
+    subparser.add_argument(
+        "current_name", metavar="FROM", help="current identifier of the machine"
+    )
+    subparser.add_argument(
+        "new_name", metavar="TO", help="new identifier of the machine"
+    )
+
+
+@_command("backup")
+def _backup(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "backup",
+        help="make snapshots of persistent disks in network (currently EC2-only)",
+    )
+    subparser.set_defaults(op=LazyOp("op_backup"))
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="perform backup actions on the specified machines only",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="do not perform backup actions on the specified machines",
+    )
+    subparser.add_argument(
+        "--freeze",
+        dest="freeze_fs",
+        action="store_true",
+        help="freeze filesystems for non-root filesystems that support this (e.g. xfs)",
+    )
+    subparser.add_argument(
+        "--force",
+        dest="force",
+        action="store_true",
+        help="start new backup even if previous is still running",
+    )
+    subparser.add_argument(
+        "--devices",
+        nargs="+",
+        metavar="DEVICE-NAME",
+        help="only backup the specified devices",
+    )
+
+
+@_command("backup-status")
+def _backup_status(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(subparsers, "backup-status", help="get status of backups")
+    subparser.set_defaults(op=LazyOp("op_backup_status"), syslog=False)
+    subparser.add_argument(
+        "backupid",
+        default=None,
+        nargs="?",
+        help="use specified backup in stead of latest",
+    )
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="perform backup actions on the specified machines only",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="do not perform backup actions on the specified machines",
+    )
+    subparser.add_argument(
+        "--wait",
+        dest="wait",
+        action="store_true",
+        help="wait until backup is finished",
+    )
+    subparser.add_argument(
+        "--latest",
+        dest="latest",
+        action="store_true",
+        help="show status of latest backup only",
+    )
+
+
+@_command("remove-backup")
+def _remove_backup(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(subparsers, "remove-backup", help="remove a given backup")
+    subparser.set_defaults(op=LazyOp("op_remove_backup"))
+    subparser.add_argument("backupid", metavar="BACKUP-ID", help="backup ID to remove")
+    subparser.add_argument(
+        "--keep-physical",
+        dest="keep_physical",
+        action="store_true",
+        help="do not remove the physical backups, only remove backups from nixops state",
+    )
+
+
+@_command("clean-backups")
+def _clean_backups(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(subparsers, "clean-backups", help="remove old backups")
+    subparser.set_defaults(op=LazyOp("op_clean_backups"))
+    subparser.add_argument(
+        "--keep", dest="keep", type=int, help="number of backups to keep around"
+    )
+    subparser.add_argument(
+        "--keep-days",
+        metavar="N",
+        dest="keep_days",
+        type=int,
+        help="keep backups newer than N days",
+    )
+    subparser.add_argument(
+        "--keep-physical",
+        dest="keep_physical",
+        action="store_true",
+        help="do not remove the physical backups, only remove backups from nixops state",
+    )
+
+
+@_command("restore")
+def _restore(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "restore",
+        help="restore machines based on snapshots of persistent disks in network (currently EC2-only)",
+    )
+    subparser.set_defaults(op=LazyOp("op_restore"))
+    subparser.add_argument(
+        "--backup-id", default=None, help="use specified backup in stead of latest"
+    )
+    subparser.add_argument(
+        "--include",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="perform backup actions on the specified machines only",
+    )
+    subparser.add_argument(
+        "--exclude",
+        nargs="+",
+        metavar="MACHINE-NAME",
+        help="do not perform backup actions on the specified machines",
+    )
+    subparser.add_argument(
+        "--devices",
+        nargs="+",
+        metavar="DEVICE-NAME",
+        help="only restore the specified devices",
+    )
+
+
+@_command("show-option")
+def _show_option(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "show-option", help="print the value of a configuration option"
+    )
+    subparser.set_defaults(op=LazyOp("op_show_option"))
+    subparser.add_argument(
+        "machine", metavar="MACHINE", help="identifier of the machine"
+    )
+    subparser.add_argument("option", metavar="OPTION", help="option name")
+    subparser.add_argument(
+        "--include-physical",
+        action="store_true",
+        help="include the physical specification in the evaluation",
+    )
+
+
+@_command("list-generations")
+def _list_generations(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "list-generations",
+        help="list previous configurations to which you can roll back",
+    )
+    subparser.set_defaults(op=LazyOp("op_list_generations"), syslog=False)
+
+
+@_command("rollback")
+def _rollback(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "rollback", help="roll back to a previous configuration"
+    )
+    subparser.set_defaults(op=LazyOp("op_rollback"))
+    subparser.add_argument(
+        "generation",
+        type=int,
+        metavar="GENERATION",
+        help="number of the desired configuration (see ‘nixops list-generations’)",
+    )
+    add_common_deployment_options(subparser)
+
+
+@_command("delete-generation")
+def _delete_generation(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "delete-generation", help="remove a previous configuration"
+    )
+    subparser.set_defaults(op=LazyOp("op_delete_generation"))
+    subparser.add_argument(
+        "generation",
+        type=int,
+        metavar="GENERATION",
+        help="number of the desired configuration (see ‘nixops list-generations’)",
+    )
+    add_common_deployment_options(subparser)
+
+
+@_command("show-console-output")
+def _show_console_output(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers,
+        "show-console-output",
+        help="print the machine's console output on stdout",
+    )
+    subparser.set_defaults(op=LazyOp("op_show_console_output"), syslog=False)
+    subparser.add_argument(
+        "machine", metavar="MACHINE", help="identifier of the machine"
+    )
+    add_common_deployment_options(subparser)
+
+
+@_command("dump-nix-paths")
+def _dump_nix_paths(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "dump-nix-paths", help="dump Nix paths referenced in deployments"
+    )
+    subparser.add_argument(
+        "--all", action="store_true", help="dump Nix paths for all deployments"
+    )
+    subparser.set_defaults(op=LazyOp("op_dump_nix_paths"), syslog=False)
+    add_common_deployment_options(subparser)
+
+
+@_command("export")
+def _export(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "export", help="export the state of a deployment"
+    )
+    subparser.add_argument("--all", action="store_true", help="export all deployments")
+    subparser.set_defaults(op=LazyOp("op_export"), syslog=False)
+
+
+@_command("import")
+def _import(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "import", help="import deployments into the state file"
+    )
+    subparser.add_argument(
+        "--include-keys",
+        action="store_true",
+        help="import public SSH hosts keys to .ssh/known_hosts",
+    )
+    subparser.set_defaults(op=LazyOp("op_import"))
+
+
+@_command("edit")
+def _edit(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "edit", help="open the deployment specification in $EDITOR"
+    )
+    subparser.set_defaults(op=LazyOp("op_edit"))
+
+
+@_command("copy-closure")
+def _copy_closure(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "copy-closure", help="copy closure to a target machine"
+    )
+    subparser.add_argument("machine", help="identifier of the machine")
+    subparser.add_argument("storepath", help="store path of the closure to be copied")
+    subparser.set_defaults(op=LazyOp("op_copy_closure"))
+
+
+@_command("list-plugins")
+def _list_plugins(subparsers: _SubParsersAction) -> None:
+    subparser = subparsers.add_parser(
+        "list-plugins", help="list the available nixops plugins"
+    )
+    subparser.set_defaults(op=LazyOp("op_list_plugins"))
+    subparser.add_argument(
+        "--verbose", "-v", action="store_true", help="Provide extra plugin information"
+    )
+    subparser.add_argument("--debug", action="store_true", help="enable debug output")
+
+
+@_command("unlock")
+def _unlock(subparsers: _SubParsersAction) -> None:
+    subparser = add_subparser(
+        subparsers, "unlock", help="Force unlock the deployment lock"
+    )
+    subparser.set_defaults(op=LazyOp("op_unlock"))
+
+
+_parser: Optional[ArgumentParser] = None
+
+
+def _requested_command(argv: List[str]) -> Optional[str]:
+    for arg in argv:
+        if arg in ("-h", "--help", "--version"):
+            return None
+        if not arg.startswith("-"):
+            return arg
+    return None
+
+
+def _have_plugins() -> bool:
+    """
+    Return whether plugins other than NixOps' own are installed.  This
+    only reads the (cached) entry points, not the plugins themselves.
+    """
+    return any(
+        value != "nixops.plugin" for _, value in nixops.cache.entry_points("nixops")
+    )
+
+
+def get_parser(argv: Optional[List[str]] = None) -> ArgumentParser:
+    """
+    Return the parser for the command line ‘argv’ (by default, the
+    parser for sys.argv, which is only built once).  If it invokes a
+    core subcommand, only that subcommand is added to the parser and
+    extended by the ‘subcommand_parser’ hooks of the plugins, unless a
+    plugin implements the ‘parser’ hook, which may extend any
+    subcommand: then all subcommands are added and it is run.
+    """
+    global _parser
+    if argv is None:
+        if _parser is not None:
+            return _parser
+        _parser = get_parser(sys.argv[1:])
+        return _parser
+
+    parser = ArgumentParser(description="NixOS cloud deployment tool", prog="nixops")
+    parser.add_argument("--version", action="version", version="NixOps @version@")
+    parser.add_argument(
+        "--pdb", action="store_true", help="Invoke pdb on unhandled exception"
+    )
+
+    subparsers: _SubParsersAction = parser.add_subparsers(
+        help="sub-command help", metavar="operation", required=True
+    )
+
+    command = _requested_command(argv)
+    if command in _commands and not _have_plugins():
+        _commands[command](subparsers)
+        return parser
+
+    from nixops.plugins.manager import PluginManager
+
+    if command in _commands and not PluginManager.extends_parser():
+        _commands[command](subparsers)
+    else:
+        for add_command in _commands.values():
+            add_command(subparsers)
+        PluginManager.parser(parser, subparsers)
+    if command in _commands:
+        PluginManager.subcommand_parser(command, subparsers.choices[command])
+
+    return parser
+
+
+def parse_args(argv: Optional[List[str]] = None) -> Namespace:
+    """
+    Parse ‘argv’ (by default, sys.argv).  Subcommands can reject
+    combinations of options by setting a ‘check_args’ default.
+    """
+    args = get_parser(argv).parse_args(argv)
+    check_args = getattr(args, "check_args", None)
+    if check_args is not None:
+        check_args(args)
+    return args
+
+
+def __getattr__(name: str) -> Any:
+    # Backwards compatibility: the parser used to be built on import.
+    if name == "parser":
+        return get_parser()
+    raise AttributeError("module {0} has no attribute {1}".format(__name__, name))
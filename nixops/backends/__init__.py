@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
+import ipaddress
 import os
 import re
 from typing import (
@@ -13,15 +14,36 @@ from typing import (
     Sequence,
     TypeVar,
     Callable,
+    Iterator,
+    Tuple,
 )
+from contextlib import contextmanager
 from nixops.monkey import Protocol, runtime_checkable
 import nixops.util
 import nixops.resources
 import nixops.ssh_util
 from nixops.state import RecordId
+import socket
 import subprocess
 import threading
 import nixops
+import nixops.reachability
+
+
+# The ssh_config files that ‘ssh -G’ output depends on.
+_SSH_CONFIG_FILES = ["~/.ssh/config", "/etc/ssh/ssh_config"]
+
+
+def _mtimes(paths: Sequence[str]) -> Tuple[Tuple[str, Optional[int]], ...]:
+    """The modification times of ‘paths’, or None for missing files."""
+    result = []
+    for path in paths:
+        try:
+            mtime: Optional[int] = os.stat(os.path.expanduser(path)).st_mtime_ns
+        except OSError:
+            mtime = None
+        result.append((path, mtime))
+    return tuple(result)
 
 
 class KeyOptions(nixops.resources.ResourceOptions):
@@ -70,8 +92,7 @@ class MachineDefinition(nixops.resources.ResourceDefinition):
         self.always_activate = self.config.alwaysActivate
         self.owners = self.config.owners
         self.has_fast_connection = self.config.hasFastConnection
-        # TODO: Extend MutableValidatedObject to handle this case
-        self.keys = {k: KeyOptions(**v) for k, v in config["keys"].items()}
+        self.keys = dict(self.config.keys)
         self.ssh_options = self.config.sshOptions
 
         self.ssh_user = self.config.targetUser or "root"
@@ -83,6 +104,23 @@ class MachineDefinition(nixops.resources.ResourceDefinition):
 MachineDefinitionType = TypeVar("MachineDefinitionType", bound="MachineDefinition")
 
 
+def _ssh_flags_port(flags: List[str]) -> Optional[int]:
+    """
+    The port set by ‘-p N’ or ‘-o Port=N’ in the SSH command line
+    ‘flags’, or None if none is.  As with ssh, the first one wins.
+    """
+    args = iter(flags)
+    for flag in args:
+        if flag.startswith("-p"):
+            return int(flag[2:] or next(args, ""))
+        if flag.startswith("-o"):
+            option = flag[2:] or next(args, "")
+            (key, _, value) = option.replace("=", " ", 1).partition(" ")
+            if key.lower() == "port":
+                return int(value.strip())
+    return None
+
+
 @runtime_checkable
 class MachineState(
     nixops.resources.ResourceState[MachineDefinitionType],
@@ -131,6 +169,12 @@ class MachineState(
 
     state: nixops.resources.State
 
+    # Memoized ‘ssh -G’ output and generated known_hosts file, with the
+    # inputs they were computed from.
+    _ssh_ambient_options: Optional[Tuple[Any, Dict[str, str]]] = None
+    _ssh_known_hosts: Optional[Tuple[Any, str]] = None
+    _pinned_ssh_flags: Optional[List[str]] = None
+
     def __init__(
         self, depl: "nixops.deployment.Deployment", name: str, id: RecordId
     ) -> None:
@@ -138,12 +182,15 @@ class MachineState(
         self.defn = None
         self._ssh_pinged_this_time = False
         self.ssh = nixops.ssh_util.SSH(self.logger)
-        self.ssh.register_flag_fun(self.get_ssh_flags)
+        self.ssh.register_flag_fun(self._get_ssh_flags)
         self.ssh.register_host_fun(self.get_ssh_name)
         self.ssh.register_passwd_fun(self.get_ssh_password)
         self._ssh_private_key_file: Optional[str] = None
         self.new_toplevel: Optional[str] = None
         self.ssh.privilege_escalation_command = self.privilege_escalation_command
+        self._ssh_ambient_options = None
+        self._ssh_known_hosts = None
+        self._pinned_ssh_flags = None
 
     def prefix_definition(self, attr):
         return attr
@@ -340,12 +387,64 @@ class MachineState(
         if not self.ping():
             raise ValueError("Did not return True")
 
+    def _tcp_address(self) -> Optional[Tuple[str, int]]:
+        """
+        The host and port that SSH connects to, or None if they cannot be
+        probed directly, e.g. because SSH goes through a proxy.
+        """
+        flags = self.get_ssh_flags()
+        if "-J" in flags or any(
+            f.lower().startswith(("proxycommand", "proxyjump", "hostname"))
+            for f in flags
+        ):
+            return None
+        opts = self._get_ssh_ambient_options()
+        if opts.get("proxycommand", "none") != "none":
+            return None
+        if opts.get("proxyjump", "none") != "none":
+            return None
+        try:
+            port = _ssh_flags_port(flags)
+        except ValueError:
+            return None
+        if port is None:
+            port = int(opts.get("port", 22))
+        return (opts.get("hostname", self.get_ssh_name()), port)
+
+    def _wait_for_tcp(
+        self,
+        up: bool,
+        timeout: Optional[int],
+        callback: Optional[Callable[[], Any]],
+    ) -> bool:
+        """
+        Wait for the SSH port using the shared prober.  Return false if
+        it cannot be used for this machine.
+        """
+        address = self._tcp_address()
+        if address is None:
+            return False
+        try:
+            prober = nixops.reachability.get_prober()
+            prober.wait(
+                *address,
+                up=up,
+                timeout=timeout,
+                callback=callback,
+                # An open port does not mean that we can log in yet.
+                confirm=self.ping if up else None,
+            )
+        except socket.gaierror:
+            return False
+        return True
+
     def wait_for_up(
         self,
         timeout: Optional[int] = None,
         callback: Optional[Callable[[], Any]] = None,
     ) -> None:
-        nixops.util.wait_for_success(self._ping, timeout=timeout, callback=callback)
+        if not self._wait_for_tcp(True, timeout, callback):
+            nixops.util.wait_for_success(self._ping, timeout=timeout, callback=callback)
         self.ssh.reset()  # To avoid passing a stderr suppressed master conn forward
 
     def wait_for_down(
@@ -353,7 +452,8 @@ class MachineState(
         timeout: Optional[int] = None,
         callback: Optional[Callable[[], Any]] = None,
     ) -> None:
-        nixops.util.wait_for_fail(self._ping, timeout=timeout, callback=callback)
+        if not self._wait_for_tcp(False, timeout, callback):
+            nixops.util.wait_for_fail(self._ping, timeout=timeout, callback=callback)
         self.ssh.reset()  # To avoid passing a stderr suppressed master conn forward
 
     def reboot_sync(self, hard: bool = False) -> None:
@@ -478,8 +578,15 @@ class MachineState(
         return None
 
     def _get_ssh_ambient_options(self) -> Dict[str, str]:
+        ssh_name = self.get_ssh_name()
+        key = (ssh_name, _mtimes(_SSH_CONFIG_FILES))
+        if self._ssh_ambient_options is not None:
+            (cached_key, cached) = self._ssh_ambient_options
+            if cached_key == key:
+                return cached
+
         with subprocess.Popen(
-            ["ssh", "-G", self.get_ssh_name()], stdout=subprocess.PIPE, text=True
+            ["ssh", "-G", ssh_name], stdout=subprocess.PIPE, text=True
         ) as proc:
             assert proc.stdout is not None
             opts: Dict[str, str] = {}
@@ -488,7 +595,8 @@ class MachineState(
                 if len(s) == 2:
                     opts[s[0].lower()] = s[1]
 
-            return opts
+        self._ssh_ambient_options = (key, opts)
+        return opts
 
     def get_known_hosts_file(self, *args, **kwargs) -> Optional[str]:
         k = self.get_ssh_host_keys()
@@ -515,6 +623,27 @@ class MachineState(
 
         return flags
 
+    def _get_ssh_flags(self) -> List[str]:
+        if self._pinned_ssh_flags is not None:
+            return list(self._pinned_ssh_flags)
+        return self.get_ssh_flags()
+
+    @contextmanager
+    def pinned_ssh_flags(self) -> Iterator[None]:
+        """
+        Compute the SSH flags once, and use them for every SSH command in
+        the block.  Only use this where nothing in the block changes them,
+        e.g. not across a reboot.
+        """
+        if self._pinned_ssh_flags is not None:
+            yield
+            return
+        self._pinned_ssh_flags = self.get_ssh_flags()
+        try:
+            yield
+        finally:
+            self._pinned_ssh_flags = None
+
     def get_ssh_password(self):
         return None
 
@@ -533,6 +662,21 @@ class MachineState(
         """Return the IP address to be used to access resource "r" from this machine."""
         return r.public_ipv4
 
+    def locality_hint(self) -> Optional[str]:
+        """
+        Return a name for the network this machine is in, such that
+        machines with the same hint can copy closures between each other
+        quickly, or None if not known.  By default, machines with a
+        private IPv4 address in the same /24 network are considered close.
+        """
+        if not self.private_ipv4:
+            return None
+        try:
+            network = ipaddress.ip_network(self.private_ipv4 + "/24", strict=False)
+        except ValueError:
+            return None
+        return str(network)
+
     def wait_for_ssh(self, check: bool = False) -> None:
         """Wait until the SSH port is open on this machine."""
         if self.ssh_pinged and (not check or self._ssh_pinged_this_time):
@@ -574,6 +718,14 @@ class MachineState(
         else:
             ambientGlobalFiles = ambientGlobalFilesStr.split()
 
+        file = "{0}/known_host_nixops-{1}".format(self.depl.tempdir, self.name)
+
+        # The file only has to be rewritten if our key or one of the global
+        # files changed.
+        key = (known_hosts, self.get_ssh_name(), _mtimes(ambientGlobalFiles))
+        if self._ssh_known_hosts == (key, file) and os.path.exists(file):
+            return file
+
         for globalFile in ambientGlobalFiles:
             if os.path.exists(globalFile):
                 with open(globalFile) as f:
@@ -582,9 +734,11 @@ class MachineState(
                     known_hosts + f"\n\n# entries from {globalFile}\n" + contents
                 )
 
-        file = "{0}/known_host_nixops-{1}".format(self.depl.tempdir, self.name)
-        with os.fdopen(os.open(file, os.O_CREAT | os.O_WRONLY, 0o600), "w") as f:
+        with os.fdopen(
+            os.open(file, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600), "w"
+        ) as f:
             f.write(known_hosts)
+        self._ssh_known_hosts = (key, file)
         return file
 
     def _logged_exec(self, command: List[str], **kwargs) -> Union[str, int]:
@@ -619,22 +773,41 @@ class MachineState(
         cmd += " " + method
         return int(self.run_command(cmd, check=False))
 
-    def copy_closure_to(self, path: str) -> None:
-        """Copy a closure to this machine."""
+    def copy_closure_to(
+        self,
+        path: str,
+        compress: Optional[bool] = None,
+        use_substitutes: Optional[bool] = None,
+    ) -> None:
+        """
+        Copy a closure to this machine.  Whether to compress the copy and
+        to let the machine use substitutes defaults to what
+        ‘hasFastConnection’ says.
+        """
 
-        # !!! Implement copying between cloud machines, as in the Perl
-        # version.
+        # Copying between machines is done by nixops.transfer.tree_copy().
 
         ssh = self.get_ssh_for_copy_closure()
 
-        # Any remaining paths are copied from the local machine.
+        # Any remaining paths are copied from the local machine.  The SSH
+        # master connection is compressed if the machine does not have a
+        # fast connection.  Compression cannot be changed per session of
+        # a master connection (and Nix ignores ‘--gzip’), so a copy that
+        # needs otherwise gets its own connection.
         env = dict(os.environ)
-        env["NIX_SSHOPTS"] = " ".join(
-            ssh._get_flags() + ssh.get_master(user=self.ssh_user).opts
-        )
+        if compress is None or compress == ssh._compress:
+            opts = ssh.get_master(user=self.ssh_user).opts
+        else:
+            opts = [
+                "-oControlPath=none",
+                "-oCompression=" + ("yes" if compress else "no"),
+            ]
+        env["NIX_SSHOPTS"] = " ".join(ssh._get_flags() + opts)
+        if use_substitutes is None:
+            use_substitutes = not self.has_fast_connection
         self._logged_exec(
             ["nix-copy-closure", "--to", ssh._get_target(user=self.ssh_user), path]
-            + ([] if self.has_fast_connection else ["--use-substitutes"]),
+            + (["--use-substitutes"] if use_substitutes else []),
             env=env,
         )
 
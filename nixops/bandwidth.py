@@ -0,0 +1,219 @@
+"""
+Adapting closure copies to the available bandwidth.
+
+With a fixed number of concurrent copies, a deployment either saturates
+the uplink, so that copies slow down and time out, or leaves it idle.
+The Controller instead adjusts the number of concurrent copies as they
+complete, like TCP does with its congestion window: it adds about one
+copy per round of copies that succeed, and halves the number on signs
+of congestion, i.e. a failed copy, a round trip time during a copy well
+above the one measured to the same host just before it, or an aggregate
+throughput above the bandwidth cap.
+
+link_options() decides per host whether to compress and whether to let
+the machine use substitutes, from the throughput measured in earlier
+copies to it.
+"""
+
+import socket
+import statistics
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+MiB = 1024 * 1024
+
+# Number of concurrent copies to start with.
+INITIAL_CONCURRENCY = 2
+# Factor by which the concurrency is reduced on congestion.
+DECREASE = 0.5
+# A round trip time during a copy this many times the one before it
+# means that the link is congested.
+RTT_INFLATION = 3.0
+# Weight of the newest sample in the aggregate throughput.
+SMOOTHING = 0.3
+
+# Below this throughput compressing the stream saves more time than it
+# costs.
+COMPRESS_BELOW = 30 * MiB
+# Below this throughput a machine is expected to fetch paths from a
+# binary cache faster than from us.
+SUBSTITUTE_BELOW = 5 * MiB
+
+
+@dataclass
+class Ticket:
+    """A copy that may run, handed out by Controller.acquire()."""
+
+    start: float
+    # The value of Controller._busy when it started.
+    busy: float
+    # The number of decreases before it started.
+    epoch: int
+
+
+class Controller:
+    """
+    Limit the number of concurrent copies to an additive-increase,
+    multiplicative-decrease window between 1 and ‘max_concurrency’,
+    keeping the aggregate throughput under ‘bandwidth_cap’ bytes per
+    second if given.
+    """
+
+    def __init__(
+        self, max_concurrency: int, bandwidth_cap: Optional[float] = None
+    ) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self.bandwidth_cap = bandwidth_cap
+        self.limit = float(min(INITIAL_CONCURRENCY, self.max_concurrency))
+        self._cond = threading.Condition()
+        self._active = 0
+        self._epoch = 0
+        # The number of copies running, integrated over time.
+        self._busy = 0.0
+        self._busy_at = time.monotonic()
+        # The smoothed aggregate throughput in bytes per second.
+        self.rate: Optional[float] = None
+        # The window after each change, oldest first.
+        self.limits: List[int] = [int(self.limit)]
+
+    def acquire(self) -> Ticket:
+        """Wait until another copy may run."""
+        with self._cond:
+            while self._active >= int(self.limit):
+                self._cond.wait()
+            self._account()
+            self._active += 1
+            return Ticket(self._busy_at, self._busy, self._epoch)
+
+    def release(
+        self,
+        ticket: Ticket,
+        size: int,
+        ok: bool = True,
+        rtt: Optional[float] = None,
+        base_rtt: Optional[float] = None,
+    ) -> None:
+        """
+        Record that the copy of ‘ticket’ transferred ‘size’ bytes and
+        succeeded if ‘ok’, and the round trip time to its host measured
+        while it was in progress (‘rtt’) and just before (‘base_rtt’).
+        """
+        with self._cond:
+            self._account()
+            now = self._busy_at
+            self._active -= 1
+            congested = not ok
+            if rtt is not None and base_rtt is not None:
+                if rtt > RTT_INFLATION * base_rtt:
+                    congested = True
+            if ok and size > 0 and now > ticket.start:
+                # Copies running at the same time share the uplink, so
+                # the aggregate is about this copy's rate times their
+                # average number.
+                concurrency = (self._busy - ticket.busy) / (now - ticket.start)
+                sample = size / (now - ticket.start) * concurrency
+                self.rate = (
+                    sample
+                    if self.rate is None
+                    else SMOOTHING * sample + (1 - SMOOTHING) * self.rate
+                )
+                if self.bandwidth_cap is not None and self.rate > self.bandwidth_cap:
+                    congested = True
+            if congested:
+                # Only react once to the copies that ran before the last
+                # decrease.
+                if ticket.epoch == self._epoch:
+                    self._epoch += 1
+                    self._set_limit(self.limit * DECREASE)
+            elif ok and not self._near_cap():
+                self._set_limit(self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def _account(self) -> None:
+        now = time.monotonic()
+        self._busy += self._active * (now - self._busy_at)
+        self._busy_at = now
+
+    def _near_cap(self) -> bool:
+        """Whether one more copy would probably exceed the bandwidth cap."""
+        if self.bandwidth_cap is None or self.rate is None:
+            return False
+        return self.rate * (int(self.limit) + 1) / int(self.limit) > self.bandwidth_cap
+
+    def _set_limit(self, limit: float) -> None:
+        self.limit = min(max(limit, 1.0), float(self.max_concurrency))
+        if int(self.limit) != self.limits[-1]:
+            self.limits.append(int(self.limit))
+
+
+def measure_rtt(address: Tuple[str, int], timeout: float = 5.0) -> Optional[float]:
+    """
+    The time it takes to connect to ‘address’, in seconds, or None if it
+    cannot be connected to.
+    """
+    start = time.monotonic()
+    try:
+        with socket.create_connection(address, timeout=timeout):
+            return time.monotonic() - start
+    except OSError:
+        return None
+
+
+class RTTSampler:
+    """
+    Measure the round trip time to ‘address’ before the block starts, as
+    a baseline, and then in the background, right away and every
+    ‘interval’ seconds until the block ends, so as to see the effect of
+    the copy running in it.
+    """
+
+    def __init__(self, address: Tuple[str, int], interval: float = 5.0) -> None:
+        self._address = address
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.baseline: Optional[float] = None
+        self.samples: List[float] = []
+
+    def _sample(self) -> None:
+        rtt = measure_rtt(self._address)
+        if rtt is not None:
+            self.samples.append(rtt)
+
+    def _run(self) -> None:
+        self._sample()
+        while not self._stop.wait(self._interval):
+            self._sample()
+
+    def __enter__(self) -> "RTTSampler":
+        self.baseline = measure_rtt(self._address)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def rtt(self) -> Optional[float]:
+        """The median of the round trip times measured in the block, if any."""
+        if not self.samples:
+            return None
+        return statistics.median(self.samples)
+
+
+def link_options(
+    throughput: Optional[float], has_fast_connection: bool
+) -> Tuple[bool, bool]:
+    """
+    Return whether to compress copies to a host, and whether to let it
+    use substitutes, given the ‘throughput’ of earlier copies to it, or
+    its ‘hasFastConnection’ option if it was never measured.
+    """
+    if throughput is None:
+        return (not has_fast_connection, not has_fast_connection)
+    return (throughput < COMPRESS_BELOW, throughput < SUBSTITUTE_BELOW)
@@ -0,0 +1,160 @@
+"""
+Using deployment machines as remote builders.
+
+The machines being deployed are registered as Nix remote builders (in
+the format of nix.machines(5)), each with the system types it can build
+for and a number of jobs and speed factor reflecting how many of its
+cores are idle, so that Nix spreads the derivations of the machine
+configurations over them.  BuildLog picks up from Nix's output which
+derivation was built where, for reporting how much each builder did.
+"""
+
+import base64
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, TYPE_CHECKING, Tuple
+
+if TYPE_CHECKING:
+    import nixops.backends
+
+# The Nix system types that a machine can build for, by ‘uname -m’.
+SYSTEMS: Dict[str, List[str]] = {
+    "x86_64": ["x86_64-linux", "i686-linux"],
+    "i686": ["i686-linux"],
+    "aarch64": ["aarch64-linux"],
+    "armv7l": ["armv7l-linux"],
+    "armv6l": ["armv6l-linux"],
+}
+
+_building = re.compile(r"building '(/nix/store/[^']+\.drv)'(?: on '([^']+)')?")
+
+
+@dataclass
+class Builder:
+    """An entry of a Nix machines file."""
+
+    uri: str
+    systems: List[str]
+    ssh_key: Optional[str] = None
+    max_jobs: int = 1
+    speed_factor: int = 1
+    supported_features: List[str] = field(default_factory=list)
+    mandatory_features: List[str] = field(default_factory=list)
+    public_host_key: Optional[str] = None
+    # The deployment machine, if it is one.
+    machine: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        return self.machine or self.uri
+
+    def line(self) -> str:
+        """The entry in a machines file."""
+
+        def join(values: List[str]) -> str:
+            return ",".join(values) or "-"
+
+        return " ".join(
+            [
+                self.uri,
+                join(self.systems),
+                self.ssh_key or "-",
+                str(self.max_jobs),
+                str(self.speed_factor),
+                join(self.supported_features),
+                join(self.mandatory_features),
+                base64.b64encode(self.public_host_key.encode()).decode()
+                if self.public_host_key
+                else "-",
+            ]
+        )
+
+
+def parse_machines(text: str) -> List[Builder]:
+    """Parse the contents of a Nix machines file."""
+    builders: List[Builder] = []
+    for line in text.splitlines():
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        fields += ["-"] * (8 - len(fields))
+
+        def values(s: str) -> List[str]:
+            return [] if s == "-" else s.split(",")
+
+        builders.append(
+            Builder(
+                uri=fields[0],
+                systems=values(fields[1]),
+                ssh_key=None if fields[2] == "-" else fields[2],
+                max_jobs=1 if fields[3] == "-" else int(fields[3]),
+                speed_factor=1 if fields[4] == "-" else int(fields[4]),
+                supported_features=values(fields[5]),
+                mandatory_features=values(fields[6]),
+                public_host_key=None
+                if fields[7] == "-"
+                else base64.b64decode(fields[7]).decode(),
+            )
+        )
+    return builders
+
+
+def probe(machine: "nixops.backends.GenericMachineState") -> Builder:
+    """
+    Describe ‘machine’ as a remote builder, from its architecture,
+    number of cores and load average.
+    """
+    (cores, arch) = str(
+        machine.run_command("nproc; uname -m", capture_stdout=True, timeout=15)
+    ).split()
+    systems = SYSTEMS.get(arch)
+    if systems is None:
+        raise Exception(
+            "machine ‘{0}’ has unsupported architecture ‘{1}’".format(
+                machine.name, arch
+            )
+        )
+    load_avg = machine.get_load_avg()
+    load = float(load_avg[0]) if load_avg else 0.0
+    idle = max(1, round(int(cores) - load))
+    return Builder(
+        uri="{0}@{1}".format(machine.ssh_user, machine.get_ssh_name()),
+        systems=systems,
+        ssh_key=machine.get_ssh_private_key_file(),
+        max_jobs=idle,
+        speed_factor=idle,
+        public_host_key=machine.public_host_key,
+        machine=machine.name,
+    )
+
+
+class BuildLog:
+    """Which derivations Nix built, and where, from its output."""
+
+    def __init__(self) -> None:
+        # The derivations built by each builder, by URI, or None for
+        # the local machine.
+        self.builds: Dict[Optional[str], List[str]] = {}
+
+    def feed(self, line: str) -> None:
+        m = _building.search(line)
+        if m is not None:
+            self.builds.setdefault(m.group(2), []).append(m.group(1))
+
+    def utilization(self, builders: List[Builder]) -> List[Tuple[str, int, float]]:
+        """
+        The name, number of builds and share of all builds of each
+        builder and of the local machine ("localhost"), busiest first.
+        """
+        total = sum(len(drvs) for drvs in self.builds.values())
+        names = {b.uri: b.name for b in builders}
+        # Nix may show the URI with a scheme.
+        names.update({"ssh://" + b.uri: b.name for b in builders})
+        counts: Dict[str, int] = {b.name: 0 for b in builders}
+        for uri, drvs in self.builds.items():
+            name = "localhost" if uri is None else names.get(uri, uri)
+            counts[name] = counts.get(name, 0) + len(drvs)
+        return sorted(
+            ((name, n, n / total if total else 0.0) for name, n in counts.items()),
+            key=lambda u: -u[1],
+        )
@@ -0,0 +1,116 @@
+"""
+NixOps' persistent caches.
+
+This module is imported to parse the command line, so it must only
+depend on the standard library.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from typing import List, Optional, Tuple
+
+
+def cache_dir(name: str) -> Optional[str]:
+    """
+    Return the directory of one of NixOps' persistent caches, or None if
+    caching has been disabled by setting $NIXOPS_NO_CACHE or there is no
+    cache directory ($XDG_CACHE_HOME and $HOME are both unset).
+    """
+    if os.environ.get("NIXOPS_NO_CACHE"):
+        return None
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        home = os.environ.get("HOME")
+        if not home:
+            return None
+        base = os.path.join(home, ".cache")
+    return os.path.join(base, "nixops", name)
+
+
+def write_file_atomic(path: str, contents: str) -> None:
+    """Write a file by renaming a temporary file over it."""
+    os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_cache_file(path: str, contents: str) -> bool:
+    """
+    Write a file in one of NixOps' caches (see cache_dir()).  Caches are
+    only an optimisation, so if the file cannot be written, e.g. because
+    the cache directory is read-only, return False rather than failing.
+    """
+    try:
+        write_file_atomic(path, contents)
+    except OSError:
+        return False
+    return True
+
+
+def _entry_points_fingerprint() -> str:
+    """
+    Fingerprint the installed distributions by the mtimes of their
+    entry point metadata, which is much cheaper than reading it.
+    """
+    digest = hashlib.sha256()
+    for path in sys.path:
+        digest.update(path.encode() + b"\0")
+        try:
+            entries = os.scandir(path or ".")
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if not entry.name.endswith((".dist-info", ".egg-info")):
+                    continue
+                try:
+                    st = os.stat(os.path.join(entry.path, "entry_points.txt"))
+                    mtime = st.st_mtime_ns
+                except OSError:
+                    mtime = 0
+                digest.update("{0}:{1}\0".format(entry.name, mtime).encode())
+    return digest.hexdigest()
+
+
+def entry_points(group: str) -> List[Tuple[str, str]]:
+    """
+    Return the (name, value) pairs of the entry points in ‘group’.
+    They are indexed in the cache directory, so that the metadata of
+    every installed distribution is only read again when one changes.
+    """
+    directory = cache_dir("plugins")
+    index_file = os.path.join(directory, group + ".json") if directory else None
+    fingerprint = _entry_points_fingerprint() if index_file else None
+
+    if index_file is not None:
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+            if index["fingerprint"] == fingerprint:
+                return [(name, value) for name, value in index["entry_points"]]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    import importlib.metadata
+
+    result: List[Tuple[str, str]] = []
+    for dist in importlib.metadata.distributions():
+        for ep in dist.entry_points:
+            if ep.group == group:
+                result.append((ep.name, ep.value))
+
+    if index_file is not None:
+        write_cache_file(
+            index_file,
+            json.dumps({"fingerprint": fingerprint, "entry_points": result}),
+        )
+    return result
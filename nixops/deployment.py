@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import contextlib
+import json
 import sys
 import os.path
 import subprocess
@@ -10,6 +12,7 @@ from collections import defaultdict
 import re
 from datetime import datetime, timedelta
 from nixops.resources import GenericResourceState
+import nixops.state
 import nixops.statefile
 import getpass
 import traceback
@@ -18,15 +21,18 @@ import fcntl
 import platform
 import time
 import importlib
+import urllib.parse
 
 from functools import reduce, lru_cache
 from typing import (
     Callable,
     Dict,
+    Iterator,
     Optional,
     TextIO,
     Set,
     List,
+    Sequence,
     DefaultDict,
     Any,
     Tuple,
@@ -36,8 +42,15 @@ from typing import (
     Type,
 )
 import nixops.backends
+import nixops.bandwidth
+import nixops.builders
+import nixops.cache
+import nixops.diff
 import nixops.logger
+import nixops.nixlog
 import nixops.parallel
+import nixops.scheduling
+import nixops.transfer
 from nixops.plugins.manager import (
     DeploymentHooksManager,
     MachineHooksManager,
@@ -46,6 +59,7 @@ from nixops.plugins.manager import (
 
 from nixops.nix_expr import RawValue, Function, Call, nixmerge, py2nix
 from nixops.ansi import ansi_success
+from nixops.registry import ResourceRegistry, TypeRegistry
 import nixops.evaluation
 
 
@@ -58,12 +72,143 @@ class UnknownBackend(Exception):
 
 DEBUG: bool = False
 
+# Seconds between logging the progress of builds.
+BUILD_PROGRESS_INTERVAL = 5.0
+# Number of build reports to keep per deployment.
+BUILD_REPORTS_KEPT = 20
+# Number of resources planned at the same time by ‘--plan-only’, unless
+# ‘--max-concurrent-activate’ is given.
+MAX_CONCURRENT_PLAN = 8
+
 NixosConfigurationType = List[Dict[Tuple[str, ...], Any]]
 
 TypedResource = TypeVar("TypedResource")
 TypedDefinition = TypeVar("TypedDefinition")
 
 
+class PresentClosures:
+    """
+    The store paths that ‘Deployment._skip_present_closures’ did not
+    copy, collected over several calls so that they are reported once.
+    """
+
+    def __init__(self) -> None:
+        self.machines = 0
+        self.present_machines = 0
+        # The paths not copied to machines that have their configuration,
+        # and to those that only have part of its closure.
+        self.skipped: List[str] = []
+        self.partial: List[str] = []
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        machines: int,
+        present_machines: int,
+        skipped: List[str],
+        partial: List[str],
+    ) -> None:
+        with self._lock:
+            self.machines += machines
+            self.present_machines += present_machines
+            self.skipped += skipped
+            self.partial += partial
+
+
+class DeploymentLock(object):
+    """
+    A flock(2)-based lock on a deployment.
+
+    Without resources, the deployment lock file is locked exclusively.
+    With resources, every named resource gets an exclusive lock file of
+    its own and the deployment lock file is locked shared.  The resource
+    locks are acquired in sorted order, and before the deployment lock,
+    so that concurrent lockers cannot deadlock.  Changes to state shared
+    by the whole deployment are serialised by a separate lock file, see
+    exclusive().
+    """
+
+    def __init__(
+        self,
+        lock_file_path: str,
+        logger: nixops.logger.Logger,
+        resources: Sequence[str] = (),
+    ):
+        self._lock_file_path = lock_file_path
+        self._logger = logger
+        self.resources: List[str] = sorted(set(resources))
+        self._lock_files: List[TextIO] = []
+        self.held = False
+
+    def _flock(self, lock_file: TextIO, exclusive: bool, what: str) -> None:
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(lock_file, mode | fcntl.LOCK_NB)
+        except IOError:
+            self._logger.log("waiting for {0}...".format(what))
+            fcntl.flock(lock_file, mode)
+
+    def _open(self, path: str) -> TextIO:
+        lock_file = open(path, "w")
+        fcntl.fcntl(lock_file, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._lock_files.append(lock_file)
+        return lock_file
+
+    def __enter__(self) -> None:
+        try:
+            if not self.resources:
+                self._flock(
+                    self._open(self._lock_file_path), True, "exclusive deployment lock"
+                )
+                self.held = True
+                return
+
+            resource_dir = self._lock_file_path + ".resources"
+            if not os.path.exists(resource_dir):
+                os.makedirs(resource_dir, 0o700, exist_ok=True)
+            for name in self.resources:
+                self._flock(
+                    self._open(
+                        os.path.join(resource_dir, urllib.parse.quote(name, safe=""))
+                    ),
+                    True,
+                    "exclusive lock on resource ‘{0}’".format(name),
+                )
+            self._flock(
+                self._open(self._lock_file_path), False, "shared deployment lock"
+            )
+            self.held = True
+        except BaseException:
+            self._release()
+            raise
+
+    @contextlib.contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """
+        Serialise changes to deployment-wide state with the other holders
+        of the shared deployment lock, for the duration of the block.  This
+        takes a separate, short-lived lock, so the holders of the shared
+        deployment lock keep running meanwhile.  It is a no-op if the whole
+        deployment is already locked.
+        """
+        if not self.resources:
+            yield
+            return
+        with open(self._lock_file_path + ".wide", "w") as lock_file:
+            fcntl.fcntl(lock_file, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            self._flock(lock_file, True, "deployment-wide lock")
+            yield
+
+    def _release(self) -> None:
+        self.held = False
+        for lock_file in reversed(self._lock_files):
+            lock_file.close()
+        self._lock_files = []
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self._release()
+
+
 class Deployment:
     """NixOps top-level deployment manager."""
 
@@ -74,6 +219,12 @@ class Deployment:
     args: Dict[str, str] = nixops.util.attr_property("args", {}, "json")
     description = nixops.util.attr_property("description", default_description)
     configs_path = nixops.util.attr_property("configsPath", None)
+    # The configurations last deployed with ‘--build-on-target’.  They
+    # were never built locally, so unlike ‘configs_path’ this is not a
+    # valid store path here; it only tells which machines are outdated.
+    target_configs_path: Optional[str] = nixops.util.attr_property(
+        "targetConfigsPath", None
+    )
     rollback_enabled: bool = nixops.util.attr_property("rollbackEnabled", False)
 
     # internal variable to mark if network attribute of network has been evaluated (separately)
@@ -103,10 +254,11 @@ class Deployment:
         self.logger = nixops.logger.Logger(log_file)
 
         self._lock_file_path: Optional[str] = None
+        self._lock: Optional[DeploymentLock] = None
 
         self.expr_path = nixops.evaluation.get_expr_path()
 
-        self.resources: Dict[str, nixops.resources.GenericResourceState] = {}
+        self.resources = ResourceRegistry()
         with self._db:
             c = self._db.cursor()
             c.execute(
@@ -120,6 +272,37 @@ class Deployment:
 
         self.definitions: Optional[Definitions] = None
 
+        self._state_snapshot: Optional[nixops.state.DeploymentSnapshot] = None
+
+        # What copying the closures would transfer, per machine; set by a
+        # dry run.
+        self.transfer_estimates: Dict[str, nixops.transfer.Estimate] = {}
+
+        # The machines whose configuration failed to build, if they were
+        # built separately.
+        self.failed_builds: List[str] = []
+
+        # The report of the last build (see nixops.nixlog.Activities).
+        self.build_report: Optional[Dict[str, Any]] = None
+        self._progress_lock = threading.Lock()
+        self._progress_logged = 0.0
+
+    @contextlib.contextmanager
+    def state_snapshot(self) -> Iterator[nixops.state.DeploymentSnapshot]:
+        """
+        Read the attributes of all resources in one go, and let the diff
+        engine plan resources using this copy rather than the state
+        file.  The state must not be modified meanwhile.
+        """
+        self._state_snapshot = nixops.state.DeploymentSnapshot(self)
+        try:
+            yield self._state_snapshot
+        finally:
+            self._state_snapshot = None
+
+    def current_state_snapshot(self) -> Optional[nixops.state.DeploymentSnapshot]:
+        return self._state_snapshot
+
     @property
     def tempdir(self) -> nixops.util.SelfDeletingDir:
         if not self._tempdir:
@@ -130,7 +313,7 @@ class Deployment:
 
     @property
     def machines(self) -> Dict[str, nixops.backends.GenericMachineState]:
-        return _filter_machines(self.resources)
+        return self.resources.machines()  # type: ignore
 
     @property
     def active(self) -> None:
@@ -147,16 +330,16 @@ class Deployment:
     ) -> Dict[
         str, nixops.backends.GenericMachineState
     ]:  # FIXME: rename to "active_machines"
-        return _filter_machines(self.active_resources)
+        return dict(self.resources.active_machines())  # type: ignore
 
     @property
     def active_resources(self) -> Dict[str, nixops.resources.GenericResourceState]:
-        return {n: r for n, r in self.resources.items() if not r.obsolete}
+        return dict(self.resources.active())
 
     def get_generic_resource(
         self, name: str, type_name: str
     ) -> nixops.resources.GenericResourceState:
-        res = self.active_resources.get(name, None)
+        res = self.resources.active().get(name, None)
         if not res:
             raise Exception("resource ‘{0}’ does not exist".format(name))
         if res.get_type() != type_name:
@@ -200,7 +383,7 @@ class Deployment:
         return m
 
     def get_generic_machine(self, name: str) -> nixops.resources.GenericResourceState:
-        res = self.active_resources.get(name, None)
+        res = self.resources.active().get(name, None)
         if not res:
             raise Exception("machine ‘{0}’ does not exist".format(name))
         if not is_machine(res):
@@ -297,6 +480,25 @@ class Deployment:
         self.resources[name] = r
         return r
 
+    def _load_or_create_resource(
+        self, name: str, type: str
+    ) -> nixops.resources.GenericResourceState:
+        """
+        Create resource ‘name’, unless another process created it since
+        the state of this deployment was loaded.
+        """
+        c = self._db.cursor()
+        c.execute(
+            "select id, type from Resources where deployment = ? and name = ?",
+            (self.uuid, name),
+        )
+        row = c.fetchone()
+        if row is None:
+            return self._create_resource(name, type)
+        r = _create_state(self, row[1], name, row[0])
+        self.resources[name] = r
+        return r
+
     def export(self) -> Dict[str, Dict[str, Dict[str, str]]]:
         with self._db:
             c = self._db.cursor()
@@ -334,44 +536,55 @@ class Deployment:
             new.configs_path = None
             return new
 
-    def _get_deployment_lock(
-        self,
-    ) -> Any:  # FIXME: DeploymentLock is defined inside the function
+    def _get_deployment_lock(self, resources: Sequence[str] = ()) -> DeploymentLock:
+        """
+        Return a context manager locking this deployment.  If
+        ‘resources’ is empty, the whole deployment is locked
+        exclusively.  Otherwise, only the named resources are locked
+        exclusively, so that operations on disjoint sets of resources
+        (e.g. ‘deploy --include’) can run concurrently.
+        """
         if self._lock_file_path is None:
             lock_dir = os.environ.get("HOME", "") + "/.nixops/locks"
             if not os.path.exists(lock_dir):
                 os.makedirs(lock_dir, 0o700)
             self._lock_file_path = lock_dir + "/" + self.uuid
 
-        class DeploymentLock(object):
-            def __init__(self, depl: Deployment):
-                assert depl._lock_file_path is not None
-                self._lock_file_path: str = depl._lock_file_path
-                self._logger: nixops.logger.Logger = depl.logger
-                self._lock_file: Optional[TextIO] = None
+        self._lock = DeploymentLock(self._lock_file_path, self.logger, resources)
+        return self._lock
 
-            def __enter__(self) -> None:
-                self._lock_file = open(self._lock_file_path, "w")
-                fcntl.fcntl(self._lock_file, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
-                try:
-                    fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                except IOError:
-                    self._logger.log("waiting for exclusive deployment lock...")
-                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
-
-            def __exit__(self, exception_type, exception_value, exception_traceback):
-                if self._lock_file is not None:
-                    self._lock_file.close()
+    def _locked(self, name: str) -> bool:
+        """
+        Whether this process may change the state of resource ‘name’,
+        i.e. it is not limited to a lock on other resources.
+        """
+        lock = self._lock
+        return (
+            lock is None
+            or not lock.held
+            or not lock.resources
+            or (name in lock.resources)
+        )
 
-        return DeploymentLock(self)
+    @contextlib.contextmanager
+    def _deployment_wide(self) -> Iterator[None]:
+        """
+        Serialise changes to deployment-wide state for the duration of
+        the block, if only some resources are locked.
+        """
+        if self._lock is None or not self._lock.held:
+            yield
+        else:
+            with self._lock.exclusive():
+                yield
 
     def delete_resource(self, m: nixops.resources.GenericResourceState) -> None:
-        del self.resources[m.name]
         with self._db:
             self._db.execute(
                 "delete from Resources where deployment = ? and id = ?",
                 (self.uuid, m.id),
             )
+            self._db.after_commit(lambda: self.resources.pop(m.name, None))
 
     def delete(self, force: bool = False) -> None:
         """Delete this deployment from the state file."""
@@ -592,6 +805,23 @@ class Deployment:
         for m in active_machines.values():
             do_machine(m)
 
+        # SSH public host keys of all machines in network.
+        known_hosts: NixosConfigurationType = []
+        for m in active_machines.values():
+            if hasattr(m, "public_host_key") and m.public_host_key:
+                # Using references to files in same tempdir for now, until NixOS has support
+                # for adding the keys directly as string. This way at least it is compatible
+                # with older versions of NixOS as well.
+                # TODO: after reasonable amount of time replace with string option
+                known_hosts.append(
+                    {
+                        ("services", "openssh", "knownHosts", m.name): {
+                            "hostNames": [m.name],
+                            "publicKey": m.public_host_key,
+                        }
+                    }
+                )
+
         def emit_resource(r: nixops.resources.GenericResourceState) -> Any:
             config: NixosConfigurationType = []
             config.extend(attrs_per_resource[r.name])
@@ -631,20 +861,7 @@ class Deployment:
                 )
 
                 # Add SSH public host keys for all machines in network.
-                for m2 in active_machines.values():
-                    if hasattr(m2, "public_host_key") and m2.public_host_key:
-                        # Using references to files in same tempdir for now, until NixOS has support
-                        # for adding the keys directly as string. This way at least it is compatible
-                        # with older versions of NixOS as well.
-                        # TODO: after reasonable amount of time replace with string option
-                        config.append(
-                            {
-                                ("services", "openssh", "knownHosts", m2.name): {
-                                    "hostNames": [m2.name],
-                                    "publicKey": m2.public_host_key,
-                                }
-                            }
-                        )
+                config.extend(known_hosts)
 
             merged = reduce(nixmerge, config) if len(config) > 0 else {}
             physical = r.get_physical_spec()
@@ -691,8 +908,19 @@ class Deployment:
         exclude: List[str],
         dry_run: bool = False,
         repair: bool = False,
+        distributed_build: bool = False,
+        per_machine: bool = False,
+        max_concurrent_build: int = 4,
+        on_built: Optional[
+            Callable[[nixops.backends.GenericMachineState], None]
+        ] = None,
     ) -> str:
-        """Build the machine configurations in the Nix store."""
+        """
+        Build the machine configurations in the Nix store.  With
+        ‘distributed_build’, use the machines as remote builders.  With
+        ‘per_machine’, build each configuration separately (see
+        ‘_build_per_machine’).
+        """
 
         self.logger.log("building all machine configurations...")
 
@@ -724,36 +952,30 @@ class Deployment:
         # If we're not running on Linux, then perform the build on the
         # target machines.  FIXME: Also enable this if we're on 32-bit
         # and want to deploy to 64-bit.
-        if platform.system() != "Linux" and os.environ.get("NIX_REMOTE") != "daemon":
-            if os.environ.get("NIX_REMOTE_SYSTEMS") is None:
-                remote_machines = []
-                for m in sorted(selected, key=lambda m: m.get_index()):
-                    key_file: Optional[str] = m.get_ssh_private_key_file()
-                    if not key_file:
-                        raise Exception(
-                            "do not know private SSH key for machine ‘{0}’".format(
-                                m.name
-                            )
-                        )
-                    # FIXME: Figure out the correct machine type of ‘m’ (it might not be x86_64-linux).
-                    remote_machines.append(
-                        "root@{0} {1} {2} 2 1\n".format(
-                            m.get_ssh_name(), "i686-linux,x86_64-linux", key_file
-                        )
-                    )
-                    # Use only a single machine for now (issue #103).
-                    break
-                remote_machines_file = "{0}/nix.machines".format(self.tempdir)
-                with open(remote_machines_file, "w") as f:
-                    f.write("".join(remote_machines))
+        build_remote = (
+            platform.system() != "Linux" and os.environ.get("NIX_REMOTE") != "daemon"
+        )
+        builders: List[nixops.builders.Builder] = []
+        builders_flags: List[str] = []
+        if distributed_build or (
+            build_remote and os.environ.get("NIX_REMOTE_SYSTEMS") is None
+        ):
+            builders = self._get_builders(selected, required=not distributed_build)
+            remote_machines_file = "{0}/nix.machines".format(self.tempdir)
+            with open(remote_machines_file, "w") as f:
+                f.write("".join(b.line() + "\n" for b in builders))
+            if build_remote:
                 os.environ["NIX_REMOTE_SYSTEMS"] = remote_machines_file
             else:
-                self.logger.log(
-                    "using predefined remote systems file: {0}".format(
-                        os.environ["NIX_REMOTE_SYSTEMS"]
-                    )
+                builders_flags = ["--option", "builders", "@" + remote_machines_file]
+        elif build_remote:
+            self.logger.log(
+                "using predefined remote systems file: {0}".format(
+                    os.environ["NIX_REMOTE_SYSTEMS"]
                 )
+            )
 
+        if build_remote:
             # FIXME: Use ‘--option use-build-hook true’ instead of setting
             # $NIX_BUILD_HOOK, once Nix supports that.
             os.environ["NIX_BUILD_HOOK"] = (
@@ -766,60 +988,440 @@ class Deployment:
                 os.makedirs(load_dir, 0o700)
             os.environ["NIX_CURRENT_LOAD"] = load_dir
 
+        log = nixops.builders.BuildLog() if builders else None
+        nix_flags: List[str] = (
+            self.extra_nix_flags
+            + nixops.nixlog.LOG_FLAGS
+            + builders_flags
+            + (["--dry-run"] if dry_run else [])
+            + (["--repair"] if repair else [])
+        )
+        self.failed_builds = []
+        activities = nixops.nixlog.Activities()
         try:
-            drv: str = self.eval(
-                include_physical=True,
-                nix_args={"names": names},
-                attr="machines.drvPath",
-            )
-
-            argv: List[str] = (
-                ["nix-store", "-r"]
-                + self.extra_nix_flags
-                + (["--dry-run"] if dry_run else [])
-                + (["--repair"] if repair else [])
-                + [drv]
-            )
-
-            configs_path = subprocess.check_output(
-                argv,
-                text=True,
-                stderr=self.logger.log_file,
-            ).rstrip()
+            if per_machine and not dry_run:
+                configs_path = self._build_per_machine(
+                    selected, nix_flags, log, activities, max_concurrent_build, on_built
+                )
+            else:
+                drv: str = self.eval(
+                    include_physical=True,
+                    nix_args={"names": names},
+                    attr="machines.drvPath",
+                )
+                configs_path = self._realise(
+                    ["nix-store", "-r"] + nix_flags + [drv], log, activities
+                )
 
         except subprocess.CalledProcessError:
             raise Exception("unable to build all machine configurations")
 
+        finally:
+            if not dry_run:
+                self._write_build_report(activities)
+
+        if log is not None:
+            for (name, count, share) in log.utilization(builders):
+                self.logger.log(
+                    "{0}: built {1} derivations ({2:.0%})".format(name, count, share)
+                )
+
         if self.rollback_enabled and not dry_run:
-            profile = self.create_profile()
-            if subprocess.call(["nix-env", "-p", profile, "--set", configs_path]) != 0:
-                raise Exception("cannot update profile ‘{0}’".format(profile))
+            if self.failed_builds:
+                self.logger.warn(
+                    "not recording a rollback generation, since some"
+                    " configurations failed to build"
+                )
+            else:
+                profile = self.create_profile()
+                with self._deployment_wide():
+                    if (
+                        subprocess.call(
+                            ["nix-env", "-p", profile, "--set", configs_path]
+                        )
+                        != 0
+                    ):
+                        raise Exception("cannot update profile ‘{0}’".format(profile))
 
         return configs_path
 
+    def _build_per_machine(
+        self,
+        machines: List[nixops.backends.GenericMachineState],
+        nix_flags: List[str],
+        log: Optional[nixops.builders.BuildLog],
+        activities: nixops.nixlog.Activities,
+        max_concurrent_build: int,
+        on_built: Optional[Callable[[nixops.backends.GenericMachineState], None]],
+    ) -> str:
+        """
+        Realise the configuration of each machine separately, at most
+        ‘max_concurrent_build’ at a time, calling ‘on_built’ for each
+        machine as soon as its configuration is built.  Machines whose
+        configuration fails to build are recorded in ‘failed_builds’.
+        Return the aggregate of the configurations that were built.
+        """
+        drvs: Dict[str, str] = self.eval(
+            include_physical=True,
+            nix_args={"names": [m.name for m in machines]},
+            attr="toplevelDrvs",
+        )
+        slots = threading.BoundedSemaphore(
+            len(machines) if max_concurrent_build == -1 else max_concurrent_build
+        )
+        lock = threading.Lock()
+
+        def worker(m: nixops.backends.GenericMachineState) -> None:
+            with slots:
+                m.logger.log("building configuration...")
+                try:
+                    m.new_toplevel = self._realise(
+                        ["nix-store", "-r"] + nix_flags + [drvs[m.name]],
+                        log,
+                        activities,
+                    )
+                except subprocess.CalledProcessError:
+                    m.logger.error("unable to build the configuration")
+                    with lock:
+                        self.failed_builds.append(m.name)
+                    return
+            if on_built is not None:
+                on_built(m)
+
+        nixops.parallel.run_tasks(
+            nr_workers=-1, tasks=iter(machines), worker_fun=worker
+        )
+
+        built = [m.name for m in machines if m.name not in self.failed_builds]
+        if not built:
+            raise Exception("unable to build any machine configuration")
+        drv: str = self.eval(
+            include_physical=True,
+            nix_args={"names": built},
+            attr="machines.drvPath",
+        )
+        return self._realise(["nix-store", "-r"] + nix_flags + [drv], None, activities)
+
+    def _realise(
+        self,
+        argv: List[str],
+        log: Optional[nixops.builders.BuildLog],
+        activities: nixops.nixlog.Activities,
+    ) -> str:
+        """
+        Run ‘argv’, a ‘nix-store -r’ command with Nix's structured log
+        enabled, and return its output.  Show what Nix prints, feeding it
+        to ‘log’ if given, and track its progress in ‘activities’.
+        """
+        process = subprocess.Popen(
+            argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+
+        def read_stderr() -> None:
+            assert process.stderr is not None
+            for line in process.stderr:
+                text = activities.feed(line, stream=process.pid)
+                if text is None:
+                    continue
+                self.logger.log_file.write(text + "\n")
+                if log is not None:
+                    log.feed(text)
+                self._log_build_progress(activities)
+
+        thread = threading.Thread(target=read_stderr, daemon=True)
+        thread.start()
+        assert process.stdout is not None
+        out = process.stdout.read()
+        process.wait()
+        thread.join()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, argv)
+        return out.rstrip()
+
+    def _log_build_progress(self, activities: nixops.nixlog.Activities) -> None:
+        """Log a summary of the build progress, every few seconds."""
+        now = time.monotonic()
+        with self._progress_lock:
+            if now - self._progress_logged < BUILD_PROGRESS_INTERVAL:
+                return
+            self._progress_logged = now
+        self.logger.log("build progress: {0}".format(activities.status()))
+
+    def _write_build_report(self, activities: nixops.nixlog.Activities) -> None:
+        """
+        Write the report of the last build to NixOps' cache directory,
+        keeping the last few reports of each deployment.  This is called
+        while handling build errors, so it must not raise.
+        """
+        self.build_report = activities.report()
+        cache_dir = nixops.cache.cache_dir("build-reports")
+        if cache_dir is None:
+            self.logger.log(activities.status())
+            return
+        report_dir = os.path.join(cache_dir, self.uuid)
+        path = os.path.join(
+            report_dir, activities.started.strftime("%Y%m%dT%H%M%S.%fZ") + ".json"
+        )
+        if not nixops.cache.write_cache_file(
+            path, json.dumps(dict(self.build_report, deployment=self.uuid), indent=2)
+        ):
+            self.logger.log(activities.status())
+            self.logger.warn("cannot write build report to ‘{0}’".format(path))
+            return
+        try:
+            for old in sorted(os.listdir(report_dir))[:-BUILD_REPORTS_KEPT]:
+                os.unlink(os.path.join(report_dir, old))
+        except OSError:
+            pass
+        self.logger.log("{0}; report written to {1}".format(activities.status(), path))
+
+    def _check_failed_builds(self) -> None:
+        if self.failed_builds:
+            raise Exception(
+                "unable to build the configuration of {0}".format(
+                    ", ".join("‘{0}’".format(n) for n in self.failed_builds)
+                )
+            )
+
+    def _target_gc_root(self) -> str:
+        """Return the GC root that keeps a configuration built on its
+        machine alive until it has been activated."""
+        return "/nix/var/nix/gcroots/nixops-{0}".format(self.uuid)
+
+    def build_on_targets(
+        self,
+        include: List[str],
+        exclude: List[str],
+        max_concurrent_build: int,
+        dry_run: bool = False,
+        repair: bool = False,
+    ) -> str:
+        """
+        Build the machine configurations on the machines themselves: copy
+        the derivation of each configuration to its machine and realise it
+        there, so that the machine substitutes or builds it.  Return the
+        path that ‘build_configs’ would have returned, which is not built.
+        """
+        selected = [
+            m for m in self.active_machines.values() if should_do(m, include, exclude)
+        ]
+        names = [m.name for m in selected]
+        drvs: Dict[str, str] = self.eval(
+            include_physical=True,
+            nix_args={"names": names},
+            attr="toplevelDrvs",
+        )
+        configs_path: str = self.eval(
+            include_physical=True,
+            nix_args={"names": names},
+            attr="machines.outPath",
+        )
+
+        if dry_run:
+            for m in selected:
+                m.logger.log("would build ‘{0}’".format(drvs[m.name]))
+            return configs_path
+
+        def worker(m: nixops.backends.GenericMachineState) -> None:
+            drv = drvs[m.name]
+            with m.pinned_ssh_flags():
+                m.logger.log("copying derivation...")
+                m.copy_closure_to(drv, use_substitutes=False)
+                m.logger.log("building configuration...")
+                # Root the result until it is activated, in case the
+                # machine collects garbage in the meantime.
+                root = self._target_gc_root()
+                out = m.run_command(
+                    "nix-store --realise {0}--add-root {1} {2} > /dev/null"
+                    " && readlink {1}".format("--repair " if repair else "", root, drv),
+                    capture_stdout=True,
+                )
+            m.new_toplevel = str(out).split()[-1]
+
+        nixops.parallel.run_tasks(
+            nr_workers=max_concurrent_build,
+            tasks=iter(selected),
+            worker_fun=worker,
+        )
+
+        if self.rollback_enabled:
+            self.logger.warn(
+                "not recording a rollback generation, since the configurations"
+                " were built on the machines"
+            )
+        return configs_path
+
+    def _get_builders(
+        self,
+        machines: List[nixops.backends.GenericMachineState],
+        required: bool,
+    ) -> List[nixops.builders.Builder]:
+        """
+        Describe ‘machines’ as remote builders, in addition to those in
+        $NIX_REMOTE_SYSTEMS.  Machines that cannot be used are skipped
+        with a warning; if builders are ‘required’ because the local
+        machine cannot build the configurations, there must be one left.
+        """
+        builders: Dict[str, nixops.builders.Builder] = {}
+
+        def probe(m: nixops.backends.GenericMachineState) -> None:
+            try:
+                if m.ssh_port not in (None, 22):
+                    raise Exception(
+                        "Nix cannot connect to SSH port {0}".format(m.ssh_port)
+                    )
+                builders[m.name] = nixops.builders.probe(m)
+            except Exception as e:
+                m.logger.warn("not using this machine as a builder: {0}".format(e))
+
+        nixops.parallel.run_tasks(nr_workers=-1, tasks=iter(machines), worker_fun=probe)
+
+        result = [builders[m.name] for m in machines if m.name in builders]
+        configured = os.environ.get("NIX_REMOTE_SYSTEMS")
+        if configured:
+            with open(configured) as f:
+                result += nixops.builders.parse_machines(f.read())
+        if required and not result:
+            raise Exception("none of the machines can be used as a builder")
+        for b in result:
+            self.logger.log(
+                "using builder ‘{0}’ for {1} ({2} jobs)".format(
+                    b.name, ", ".join(b.systems), b.max_jobs
+                )
+            )
+        return result
+
+    def estimate_transfer(
+        self, include: List[str], exclude: List[str]
+    ) -> Dict[str, nixops.transfer.Estimate]:
+        """
+        Estimate what copying the closure of each machine configuration to
+        its machine would transfer, without building anything, and warn
+        about machines that do not have enough free space.
+        """
+        selected = [
+            m for m in self.active_machines.values() if should_do(m, include, exclude)
+        ]
+        toplevels: Dict[str, str] = self.eval(
+            include_physical=True,
+            nix_args={"names": [m.name for m in selected]},
+            attr="toplevels",
+        )
+        # Configurations that are not built are estimated from what
+        # building them would fetch.
+        unbuilt = nixops.transfer.query_local_invalid(list(set(toplevels.values())))
+        drvs: Dict[str, str] = {}
+        if unbuilt:
+            names = [n for n, path in toplevels.items() if path in unbuilt]
+            drv_paths: Dict[str, str] = self.eval(
+                include_physical=True, nix_args={"names": names}, attr="toplevelDrvs"
+            )
+            drvs = {toplevels[n]: drv for n, drv in drv_paths.items()}
+        estimates = nixops.transfer.estimate(
+            {m: toplevels.get(m.name) for m in selected}, drvs
+        )
+        for m in selected:
+            e = estimates[m.name]
+            if e.size is None:
+                m.logger.log("cannot estimate the transfer size")
+            elif e.builds:
+                m.logger.log(
+                    "configuration is not built; the estimate leaves out the"
+                    " outputs of the {0} derivations to build".format(e.builds)
+                )
+            if e.insufficient_space:
+                assert e.size is not None and e.free is not None
+                m.logger.warn(
+                    "copying needs {0:.1f} MiB, but only {1:.1f} MiB is free"
+                    " on /nix/store".format(
+                        e.size / nixops.transfer.MiB, e.free / nixops.transfer.MiB
+                    )
+                )
+        return estimates
+
     def copy_closures(
         self,
         configs_path: str,
         include: List[str],
         exclude: List[str],
         max_concurrent_copy: int,
+        copy_method: str = "direct",
+        tree_fanout: int = 3,
+        probe_closures: bool = False,
+        adaptive_copy: bool = False,
+        max_copy_bandwidth: Optional[float] = None,
     ) -> None:
-        """Copy the closure of each machine configuration to the corresponding machine."""
+        """
+        Copy the closure of each machine configuration to the corresponding
+        machine.  With ‘adaptive_copy’, copy to at most
+        ‘max_concurrent_copy’ machines at a time as the available bandwidth
+        allows, staying under ‘max_copy_bandwidth’ MiB/s.
+        """
 
-        def worker(m: nixops.backends.GenericMachineState) -> None:
-            if not should_do(m, include, exclude):
-                return
-            m.logger.log("copying closure...")
+        machines = [
+            m for m in self.active_machines.values() if should_do(m, include, exclude)
+        ]
+        for m in machines:
             m.new_toplevel = os.path.realpath(configs_path + "/" + m.name)
             if not os.path.exists(m.new_toplevel):
                 raise Exception("can't find closure of machine ‘{0}’".format(m.name))
-            m.copy_closure_to(m.new_toplevel)
 
-        nixops.parallel.run_tasks(
-            nr_workers=max_concurrent_copy,
-            tasks=iter(self.active_machines.values()),
-            worker_fun=worker,
-        )
+        delta_sizes: Dict[str, int] = {}
+        machines = self._skip_present_closures(machines, probe_closures, delta_sizes)
+
+        if copy_method == "fanout":
+            self._copy_closures_fanout(machines, max_concurrent_copy)
+        elif copy_method == "tree":
+            self._copy_closures_tree(machines, max_concurrent_copy, tree_fanout)
+        elif not adaptive_copy and (
+            max_concurrent_copy == -1 or len(machines) <= max_concurrent_copy
+        ):
+            # All copies run at once, so there is nothing to schedule.
+            def copy_direct(m: nixops.backends.GenericMachineState) -> None:
+                assert m.new_toplevel is not None
+                m.logger.log("copying closure...")
+                with m.pinned_ssh_flags():
+                    m.copy_closure_to(m.new_toplevel)
+
+            nixops.parallel.run_tasks(
+                nr_workers=max_concurrent_copy, tasks=machines, worker_fun=copy_direct
+            )
+        else:
+            sizes = self._copy_sizes(machines, delta_sizes)
+            history = nixops.scheduling.ThroughputHistory.load()
+
+            controller: Optional[nixops.bandwidth.Controller] = None
+            if adaptive_copy:
+                controller = nixops.bandwidth.Controller(
+                    len(machines) if max_concurrent_copy == -1 else max_concurrent_copy,
+                    bandwidth_cap=max_copy_bandwidth * nixops.bandwidth.MiB
+                    if max_copy_bandwidth
+                    else None,
+                )
+
+            def worker(m: nixops.backends.GenericMachineState) -> None:
+                self._copy_closure(m, sizes[m.name], history, controller)
+
+            try:
+                nixops.scheduling.run_tasks(
+                    nr_workers=max_concurrent_copy,
+                    tasks=machines,
+                    worker_fun=worker,
+                    cost=lambda m: history.estimate(
+                        self._history_host(m), sizes[m.name]
+                    ),
+                )
+            finally:
+                history.save()
+                if controller is not None:
+                    self.logger.log(
+                        "copy concurrency went {0}".format(
+                            " → ".join(str(n) for n in controller.limits)
+                        )
+                    )
+        self._log_closures_copied()
+
+    def _log_closures_copied(self) -> None:
         self.logger.log(
             ansi_success(
                 "{0}> closures copied successfully".format(self.name or "unnamed"),
@@ -827,6 +1429,229 @@ class Deployment:
             )
         )
 
+    def _history_host(self, m: nixops.backends.GenericMachineState) -> str:
+        """Return the key of ‘m’ in the throughput history."""
+        return "{0}/{1}".format(self.uuid, m.name)
+
+    def _copy_closure(
+        self,
+        m: nixops.backends.GenericMachineState,
+        size: int,
+        history: nixops.scheduling.ThroughputHistory,
+        controller: Optional[nixops.bandwidth.Controller] = None,
+    ) -> None:
+        """
+        Copy the closure of the new configuration of ‘m’, which is
+        expected to transfer ‘size’ bytes, and record the throughput in
+        ‘history’.  With a ‘controller’, only copy once it admits
+        another copy, and tune the copy to the link.
+        """
+        assert m.new_toplevel is not None
+        host = self._history_host(m)
+        m.logger.log("copying closure...")
+        start = time.monotonic()
+        with m.pinned_ssh_flags():
+            if controller is None:
+                m.copy_closure_to(m.new_toplevel)
+            else:
+                (compress, use_substitutes) = nixops.bandwidth.link_options(
+                    history.get(host), m.has_fast_connection
+                )
+                ticket = controller.acquire()
+                address = m._tcp_address()
+                sampler = nixops.bandwidth.RTTSampler(address) if address else None
+                ok = False
+                try:
+                    with sampler or contextlib.nullcontext():
+                        m.copy_closure_to(
+                            m.new_toplevel,
+                            compress=compress,
+                            use_substitutes=use_substitutes,
+                        )
+                    ok = True
+                finally:
+                    controller.release(
+                        ticket,
+                        size,
+                        ok,
+                        sampler.rtt if sampler else None,
+                        sampler.baseline if sampler else None,
+                    )
+        history.record(host, size, time.monotonic() - start)
+
+    def _skip_present_closures(
+        self,
+        machines: List[nixops.backends.GenericMachineState],
+        probe_closures: bool,
+        delta_sizes: Optional[Dict[str, int]] = None,
+        present: Optional[PresentClosures] = None,
+    ) -> List[nixops.backends.GenericMachineState]:
+        """
+        Return the machines that do not have their new configuration yet,
+        and report what not copying to the others saves, or, if ‘present’
+        is given, add it there to be reported by
+        ‘_report_present_closures’.  Only machines that were last deployed
+        with their new configuration are asked, unless ‘probe_closures’ is
+        set: then every machine is asked which paths of the closure it
+        lacks, what the remaining machines already have is reported
+        separately, and the size of what they are missing is stored in
+        ‘delta_sizes’.
+        """
+        targets: Dict[nixops.backends.GenericMachineState, str] = {}
+        for m in machines:
+            assert m.new_toplevel is not None
+            if probe_closures or m.cur_toplevel == m.new_toplevel:
+                targets[m] = m.new_toplevel
+        if not targets:
+            if present is not None:
+                present.add(len(machines), 0, [], [])
+            return machines
+        presence = nixops.transfer.probe_presence(targets, closures=probe_closures)
+
+        remaining: List[nixops.backends.GenericMachineState] = []
+        skipped: List[str] = []
+        partial: List[str] = []
+        requisites: Dict[str, List[str]] = {}
+        for m in machines:
+            p = presence.get(m.name)
+            path = targets.get(m)
+            if p is None or path is None or not p.present:
+                remaining.append(m)
+            else:
+                m.logger.log("configuration already present, not copying")
+            if p is None or path is None or (p.missing is None and not p.present):
+                continue
+            if path not in requisites:
+                requisites[path] = nixops.transfer.query_requisites([path])
+            if p.present:
+                skipped += requisites[path]
+                continue
+            missing = set(p.missing or [])
+            partial += [q for q in requisites[path] if q not in missing]
+            if p.missing:
+                sizes = nixops.transfer.path_sizes(p.missing)
+                if delta_sizes is not None:
+                    delta_sizes[m.name] = sum(sizes.values())
+                m.logger.log(
+                    "{0} paths ({1:.1f} MiB) to copy".format(
+                        len(p.missing), sum(sizes.values()) / nixops.transfer.MiB
+                    )
+                )
+
+        if present is not None:
+            present.add(len(machines), len(machines) - len(remaining), skipped, partial)
+        else:
+            summary = PresentClosures()
+            summary.add(len(machines), len(machines) - len(remaining), skipped, partial)
+            self._report_present_closures(summary)
+        return remaining
+
+    def _report_present_closures(self, present: PresentClosures) -> None:
+        """Report what not copying the paths in ‘present’ saved."""
+        if present.skipped or present.partial:
+            sizes = nixops.transfer.path_sizes(
+                sorted(set(present.skipped + present.partial))
+            )
+        if present.skipped:
+            self.logger.log(
+                "{0} of {1} machines already have their configuration; not copying"
+                " {2:.1f} MiB to them".format(
+                    present.present_machines,
+                    present.machines,
+                    sum(sizes[q] for q in present.skipped) / nixops.transfer.MiB,
+                )
+            )
+        if present.partial:
+            self.logger.log(
+                "the other machines already have {0} paths ({1:.1f} MiB) of their"
+                " configuration".format(
+                    len(present.partial),
+                    sum(sizes[q] for q in present.partial) / nixops.transfer.MiB,
+                )
+            )
+
+    def _copy_sizes(
+        self,
+        machines: List[nixops.backends.GenericMachineState],
+        delta_sizes: Dict[str, int],
+    ) -> Dict[str, int]:
+        """
+        Return the number of bytes expected to be copied to each machine:
+        what it is missing if known, and otherwise the size of the
+        closure of its configuration.
+        """
+        sizes: Dict[str, int] = {}
+        closure_sizes: Dict[str, int] = {}
+        for m in machines:
+            if m.name in delta_sizes:
+                sizes[m.name] = delta_sizes[m.name]
+                continue
+            assert m.new_toplevel is not None
+            if m.new_toplevel not in closure_sizes:
+                try:
+                    closure_sizes[m.new_toplevel] = nixops.transfer.closure_size(
+                        m.new_toplevel
+                    )
+                except (OSError, subprocess.CalledProcessError) as e:
+                    m.logger.warn("cannot determine closure size: {0}".format(e))
+                    closure_sizes[m.new_toplevel] = 0
+            sizes[m.name] = closure_sizes[m.new_toplevel]
+        return sizes
+
+    def _copy_closures_fanout(
+        self,
+        machines: List[nixops.backends.GenericMachineState],
+        max_concurrent_copy: int,
+    ) -> None:
+        """
+        Copy closures with nixops.transfer, exporting each store path once
+        for all machines.
+        """
+        targets: Dict[nixops.backends.GenericMachineState, str] = {}
+        for m in machines:
+            assert m.new_toplevel is not None
+            targets[m] = m.new_toplevel
+        self.logger.log("exporting closures for {0} machines...".format(len(targets)))
+        # Compressing only pays off if some connection is slow.
+        compress = not all(m.has_fast_connection for m in machines)
+        with contextlib.ExitStack() as stack:
+            for m in machines:
+                stack.enter_context(m.pinned_ssh_flags())
+            sent = nixops.transfer.fanout_copy(
+                targets,
+                spill_dir=self.tempdir,
+                nr_workers=max_concurrent_copy,
+                compress=compress,
+            )
+        for m in machines:
+            m.logger.log("sent {0:.1f} MiB".format(sent.get(m.name, 0) / (1024 * 1024)))
+
+    def _copy_closures_tree(
+        self,
+        machines: List[nixops.backends.GenericMachineState],
+        max_concurrent_copy: int,
+        tree_fanout: int,
+    ) -> None:
+        """
+        Copy closures with nixops.transfer, letting machines that are
+        close to each other copy them between themselves.
+        """
+        targets: Dict[nixops.backends.GenericMachineState, str] = {}
+        for m in machines:
+            assert m.new_toplevel is not None
+            targets[m] = m.new_toplevel
+        hops = nixops.transfer.tree_copy(
+            targets, nr_workers=max_concurrent_copy, fanout=tree_fanout
+        )
+        direct = sum(1 for h in hops if h.source is None)
+        fell_back = sum(1 for h in hops if h.fell_back)
+        self.logger.log(
+            "{0} closures copied from this machine ({1} after a failed copy"
+            " between machines), {2} between machines".format(
+                direct, fell_back, len(hops) - direct
+            )
+        )
+
     def activate_configs(  # noqa: C901
         self,
         configs_path: str,
@@ -841,6 +1666,7 @@ class Deployment:
         test: bool,
         boot: bool,
         max_concurrent_activate: int,
+        remove_gc_root: bool = False,
     ) -> None:
         """Activate the new configuration on a machine."""
 
@@ -876,9 +1702,16 @@ class Deployment:
                     elif ret != 0:
                         raise Exception("unable to set new system profile")
 
+            def remove_root():
+                # The configuration built by ‘build_on_targets’ is now
+                # rooted by the system profile or the running system.
+                if remove_gc_root:
+                    m.run_command("rm -f {0}".format(self._target_gc_root()))
+
             try:
                 if not test:
                     set_profile()
+                    remove_root()
 
                 m.send_keys()
 
@@ -921,6 +1754,9 @@ class Deployment:
                     # FIXME: should check which systemd services
                     # failed to start after the reboot.
 
+                if test:
+                    remove_root()
+
                 if res == 0:
                     m.success("activation finished successfully")
 
@@ -953,10 +1789,20 @@ class Deployment:
             )
 
     def _get_free_resource_index(self) -> int:
-        index = 0
-        for r in self.resources.values():
-            if r.index is not None and index <= r.index:
-                index = r.index + 1
+        index = self.resources.next_free_index()
+        if self._lock is not None and self._lock.held and self._lock.resources:
+            # Resources locked by other processes may have been given an
+            # index since the state of this deployment was loaded.
+            c = self._db.cursor()
+            c.execute(
+                "select max(cast(a.value as integer)) from ResourceAttrs a"
+                " join Resources r on a.machine = r.id"
+                " where r.deployment = ? and a.name = 'index'",
+                (self.uuid,),
+            )
+            row = c.fetchone()
+            if row is not None and row[0] is not None:
+                index = max(index, int(row[0]) + 1)
         return index
 
     def get_backups(
@@ -1061,7 +1907,7 @@ class Deployment:
         backup_id: Optional[str] = None,
         devices: List[str] = [],
     ) -> None:
-        with self._get_deployment_lock():
+        with self._get_deployment_lock(include):
 
             self.evaluate_active(include, exclude)
 
@@ -1090,11 +1936,12 @@ class Deployment:
     ) -> None:
         self.evaluate()
 
-        # Create state objects for all defined resources.
+        # Create state objects for all defined resources.  If only some
+        # resources are locked, leave the others to whoever locks them.
         with self._db:
             for defn in self._definitions().values():
-                if defn.name not in self.resources:
-                    self._create_resource(defn.name, defn.get_type())
+                if defn.name not in self.resources and self._locked(defn.name):
+                    self._load_or_create_resource(defn.name, defn.get_type())
 
         self.logger.update_log_prefixes()
 
@@ -1104,15 +1951,17 @@ class Deployment:
         # delete obsolete resources from ‘self.resources’ because they
         # contain important state that we don't want to forget about.)
         for m in self.resources.values():
+            if not self._locked(m.name):
+                continue
             if m.name in self._definitions():
-                if m.obsolete:
+                if self.resources.is_obsolete(m.name):
                     self.logger.log(
                         "resource ‘{0}’ is no longer obsolete".format(m.name)
                     )
                     m.obsolete = False
             else:
                 self.logger.log("resource ‘{0}’ is obsolete".format(m.name))
-                if not m.obsolete:
+                if not self.resources.is_obsolete(m.name):
                     m.obsolete = True
                 if not should_do(m, include, exclude):
                     continue
@@ -1122,6 +1971,96 @@ class Deployment:
         if to_destroy:
             self._destroy_resources(include=to_destroy)
 
+    def _plan(
+        self,
+        include: List[str],
+        exclude: List[str],
+        json_output: bool,
+        max_concurrent_plan: int,
+    ) -> None:
+        """
+        Show the changes the diff engine would make to the active
+        resources.  At most ‘max_concurrent_plan’ plans (or
+        ‘MAX_CONCURRENT_PLAN’, if it is -1) are computed at a time, on a
+        snapshot of the state file, so no resource has to
+        wait for a lock held by another.  If
+        ‘json_output’ is set, each change is also printed on stdout as a
+        line of JSON, with the resources in creation order.
+        """
+        to_plan: List[nixops.resources.GenericResourceState] = []
+        for r in self.active_resources.values():
+            if isinstance(r, nixops.resources.DiffEngineResourceState):
+                if should_do(r, include, exclude):
+                    to_plan.append(r)
+            else:
+                r.warn(
+                    "resource type {} doesn't implement a plan operation".format(
+                        r.get_type()
+                    )
+                )
+
+        plans: Dict[str, Optional[nixops.diff.Plan]] = {}
+
+        def worker(r: nixops.resources.DiffEngineResourceState) -> None:
+            plans[r.name] = r.plan(self._definition_for_required(r.name))
+
+        with self.state_snapshot():
+            nixops.parallel.run_tasks(
+                nr_workers=(
+                    MAX_CONCURRENT_PLAN
+                    if max_concurrent_plan == -1
+                    else max_concurrent_plan
+                ),
+                tasks=to_plan,
+                worker_fun=worker,
+            )
+
+        if not json_output:
+            return
+
+        for r in self._creation_order(to_plan):
+            plan = plans.get(r.name)
+            if plan is None:
+                continue
+            for record in plan.records():
+                record = dict(resource=r.name, type=r.get_type(), **record)
+                sys.stdout.write(
+                    json.dumps(record, cls=nixops.util.NixopsEncoder, sort_keys=True)
+                    + "\n"
+                )
+        sys.stdout.flush()
+
+    def _creation_order(
+        self, resources: List[nixops.resources.GenericResourceState]
+    ) -> List[nixops.resources.GenericResourceState]:
+        """
+        Sort ‘resources’ so that every resource comes after the resources
+        it is created after, and otherwise by name.
+        """
+        active = list(self.active_resources.values())
+        deps = {
+            r.name: {
+                d.name
+                for d in r.create_after(
+                    iter(active), self._definition_for_required(r.name)
+                )
+            }
+            for r in resources
+        }
+        order: List[nixops.resources.GenericResourceState] = []
+        done: Set[str] = set()
+        remaining = sorted(resources, key=lambda r: r.name)
+        while remaining:
+            ready = [r for r in remaining if not (deps[r.name] & deps.keys()) - done]
+            if not ready:
+                # A dependency cycle; creation would deadlock on it too.
+                ready = remaining
+            for r in ready:
+                order.append(r)
+                done.add(r.name)
+            remaining = [r for r in remaining if r.name not in done]
+        return order
+
     def _deploy(  # noqa: C901
         self,
         dry_run: bool = False,
@@ -1139,23 +2078,39 @@ class Deployment:
         allow_recreate: bool = False,
         force_reboot: bool = False,
         max_concurrent_copy: int = 5,
+        copy_method: str = "direct",
+        tree_fanout: int = 3,
+        probe_closures: bool = False,
+        adaptive_copy: bool = False,
+        max_copy_bandwidth: Optional[float] = None,
         max_concurrent_activate: int = -1,
         sync: bool = True,
         always_activate: bool = False,
         repair: bool = False,
         dry_activate: bool = False,
+        json_output: bool = False,
+        distributed_build: bool = False,
+        build_on_target: bool = False,
+        build_per_machine: bool = False,
+        max_concurrent_build: int = 4,
     ) -> None:
         """Perform the deployment defined by the deployment specification."""
 
         self.evaluate_active(include, exclude, kill_obsolete)
 
         # Assign each resource an index if it doesn't have one.
-        for r in self.active_resources.values():
-            if r.index is None:
-                r.index = self._get_free_resource_index()
-                # FIXME: Logger should be able to do coloring without the need
-                #        for an index maybe?
-                r.logger.register_index(r.index)
+        unindexed = [
+            r
+            for r in self.active_resources.values()
+            if r.index is None and self._locked(r.name)
+        ]
+        if unindexed:
+            with self._deployment_wide():
+                for r in unindexed:
+                    r.index = self._get_free_resource_index()
+                    # FIXME: Logger should be able to do coloring without the need
+                    #        for an index maybe?
+                    r.logger.register_index(r.index)
 
         self.logger.update_log_prefixes()
 
@@ -1177,22 +2132,8 @@ class Deployment:
                 r._created_event = threading.Event()
                 r._errored = False
 
-            def plan_worker(r: nixops.resources.DiffEngineResourceState) -> None:
-                if not should_do(r, include, exclude):
-                    return
-                r.plan(self._definition_for_required(r.name))
-
             if plan_only:
-                for r in self.active_resources.values():
-                    if isinstance(r, nixops.resources.DiffEngineResourceState):
-                        plan_worker(r)
-                    else:
-                        r.warn(
-                            "resource type {} doesn't implement a plan operation".format(
-                                r.get_type()
-                            )
-                        )
-
+                self._plan(include, exclude, json_output, max_concurrent_activate)
                 return
 
             def worker(r: nixops.resources.GenericResourceState):
@@ -1274,31 +2215,107 @@ class Deployment:
         if create_only:
             return
 
-        # Build the machine configurations.
-        # Record configs_path in the state so that the ‘info’ command
-        # can show whether machines have an outdated configuration.
-        self.configs_path = self.build_configs(
-            dry_run=dry_run, repair=repair, include=include, exclude=exclude
-        )
+        if build_on_target:
+            # Build each machine configuration on its machine, which
+            # leaves nothing to copy.
+            configs_path = self.build_on_targets(
+                include=include,
+                exclude=exclude,
+                max_concurrent_build=max_concurrent_build,
+                dry_run=dry_run,
+                repair=repair,
+            )
+            if build_only or dry_run:
+                return
+            with self._deployment_wide():
+                self.target_configs_path = configs_path
+        else:
+            # With per-machine builds and plain copies, copy each closure
+            # as soon as it is built.  The copies then start in the order
+            # the builds finish rather than longest first, but otherwise
+            # work as in copy_closures().
+            stream_copies = (
+                build_per_machine
+                and copy_method == "direct"
+                and not adaptive_copy
+                and not (build_only or dry_run)
+            )
+            copy_slots = threading.BoundedSemaphore(
+                len(self.active_machines)
+                if max_concurrent_copy == -1
+                else max_concurrent_copy
+            )
+            history = (
+                nixops.scheduling.ThroughputHistory.load() if stream_copies else None
+            )
+            present = PresentClosures()
+
+            def copy_built(m: nixops.backends.GenericMachineState) -> None:
+                assert history is not None
+                delta_sizes: Dict[str, int] = {}
+                if not self._skip_present_closures(
+                    [m], probe_closures, delta_sizes, present
+                ):
+                    return
+                size = self._copy_sizes([m], delta_sizes)[m.name]
+                with copy_slots:
+                    self._copy_closure(m, size, history)
 
-        if build_only or dry_run:
-            return
+            # Build the machine configurations.
+            # Record configs_path in the state so that the ‘info’ command
+            # can show whether machines have an outdated configuration.
+            try:
+                configs_path = self.build_configs(
+                    dry_run=dry_run,
+                    repair=repair,
+                    include=include,
+                    exclude=exclude,
+                    distributed_build=distributed_build,
+                    per_machine=build_per_machine,
+                    max_concurrent_build=max_concurrent_build,
+                    on_built=copy_built if stream_copies else None,
+                )
+            finally:
+                if history is not None:
+                    history.save()
+            with self._deployment_wide():
+                self.configs_path = configs_path
+                self.target_configs_path = None
+            # Leave out machines whose configuration failed to build.
+            exclude = exclude + self.failed_builds
+
+            if dry_run:
+                self.transfer_estimates = self.estimate_transfer(include, exclude)
+
+            if build_only or dry_run:
+                self._check_failed_builds()
+                return
 
-        # Copy the closures of the machine configurations to the
-        # target machines.
-        self.copy_closures(
-            self.configs_path,
-            include=include,
-            exclude=exclude,
-            max_concurrent_copy=max_concurrent_copy,
-        )
+            # Copy the closures of the machine configurations to the
+            # target machines.
+            if not stream_copies:
+                self.copy_closures(
+                    configs_path,
+                    include=include,
+                    exclude=exclude,
+                    max_concurrent_copy=max_concurrent_copy,
+                    copy_method=copy_method,
+                    tree_fanout=tree_fanout,
+                    probe_closures=probe_closures,
+                    adaptive_copy=adaptive_copy,
+                    max_copy_bandwidth=max_copy_bandwidth,
+                )
+            else:
+                self._report_present_closures(present)
+                self._log_closures_copied()
 
         if copy_only:
+            self._check_failed_builds()
             return
 
         # Active the configurations.
         self.activate_configs(
-            self.configs_path,
+            configs_path,
             include=include,
             exclude=exclude,
             allow_reboot=allow_reboot,
@@ -1310,9 +2327,11 @@ class Deployment:
             test=test,
             boot=boot,
             max_concurrent_activate=max_concurrent_activate,
+            remove_gc_root=build_on_target,
         )
 
         if dry_activate:
+            self._check_failed_builds()
             return
 
         # Trigger cleanup of resources, e.g. disks that need to be detached etc. Needs to be
@@ -1329,6 +2348,8 @@ class Deployment:
             tasks=iter(self.active_resources.values()),
             worker_fun=cleanup_worker,
         )
+        self._check_failed_builds()
+
         self.logger.log(
             ansi_success(
                 "{0}> deployment finished successfully".format(self.name or "unnamed"),
@@ -1361,7 +2382,7 @@ class Deployment:
             raise
 
     def deploy(self, **kwargs: Any) -> None:
-        with self._get_deployment_lock():
+        with self._get_deployment_lock(kwargs.get("include", [])):
             self.run_with_notify("deploy", lambda: self._deploy(**kwargs))
 
     def _rollback(
@@ -1373,6 +2394,11 @@ class Deployment:
         allow_reboot: bool = False,
         force_reboot: bool = False,
         max_concurrent_copy: int = 5,
+        copy_method: str = "direct",
+        tree_fanout: int = 3,
+        probe_closures: bool = False,
+        adaptive_copy: bool = False,
+        max_copy_bandwidth: Optional[float] = None,
         max_concurrent_activate: int = -1,
         sync: bool = True,
     ) -> None:
@@ -1381,49 +2407,59 @@ class Deployment:
                 "rollback is not enabled for this network; please set ‘network.enableRollback’ to ‘true’ and redeploy"
             )
         profile = self.get_profile()
-        if (
-            subprocess.call(
-                ["nix-env", "-p", profile, "--switch-generation", str(generation)]
-            )
-            != 0
-        ):
-            raise Exception("nix-env --switch-generation failed")
-
-        self.configs_path = os.path.realpath(profile)
-        assert os.path.isdir(self.configs_path)
-
-        names = set()
-        for filename in os.listdir(self.configs_path):
-            if not os.path.islink(self.configs_path + "/" + filename):
-                continue
+        # The profile and the set of obsolete machines are deployment-wide.
+        with self._deployment_wide():
             if (
-                should_do_n(filename, include, exclude)
-                and filename not in self.machines
-            ):
-                raise Exception(
-                    "cannot roll back machine ‘{0}’ which no longer exists".format(
-                        filename
-                    )
+                subprocess.call(
+                    ["nix-env", "-p", profile, "--switch-generation", str(generation)]
                 )
-            names.add(filename)
+                != 0
+            ):
+                raise Exception("nix-env --switch-generation failed")
 
-        # Update the set of active machines.
-        for m in self.machines.values():
-            if m.name in names:
-                if m.obsolete:
-                    self.logger.log(
-                        "machine ‘{0}’ is no longer obsolete".format(m.name)
+            self.configs_path = os.path.realpath(profile)
+            self.target_configs_path = None
+            assert os.path.isdir(self.configs_path)
+
+            names = set()
+            for filename in os.listdir(self.configs_path):
+                if not os.path.islink(self.configs_path + "/" + filename):
+                    continue
+                if (
+                    should_do_n(filename, include, exclude)
+                    and filename not in self.machines
+                ):
+                    raise Exception(
+                        "cannot roll back machine ‘{0}’ which no longer exists".format(
+                            filename
+                        )
                     )
-                    m.obsolete = False
-            else:
-                self.logger.log("machine ‘{0}’ is obsolete".format(m.name))
-                m.obsolete = True
+                names.add(filename)
+
+            # Update the set of active machines.
+            for m in self.machines.values():
+                if not self._locked(m.name):
+                    continue
+                if m.name in names:
+                    if m.obsolete:
+                        self.logger.log(
+                            "machine ‘{0}’ is no longer obsolete".format(m.name)
+                        )
+                        m.obsolete = False
+                else:
+                    self.logger.log("machine ‘{0}’ is obsolete".format(m.name))
+                    m.obsolete = True
 
         self.copy_closures(
             self.configs_path,
             include=include,
             exclude=exclude,
             max_concurrent_copy=max_concurrent_copy,
+            copy_method=copy_method,
+            tree_fanout=tree_fanout,
+            probe_closures=probe_closures,
+            adaptive_copy=adaptive_copy,
+            max_copy_bandwidth=max_copy_bandwidth,
         )
 
         self.activate_configs(
@@ -1442,7 +2478,7 @@ class Deployment:
         )
 
     def rollback(self, **kwargs: Any) -> None:
-        with self._get_deployment_lock():
+        with self._get_deployment_lock(kwargs.get("include", [])):
             self._rollback(**kwargs)
 
     def _destroy_resources(
@@ -1490,42 +2526,43 @@ class Deployment:
     ) -> None:
         """Destroy all active and obsolete resources."""
 
-        with self._get_deployment_lock():
+        with self._get_deployment_lock(include):
             self.run_with_notify(
                 "destroy", lambda: self._destroy_resources(include, exclude, wipe)
             )
 
-        # Remove the destroyed machines from the rollback profile.
-        # This way, a subsequent "nix-env --delete-generations old" or
-        # "nix-collect-garbage -d" will get rid of the machine
-        # configurations.
-        if self.rollback_enabled:  # and len(self.active) == 0:
-            profile = self.create_profile()
-            attrs = {
-                m.name: Call(RawValue("builtins.storePath"), m.cur_toplevel)
-                for m in self.active_machines.values()
-                if m.cur_toplevel
-            }
-            if (
-                subprocess.call(
-                    [
-                        "nix-env",
-                        "-p",
-                        profile,
-                        "--set",
-                        "*",
-                        "-I",
-                        "nixops=" + self.expr_path,
-                        "-f",
-                        "<nixops/update-profile.nix>",
-                        "--arg",
-                        "machines",
-                        py2nix(attrs, inline=True),
-                    ]
-                )
-                != 0
-            ):
-                raise Exception("cannot update profile ‘{0}’".format(profile))
+            # Remove the destroyed machines from the rollback profile.
+            # This way, a subsequent "nix-env --delete-generations old" or
+            # "nix-collect-garbage -d" will get rid of the machine
+            # configurations.
+            if self.rollback_enabled:  # and len(self.active) == 0:
+                profile = self.create_profile()
+                with self._deployment_wide():
+                    attrs = {
+                        m.name: Call(RawValue("builtins.storePath"), m.cur_toplevel)
+                        for m in self.active_machines.values()
+                        if m.cur_toplevel
+                    }
+                    if (
+                        subprocess.call(
+                            [
+                                "nix-env",
+                                "-p",
+                                profile,
+                                "--set",
+                                "*",
+                                "-I",
+                                "nixops=" + self.expr_path,
+                                "-f",
+                                "<nixops/update-profile.nix>",
+                                "--arg",
+                                "machines",
+                                py2nix(attrs, inline=True),
+                            ]
+                        )
+                        != 0
+                    ):
+                        raise Exception("cannot update profile ‘{0}’".format(profile))
 
     def delete_resources(
         self, include: List[str] = [], exclude: List[str] = []
@@ -1604,14 +2641,18 @@ class Deployment:
 
         self.logger.log("renaming resource ‘{0}’ to ‘{1}’...".format(name, new_name))
 
-        m = self.resources.pop(name)
-        self.resources[new_name] = m
+        m = self.resources[name]
+
+        def renamed() -> None:
+            self.resources.pop(name)
+            self.resources[new_name] = m
 
         with self._db:
             self._db.execute(
                 "update Resources set name = ? where deployment = ? and id = ?",
                 (new_name, self.uuid, m.id),
             )
+            self._db.after_commit(renamed)
 
     def send_keys(self, include: List[str] = [], exclude: List[str] = []) -> None:
         """Send encryption keys to machines."""
@@ -1662,9 +2703,10 @@ def is_machine_defn(r: nixops.resources.GenericResourceState) -> bool:
     return isinstance(r, nixops.backends.MachineDefinition)
 
 
-def _subclasses(cls: Any) -> List[Any]:
-    sub = cls.__subclasses__()
-    return [cls] if not sub else [g for s in sub for g in _subclasses(s)]
+_definition_types = TypeRegistry(
+    nixops.resources.ResourceDefinition, lambda cls: cls.get_resource_type()
+)
+_state_types = TypeRegistry(nixops.resources.ResourceState, lambda cls: cls.get_type())
 
 
 def _create_definition(
@@ -1672,9 +2714,9 @@ def _create_definition(
 ) -> nixops.resources.ResourceDefinition:
     """Create a resource definition object from the given XML representation of the machine's attributes."""
 
-    for cls in _subclasses(nixops.resources.ResourceDefinition):
-        if type_name == cls.get_resource_type():
-            return cls(name, nixops.resources.ResourceEval(config))  # type: ignore
+    cls = _definition_types.get(type_name)
+    if cls is not None:
+        return cls(name, nixops.resources.ResourceEval(config))  # type: ignore
 
     raise nixops.deployment.UnknownBackend(
         "unknown resource type ‘{0}’".format(type_name)
@@ -1686,12 +2728,9 @@ def _create_state(
 ) -> GenericResourceState:
     """Create a resource state object of the desired type."""
 
-    for cls in _subclasses(nixops.resources.ResourceState):
-        try:
-            if type == cls.get_type():
-                return cls(depl, name, id)  # type: ignore
-        except NotImplementedError:
-            pass
+    cls = _state_types.get(type)
+    if cls is not None:
+        return cls(depl, name, id)  # type: ignore
 
     raise nixops.deployment.UnknownBackend("unknown resource type ‘{0}’".format(type))
 
@@ -1,21 +1,26 @@
 from __future__ import annotations
 
-import itertools
-
+import math
+from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import (
     Any,
     AnyStr,
     Callable,
     Dict,
+    FrozenSet,
+    Iterator,
     List,
+    Mapping,
     Optional,
+    Set,
     Tuple,
     Generic,
     TypeVar,
     TYPE_CHECKING,
 )
 from nixops.logger import MachineLogger
-from nixops.state import StateDict
+from nixops.state import DeploymentSnapshot
 
 if TYPE_CHECKING:
     import nixops.deployment
@@ -58,6 +63,109 @@ class Handler:
         return self._keys
 
 
+def _describe_handler(handler: Handler) -> str:
+    name: Optional[str] = getattr(handler.handle, "__name__", None)
+    if name and name != "_default_handle":
+        return name
+    return "handler for {0}".format(", ".join(handler.get_keys()))
+
+
+@dataclass
+class Plan:
+    """The changes to a resource, and the handlers realizing them in order."""
+
+    # The kind of change (Diff.SET, Diff.UPDATE or Diff.UNSET) per key.
+    changes: Dict[str, int] = field(default_factory=dict)
+    handlers: List[Handler] = field(default_factory=list)
+    # The values in the state and in the definition of the changed keys.
+    old: Dict[str, Any] = field(default_factory=dict)
+    new: Dict[str, Any] = field(default_factory=dict)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "changes": {k: _ACTIONS[v] for k, v in self.changes.items()},
+            "handlers": [
+                {"handler": _describe_handler(h), "keys": list(h.get_keys())}
+                for h in self.handlers
+            ],
+        }
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """Yield a record per changed key, e.g. to print as JSON."""
+        for k, v in self.changes.items():
+            yield {
+                "key": k,
+                "action": _ACTIONS[v],
+                "old": self.old.get(k),
+                "new": self.new.get(k),
+            }
+
+
+@lru_cache(maxsize=1024)
+def _minimal_cover(
+    handler_keys: Tuple[FrozenSet[str], ...], keys: FrozenSet[str]
+) -> Optional[Tuple[int, ...]]:
+    """
+    Return the positions of the smallest set of handlers whose keys cover
+    ‘keys’, or None if there is no such set.  Among sets of the same
+    size, the first one in the order of itertools.combinations() is
+    returned.
+
+    A greedy cover bounds the size of the result; a branch and bound
+    search over the handlers touching ‘keys’ then finds the minimum.
+    """
+    relevant = [
+        (i, hkeys & keys) for i, hkeys in enumerate(handler_keys) if hkeys & keys
+    ]
+    if not keys:
+        return ()
+    if frozenset().union(*(hkeys for _, hkeys in relevant)) != keys:
+        return None
+
+    # Greedy upper bound.
+    upper = 0
+    uncovered = set(keys)
+    while uncovered:
+        best = max(relevant, key=lambda r: len(r[1] & uncovered))
+        uncovered -= best[1]
+        upper += 1
+
+    # Keys covered by the handlers from a given position onward.
+    suffix: List[FrozenSet[str]] = [frozenset()] * (len(relevant) + 1)
+    for pos in range(len(relevant) - 1, -1, -1):
+        suffix[pos] = suffix[pos + 1] | relevant[pos][1]
+    widest = max(len(hkeys) for _, hkeys in relevant)
+
+    def search(pos: int, uncovered: FrozenSet[str], left: int) -> Optional[List[int]]:
+        if not uncovered:
+            return []
+        if left == 0 or not uncovered <= suffix[pos]:
+            return None
+        # Even the handlers covering most of the rest need too many steps.
+        gains = sorted(
+            (len(hkeys & uncovered) for _, hkeys in relevant[pos:]), reverse=True
+        )
+        if sum(gains[:left]) < len(uncovered):
+            return None
+        for p in range(pos, len(relevant)):
+            i, hkeys = relevant[p]
+            if not hkeys & uncovered:
+                continue
+            rest = search(p + 1, uncovered - hkeys, left - 1)
+            if rest is not None:
+                return [i] + rest
+        return None
+
+    for size in range(math.ceil(len(keys) / widest), upper + 1):
+        # A smaller cover was not found, so a cover found with at most
+        # ‘size’ handlers has exactly ‘size’ handlers.
+        found = search(0, keys, size)
+        if found is not None:
+            return tuple(found)
+
+    raise Exception("internal error: no cover within the greedy bound")
+
+
 class Diff(Generic[ResourceDefinitionType]):
     """
     Diff engine main class which implements methods for doing diffs between
@@ -73,12 +181,17 @@ class Diff(Generic[ResourceDefinitionType]):
         depl: nixops.deployment.Deployment,
         logger: MachineLogger,
         defn: ResourceDefinitionType,
-        state: StateDict,
+        state: Mapping[str, Any],
         res_type: str,
+        snapshot: Optional[DeploymentSnapshot] = None,
     ) -> None:
         self.handlers: List[Handler] = []
         self._definition = defn.resource_eval
         self._state = state
+        # If set, references to other resources are resolved from this
+        # snapshot of the state file rather than from the state file.
+        self._snapshot = snapshot
+        self._resolved: Dict[str, Any] = {}
         self._depl = depl
         self._type = res_type
         self.logger = logger
@@ -111,6 +224,10 @@ class Diff(Generic[ResourceDefinitionType]):
         the diff between definition and state then return a sorted list
         of the handlers to be called to realize the diff.
         """
+        return self.get_plan(show).handlers
+
+    def get_plan(self, show: bool = False) -> Plan:
+        """Like plan(), but also return the changes to be realized."""
         keys = list(set(self._state.keys()) | set(self._definition.keys()))
         for k in keys:
             self.eval_resource_attr_diff(k)
@@ -133,7 +250,13 @@ class Diff(Generic[ResourceDefinitionType]):
                             k, self._state[k]
                         )
                     )
-        return self.get_handlers_sequence()
+        changed = self.get_keys()
+        return Plan(
+            changes={k: self._diff[k] for k in changed},
+            handlers=self.get_handlers_sequence(),
+            old={k: self._state.get(k) for k in changed},
+            new={k: self.get_resource_definition(k) for k in changed},
+        )
 
     def set_handlers(self, handlers: List[Handler]) -> None:
         self.handlers = handlers
@@ -145,15 +268,28 @@ class Diff(Generic[ResourceDefinitionType]):
         The output is a sorted sequence of handlers based on their
         dependencies.
         """
-        # TODO implement cycle detection
         parent: Dict[Handler, Optional[Handler]] = {}
         sequence: List[Handler] = []
+        # The handlers on the current path of the search.
+        path: List[Handler] = []
+        on_path: Set[Handler] = set()
 
         def visit(handler: Handler) -> None:
+            path.append(handler)
+            on_path.add(handler)
             for v in handler.get_deps():
+                if v in on_path:
+                    cycle = path[path.index(v) :] + [v]
+                    raise Exception(
+                        "dependency cycle between handlers of resource type {0}: {1}".format(
+                            self._type, " -> ".join(_describe_handler(h) for h in cycle)
+                        )
+                    )
                 if v not in parent:
                     parent[v] = handler
                     visit(v)
+            path.pop()
+            on_path.discard(handler)
             sequence.append(handler)
 
         for h in handlers:
@@ -163,27 +299,28 @@ class Diff(Generic[ResourceDefinitionType]):
 
         return [h for h in sequence if h in handlers]
 
-    def get_handlers_sequence(self, combinations: int = 1) -> List[Handler]:
-        if len(self.get_keys()) == 0:
+    def get_handlers_sequence(self) -> List[Handler]:
+        """
+        Return the smallest set of handlers that realizes the change of
+        all changed keys, in dependency order.
+        """
+        keys = frozenset(self.get_keys())
+        if len(keys) == 0:
             return []
-        h_tuple: Tuple[Handler, ...]
-        for h_tuple in itertools.combinations(self.handlers, combinations):
-            keys: List[str] = []
-            for item in h_tuple:
-                keys.extend(item.get_keys())
-            if combinations == len(self.handlers):
-                keys_not_found = set(self.get_keys()) - set(keys)
-                if len(keys_not_found) > 0:
-                    raise Exception(
-                        "Couldn't find any combination of handlers"
-                        " that realize the change of {0} for resource type {1}".format(
-                            str(keys_not_found), self._type
-                        )
-                    )
-            if set(self.get_keys()) <= set(keys):
-                handlers_seq = self.topological_sort(list(h_tuple))
-                return handlers_seq
-        return self.get_handlers_sequence(combinations + 1)
+        cover = _minimal_cover(
+            tuple(frozenset(h.get_keys()) for h in self.handlers), keys
+        )
+        if cover is None:
+            keys_not_found = set(keys).difference(
+                *(h.get_keys() for h in self.handlers)
+            )
+            raise Exception(
+                "Couldn't find any combination of handlers"
+                " that realize the change of {0} for resource type {1}".format(
+                    str(keys_not_found), self._type
+                )
+            )
+        return self.topological_sort([self.handlers[i] for i in cover])
 
     def eval_resource_attr_diff(self, key: str) -> None:
         s = self._state.get(key, None)
@@ -196,13 +333,42 @@ class Diff(Generic[ResourceDefinitionType]):
             if s != d:
                 self._diff[key] = self.UPDATE
 
+    def _resolve_from_snapshot(self, res: Any, k: str) -> Any:
+        assert self._snapshot is not None
+
+        def get(attr: str) -> Any:
+            prop = getattr(type(res), attr, None)
+            spec = getattr(getattr(prop, "fget", None), "attr_property", None)
+            if isinstance(prop, property) and spec is not None:
+                return self._snapshot.attr(res.id, *spec)  # type: ignore
+            return getattr(res, attr)
+
+        if get("state") != res.UP:
+            return "computed"
+        try:
+            return get(k)
+        except AttributeError:
+            # Like res._state[k], for resources using the diff engine.
+            if not hasattr(res, "_state"):
+                raise
+            return self._snapshot.state(res.id)[k]
+
     def get_resource_definition(self, key: str) -> Any:
+        if key in self._resolved:
+            return self._resolved[key]
+
         def retrieve_def(d):
             # type: (Any) -> Any
             if isinstance(d, str) and d.startswith("res-"):
                 name = d[4:].split(".")[0]
                 res_type = d.split(".")[1]
                 k = d.split(".")[2] if len(d.split(".")) > 2 else key
+                if self._snapshot is not None:
+                    references = self._snapshot.references
+                    if (d, k) not in references:
+                        res = self._depl.get_generic_resource(name, res_type)
+                        references[(d, k)] = self._resolve_from_snapshot(res, k)
+                    return references[(d, k)]
                 res = self._depl.get_generic_resource(name, res_type)
                 if res.state != res.UP:
                     return "computed"
@@ -220,6 +386,11 @@ class Diff(Generic[ResourceDefinitionType]):
             for option in d:
                 item = retrieve_def(option)
                 options.append(item)
-            return options
-        d = retrieve_def(d)
+            d = options
+        else:
+            d = retrieve_def(d)
+        self._resolved[key] = d
         return d
+
+
+_ACTIONS = {Diff.SET: "set", Diff.UPDATE: "update", Diff.UNSET: "unset"}
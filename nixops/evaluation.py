@@ -1,8 +1,11 @@
 from nixops.nix_expr import RawValue, py2nix
 import subprocess
 import typing
-from typing import Optional, Mapping, Any, List, Dict, TextIO
+from typing import Optional, Mapping, Any, List, Dict, TextIO, Iterable, Tuple
 import json
+import hashlib
+import nixops.cache
+import nixops.util
 from nixops.util import ImmutableValidatedObject
 from nixops.exceptions import NixError
 import itertools
@@ -140,17 +143,159 @@ def eval(
         raise NixEvalError
 
 
-def eval_network(nix_expr: NetworkFile) -> NetworkEval:
+# Don't cache the evaluation of networks living in directories that are
+# too large to validate cheaply.
+_CACHE_MAX_FILES = 5000
+
+_network_evals: Dict[Tuple[str, bool], NetworkEval] = {}
+
+
+def _network_files(nix_expr: NetworkFile) -> Optional[List[str]]:
+    """
+    Return the files in the directory of a network, which its evaluation
+    may depend on, or None if there are too many of them.
+    """
+    root = nix_expr.network if nix_expr.is_flake else os.path.dirname(nix_expr.network)
+    files: List[str] = []
+    dirs = [os.path.abspath(root)]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+        if len(files) > _CACHE_MAX_FILES:
+            return None
+    return files
+
+
+def _file_signatures(
+    paths: Iterable[str], known: Dict[str, List[Any]]
+) -> Optional[Dict[str, List[Any]]]:
+    """
+    Return [mtime, size, sha256] of every file, only hashing files whose
+    mtime or size differ from ‘known’.  Return None if a file is gone.
+    """
+    signatures: Dict[str, List[Any]] = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            old = known.get(path)
+            if old is not None and old[:2] == [st.st_mtime_ns, st.st_size]:
+                signatures[path] = old
+                continue
+            with open(path, "rb") as f:
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        signatures[path] = [st.st_mtime_ns, st.st_size, digest.hexdigest()]
+    return signatures
+
+
+def _network_eval_env() -> Dict[str, Any]:
+    """The environment that the evaluation of a network depends on."""
+    expr = os.path.realpath(os.path.join(get_expr_path(), "eval-machine-info.nix"))
+    st = os.stat(expr)
+    return {
+        "expr": [expr, st.st_mtime_ns, st.st_size],
+        "NIX_PATH": os.environ.get("NIX_PATH"),
+        "NIX_CONFIG": os.environ.get("NIX_CONFIG"),
+    }
+
+
+def _network_cache_file(nix_expr: NetworkFile) -> Optional[str]:
+    cache_dir = nixops.cache.cache_dir("network-eval")
+    if cache_dir is None:
+        return None
+    key = json.dumps([os.path.abspath(nix_expr.network), nix_expr.is_flake])
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+
+def _cached_network_attrs(
+    nix_expr: NetworkFile, cache_file: str
+) -> Optional[Dict[str, Any]]:
+    try:
+        with open(cache_file) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get("env") != _network_eval_env():
+        return None
+    files = _network_files(nix_expr)
+    if files is None:
+        return None
+    paths = set(files) | set(entry["required"])
+    if paths != set(entry["files"]):
+        return None
+    signatures = _file_signatures(paths, entry["files"])
+    if signatures is None:
+        return None
+    if any(signatures[p][2] != entry["files"][p][2] for p in paths):
+        return None
+    if signatures != entry["files"]:
+        # Only the timestamps changed; record them so that the next
+        # validation doesn't need to hash the files again.
+        entry["files"] = signatures
+        nixops.cache.write_cache_file(cache_file, json.dumps(entry))
+    network: Dict[str, Any] = entry["network"]
+    return network
+
+
+def _eval_network_attrs(nix_expr: NetworkFile) -> Dict[str, Any]:
+    """
+    Evaluate the ‘network’ attribute of a network.  The result is cached
+    until a file in the network's directory, a file it requires or the
+    environment changes.
+    """
+    cache_file = _network_cache_file(nix_expr)
+    if cache_file is not None:
+        cached = _cached_network_attrs(nix_expr, cache_file)
+        if cached is not None:
+            return cached
+
+    files = _network_files(nix_expr) if cache_file is not None else None
+    before = _file_signatures(files, {}) if files is not None else None
+
     try:
         result = eval(
             networkExpr=nix_expr,
             uuid="dummy",
             deploymentName="dummy",
-            attr="info.network",
+            attr="networkInfo",
         )
     except Exception:
         raise NixEvalError("No network attribute found")
 
+    if cache_file is not None and files is not None and before is not None:
+        required = [f for f in result["files"] if os.path.isabs(f)]
+        signatures = _file_signatures(set(files) | set(required), before)
+        # Don't cache the result if a file was modified during evaluation.
+        if signatures is not None and all(signatures[p] == before[p] for p in before):
+            entry = {
+                "env": _network_eval_env(),
+                "required": required,
+                "files": signatures,
+                "network": result["network"],
+            }
+            nixops.cache.write_cache_file(cache_file, json.dumps(entry))
+
+    network: Dict[str, Any] = result["network"]
+    return network
+
+
+def eval_network(nix_expr: NetworkFile) -> NetworkEval:
+    key = (nix_expr.network, nix_expr.is_flake)
+    if key not in _network_evals:
+        _network_evals[key] = _process_network(nix_expr, _eval_network_attrs(nix_expr))
+    return _network_evals[key]
+
+
+def _process_network(nix_expr: NetworkFile, result: Dict[str, Any]) -> NetworkEval:
     if result.get("storage") is None:
         raise MalformedNetworkError(
             """
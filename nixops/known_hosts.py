@@ -1,71 +1,154 @@
 import os
 import threading
 import fcntl
+from contextlib import contextmanager
 
-from typing import Optional
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 # Allow only one thread to rewrite known_hosts at a time.
 LOCK = threading.Lock()
 
 
-def _rewrite(ip_address: str, add_ip: bool, public_host_key: str) -> None:
-    with LOCK:
-        path = os.path.expanduser("~/.ssh/known_hosts")
-
-        # If hosts file doesn't exist, create an empty file
-        if not os.path.isfile(path):
-            basedir = os.path.dirname(path)
-            if not os.path.exists(basedir):
-                os.makedirs(basedir)
-            open(path, "a").close()
-
-        with open(os.path.expanduser("~/.ssh/.known_hosts.lock"), "w") as lockfile:
-            fcntl.flock(
-                lockfile, fcntl.LOCK_EX
-            )  # unlock is implicit at the end of the with
-            with open(path, "r") as f:
-                contents = f.read()
-
-            def rewrite(lst: str) -> Optional[str]:
-                if " " not in lst:
-                    return lst
-                (first, rest) = lst.split(" ", 1)
-                names = first.split(",")
-                if ip_address not in names:
-                    return lst
-                if not add_ip and public_host_key != rest:
-                    return lst
-                new_names = [n for n in names if n != ip_address]
-                return ",".join(new_names) + " " + rest if new_names != [] else None
-
-            new = [
-                line
-                for line in [rewrite(line) for line in contents.splitlines()]
-                if line is not None
-            ]
-
-            if add_ip:
-                new.append(ip_address + " " + public_host_key)
-
-            tmp = "{0}.tmp-{1}".format(path, os.getpid())
-            f = open(tmp, "w")
-            f.write("\n".join(new + [""]))
-            f.close()
-            os.rename(tmp, path)
+class _Entries:
+    """
+    The lines of a known_hosts file, with an index from host names to
+    the lines that mention them.
+    """
+
+    def __init__(self, contents: str) -> None:
+        # Each line is either kept verbatim (comments and other lines
+        # without a key), or split into its host names and the rest.
+        self.lines: List[Tuple[Optional[List[str]], str]] = []
+        self.index: Dict[str, Set[int]] = {}
+        for line in contents.splitlines():
+            if " " not in line:
+                self.lines.append((None, line))
+                continue
+            (first, rest) = line.split(" ", 1)
+            self._append(first.split(","), rest)
+
+    def _append(self, names: List[str], rest: str) -> None:
+        n = len(self.lines)
+        self.lines.append((names, rest))
+        for name in names:
+            self.index.setdefault(name, set()).add(n)
+
+    def _remove(self, ip_address: str, public_host_key: Optional[str]) -> None:
+        """Remove ‘ip_address’ from its entries with the given key, or all."""
+        positions = self.index.get(ip_address, set())
+        for n in list(positions):
+            (names, rest) = self.lines[n]
+            assert names is not None
+            if public_host_key is not None and public_host_key != rest:
+                continue
+            names[:] = [name for name in names if name != ip_address]
+            positions.discard(n)
+
+    def remove(self, ip_address: str, public_host_key: str) -> None:
+        self._remove(ip_address, public_host_key)
+
+    def add(self, ip_address: str, public_host_key: str) -> None:
+        self._remove(ip_address, None)
+        self._append([ip_address], public_host_key)
+
+    def render(self) -> str:
+        new = []
+        for (names, rest) in self.lines:
+            if names is None:
+                new.append(rest)
+            elif names:
+                new.append(",".join(names) + " " + rest)
+        return "\n".join(new + [""])
+
+
+class Batch:
+    """
+    A set of changes to known_hosts, applied in order in a single rewrite
+    of the file.  Use it through batch().
+    """
+
+    def __init__(self) -> None:
+        self._ops: List[Tuple[str, str, str]] = []
+
+    def remove(self, ip_address: str, public_host_key: str) -> None:
+        """Remove a specific known host key."""
+        self._ops.append(("remove", ip_address, public_host_key))
+
+    def add(self, ip_address: str, public_host_key: str) -> None:
+        """Add a known host key, replacing any other key of the host."""
+        self._ops.append(("add", ip_address, public_host_key))
+
+    def update(self, prev_address: str, new_address: str, public_host_key: str) -> None:
+        if prev_address != new_address:
+            self.remove(prev_address, public_host_key)
+        self.add(new_address, public_host_key)
+
+    def apply(self) -> None:
+        if not self._ops:
+            return
+        with LOCK:
+            path = os.path.expanduser("~/.ssh/known_hosts")
+
+            # If hosts file doesn't exist, create an empty file
+            if not os.path.isfile(path):
+                basedir = os.path.dirname(path)
+                if not os.path.exists(basedir):
+                    os.makedirs(basedir)
+                open(path, "a").close()
+
+            with open(os.path.expanduser("~/.ssh/.known_hosts.lock"), "w") as lockfile:
+                fcntl.flock(
+                    lockfile, fcntl.LOCK_EX
+                )  # unlock is implicit at the end of the with
+                with open(path, "r") as f:
+                    contents = f.read()
+
+                entries = _Entries(contents)
+                for (op, ip_address, public_host_key) in self._ops:
+                    if op == "add":
+                        entries.add(ip_address, public_host_key)
+                    else:
+                        entries.remove(ip_address, public_host_key)
+                self._ops = []
+
+                new = entries.render()
+                if new == contents:
+                    return
+
+                tmp = "{0}.tmp-{1}".format(path, os.getpid())
+                f = open(tmp, "w")
+                f.write(new)
+                f.close()
+                os.rename(tmp, path)
+
+
+@contextmanager
+def batch() -> Iterator[Batch]:
+    """
+    Collect changes to known_hosts, and apply them when the block exits
+    without an exception, e.g.
+
+        with nixops.known_hosts.batch() as b:
+            for m in machines:
+                b.add(m.public_ipv4, m.public_host_key)
+    """
+    b = Batch()
+    yield b
+    b.apply()
 
 
 def remove(ip_address: str, public_host_key: str) -> None:
     """Remove a specific known host key."""
-    _rewrite(ip_address, False, public_host_key)
+    with batch() as b:
+        b.remove(ip_address, public_host_key)
 
 
 def add(ip_address: str, public_host_key: str) -> None:
     """Add a known host key."""
-    _rewrite(ip_address, True, public_host_key)
+    with batch() as b:
+        b.add(ip_address, public_host_key)
 
 
 def update(prev_address: str, new_address: str, public_host_key: str) -> None:
-    # FIXME: this rewrites known_hosts twice.
-    if prev_address != new_address:
-        remove(prev_address, public_host_key)
-    add(new_address, public_host_key)
+    with batch() as b:
+        b.update(prev_address, new_address, public_host_key)
@@ -1,4 +1,4 @@
-from typing import TypeVar, Type
+from typing import Sequence, TypeVar, Type
 from typing_extensions import Protocol
 
 
@@ -26,6 +26,23 @@ class LockInterface(Protocol):
     def unlock(self, **kwargs) -> None:
         raise NotImplementedError
 
+    # lock_resources: acquire a lock covering only the named resources
+    # of the network, so that operations on disjoint sets of resources
+    # can run concurrently. Implementing this is optional: by default the
+    # whole network is locked exclusively.
+    # Note: no arguments will be passed over kwargs. Making it part of
+    # the type definition allows adding new arguments later.
+    def lock_resources(
+        self, description: str, resources: Sequence[str], **kwargs
+    ) -> None:
+        self.lock(description=description, exclusive=True)
+
+    # unlock_resources: release a lock acquired with lock_resources.
+    # Note: no arguments will be passed over kwargs. Making it part of
+    # the type definition allows adding new arguments later.
+    def unlock_resources(self, resources: Sequence[str], **kwargs) -> None:
+        self.unlock()
+
 
 LockOptions = TypeVar("LockOptions")
 
@@ -0,0 +1,305 @@
+import fcntl
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence
+
+from nixops.util import ImmutableValidatedObject
+from . import LockDriver
+
+
+class FileLockOptions(ImmutableValidatedObject):
+    # Lock state file, shared by everyone using the network on this machine.
+    # It is required: networks sharing it would lock each other out.
+    path: Optional[str] = None
+    # Seconds after which the lock of a holder that stopped renewing it
+    # (e.g. because it was killed) is broken.
+    lease: int = 60
+    # Seconds to wait for the lock before giving up, or null to wait forever.
+    timeout: Optional[int] = None
+    # Let lock_resources() lock only the named resources. This only takes
+    # effect with storage backends that tolerate concurrent writers, like
+    # ‘legacy’.
+    resourceLocking: bool = False
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def _conflicts(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    """Whether two lock requests cannot be held at the same time."""
+    if a["resources"] is not None and b["resources"] is not None:
+        return not set(a["resources"]).isdisjoint(b["resources"])
+    # Resource locks hold the network shared, so they only conflict with
+    # exclusive network locks.
+    return bool(a["exclusive"] or b["exclusive"])
+
+
+def _describe(entry: Dict[str, Any]) -> str:
+    return "‘{0}’ (pid {1} on {2}, since {3})".format(
+        entry["description"],
+        entry["pid"],
+        entry["host"],
+        time.strftime("%H:%M:%S", time.localtime(entry["since"])),
+    )
+
+
+class FileLock(LockDriver[FileLockOptions]):
+    """
+    A lock on a local JSON file, so that several NixOps processes on one
+    machine (e.g. CI jobs) can safely share a network.
+
+    Shared locks are compatible with each other; exclusive locks are
+    not compatible with anything. Waiters queue up in arrival order and
+    are only granted the lock if they conflict with neither a holder nor
+    an earlier waiter, so a stream of readers cannot starve a writer.
+
+    Holders renew their lease while they hold the lock, and waiters
+    their place in the queue. The lease of a process that died, or that
+    stopped renewing it, is broken.
+
+    How long acquisitions waited is totalled per lock mode under
+    ‘metrics’ in the lock file.
+
+    Calling unlock() on a driver that never acquired the lock (as
+    ‘nixops unlock’ does) forcibly releases all holders.
+    """
+
+    __options = FileLockOptions
+
+    @staticmethod
+    def options(**kwargs) -> FileLockOptions:
+        return FileLockOptions(**kwargs)
+
+    def __init__(self, args: FileLockOptions) -> None:
+        if args.path is None:
+            raise Exception(
+                "the ‘file’ lock driver requires the ‘path’ option, e.g."
+                ' ‘network.lock.file.path = "/var/lib/nixops/mynetwork.lock"’'
+            )
+        self._path = os.path.expanduser(args.path)
+        self._lease = args.lease
+        self._timeout = args.timeout
+        self._resource_locking = args.resourceLocking
+        self._host = socket.gethostname()
+        self._id: Optional[str] = None
+        self._used = False
+        self._renewer: Optional[threading.Thread] = None
+        self._stop_renewing = threading.Event()
+        # Lock-wait timing of the last acquisition (see also _record_wait).
+        self.metrics: Dict[str, Any] = {}
+
+    def _update(self, fun) -> Any:
+        """Atomically read, modify and write back the lock state file."""
+        os.makedirs(os.path.dirname(self._path), 0o700, exist_ok=True)
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = json.loads(f.read() or "{}")
+            except ValueError:
+                sys.stderr.write(
+                    "warning: ignoring corrupt lock file ‘{0}’\n".format(self._path)
+                )
+                state = {}
+            state.setdefault("holders", [])
+            state.setdefault("queue", [])
+            self._expire(state)
+            result = fun(state)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f, indent=2)
+            return result
+
+    def _alive(self, entry: Dict[str, Any], now: float) -> bool:
+        if entry["expires"] < now:
+            return False
+        if entry["host"] != self._host:
+            return True
+        try:
+            os.kill(entry["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _expire(self, state: Dict[str, Any]) -> None:
+        now = time.time()
+        for key in ("holders", "queue"):
+            alive = []
+            for e in state[key]:
+                if e["id"] == self._id or self._alive(e, now):
+                    alive.append(e)
+                elif key == "holders":
+                    sys.stderr.write(
+                        "breaking expired lock held by {0}\n".format(_describe(e))
+                    )
+            state[key] = alive
+
+    def _acquire(
+        self, description: str, exclusive: bool, resources: Optional[Sequence[str]]
+    ) -> None:
+        if self._id is not None:
+            raise Exception("lock ‘{0}’ is already held".format(self._path))
+        self._used = True
+        self._id = str(uuid.uuid4())
+        mode = "exclusive" if exclusive else "shared"
+        if resources is not None:
+            mode = "resource"
+        entry = {
+            "id": self._id,
+            "description": description,
+            "exclusive": exclusive,
+            "resources": sorted(resources) if resources is not None else None,
+            "pid": os.getpid(),
+            "host": self._host,
+            "since": time.time(),
+            "expires": time.time() + self._lease,
+        }
+
+        start = time.monotonic()
+        waited_for: Optional[List[Dict[str, Any]]] = None
+
+        def try_acquire(state: Dict[str, Any]) -> List[Dict[str, Any]]:
+            entry["expires"] = time.time() + self._lease
+            queue = state["queue"]
+            # The state is read afresh on every attempt, so renew our
+            # place in the queue there, or it would expire and we would
+            # lose it.
+            ahead = []
+            for e in queue:
+                if e["id"] == self._id:
+                    e["expires"] = entry["expires"]
+                    break
+                ahead.append(e)
+            else:
+                queue.append(entry)
+            blockers = [e for e in state["holders"] + ahead if _conflicts(entry, e)]
+            if not blockers:
+                state["queue"] = [e for e in queue if e["id"] != self._id]
+                entry["since"] = time.time()
+                state["holders"].append(entry)
+                self._record_wait(
+                    state, mode, time.monotonic() - start, waited_for is not None
+                )
+            return blockers
+
+        delay = 0.1
+        try:
+            while True:
+                blockers = self._update(try_acquire)
+                if not blockers:
+                    break
+                if waited_for is None:
+                    sys.stderr.write(
+                        "waiting for {0} lock on ‘{1}’, blocked by {2}...\n".format(
+                            mode,
+                            self._path,
+                            ", ".join(_describe(e) for e in blockers),
+                        )
+                    )
+                    waited_for = blockers
+                if (
+                    self._timeout is not None
+                    and time.monotonic() - start > self._timeout
+                ):
+                    raise LockTimeout(
+                        "timed out after {0}s waiting for {1} lock on ‘{2}’".format(
+                            self._timeout, mode, self._path
+                        )
+                    )
+                time.sleep(delay)
+                # Poll well within the lease, to keep our place queued.
+                delay = min(delay * 2, 1.0, self._lease / 3)
+        except BaseException:
+            self._release()
+            raise
+
+        wait = time.monotonic() - start
+        self.metrics = {
+            "mode": mode,
+            "wait_seconds": wait,
+            "contended": waited_for is not None,
+        }
+        if waited_for is not None:
+            sys.stderr.write(
+                "acquired {0} lock on ‘{1}’ after {2:.1f}s\n".format(
+                    mode, self._path, wait
+                )
+            )
+
+        self._stop_renewing.clear()
+        self._renewer = threading.Thread(target=self._renew, daemon=True)
+        self._renewer.start()
+
+    def _record_wait(
+        self, state: Dict[str, Any], mode: str, wait: float, contended: bool
+    ) -> None:
+        """
+        Add a lock wait to the totals per lock mode kept in the lock
+        state file, so that contention on a shared machine can be
+        monitored.
+        """
+        totals = state.setdefault("metrics", {}).setdefault(
+            mode,
+            {"acquired": 0, "contended": 0, "wait_seconds": 0.0, "max_wait": 0.0},
+        )
+        totals["acquired"] += 1
+        if contended:
+            totals["contended"] += 1
+        totals["wait_seconds"] = round(totals["wait_seconds"] + wait, 3)
+        totals["max_wait"] = round(max(totals["max_wait"], wait), 3)
+
+    def _renew(self) -> None:
+        def renew(state: Dict[str, Any]) -> None:
+            for e in state["holders"]:
+                if e["id"] == self._id:
+                    e["expires"] = time.time() + self._lease
+
+        while not self._stop_renewing.wait(self._lease / 3):
+            self._update(renew)
+
+    def _release(self) -> None:
+        self._stop_renewing.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+
+        def release(state: Dict[str, Any]) -> None:
+            for key in ("holders", "queue"):
+                state[key] = [e for e in state[key] if e["id"] != self._id]
+
+        self._update(release)
+        self._id = None
+
+    def lock(self, description, exclusive, **_kwargs) -> None:
+        self._acquire(description, exclusive, None)
+
+    def unlock(self, **_kwargs) -> None:
+        if self._id is not None:
+            self._release()
+        elif not self._used:
+
+            def clear(state: Dict[str, Any]) -> None:
+                for e in state["holders"]:
+                    sys.stderr.write(
+                        "releasing lock held by {0}\n".format(_describe(e))
+                    )
+                state["holders"] = []
+
+            self._update(clear)
+
+    def lock_resources(self, description, resources, **_kwargs) -> None:
+        if self._resource_locking:
+            self._acquire(description, False, resources)
+        else:
+            self._acquire(description, True, None)
+
+    def unlock_resources(self, resources, **_kwargs) -> None:
+        self.unlock()
@@ -21,3 +21,9 @@ class NoopLock(LockDriver[NoopLockOptions]):
 
     def lock(self, description, exclusive, **_kwargs) -> None:
         pass
+
+    def unlock_resources(self, resources, **_kwargs) -> None:
+        pass
+
+    def lock_resources(self, description, resources, **_kwargs) -> None:
+        pass
@@ -0,0 +1,194 @@
+"""
+Following Nix builds through its structured log.
+
+With ‘--log-format internal-json’, Nix writes each log event to stderr
+as a line ‘@nix {json}’: activities (building a derivation, substituting
+a path, downloading or copying it) that start, report results such as
+progress or build output, and stop, as well as plain messages.
+Activities turns this stream back into the text Nix would have printed
+and keeps track of what was built and substituted, how long each took
+and how many bytes were substituted, for a live progress summary and a
+build report.
+"""
+
+import json
+import re
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+LOG_FLAGS = ["--log-format", "internal-json"]
+
+# Activity types.
+ACT_COPY_PATH = 100
+ACT_FILE_TRANSFER = 101
+ACT_BUILD = 105
+ACT_SUBSTITUTE = 108
+
+# Result types.
+RES_BUILD_LOG_LINE = 101
+RES_PROGRESS = 105
+
+_failed = re.compile(r"builder for '(/nix/store/[^']+\.drv)' failed")
+
+
+@dataclass
+class Step:
+    """A derivation being built or a path being substituted."""
+
+    # "build" or "substitute".
+    kind: str
+    path: str
+    # The machine building the derivation (None if local), or the
+    # substituter the path comes from.
+    source: Optional[str]
+    # Seconds since the Activities started.
+    start: float
+    stop: Optional[float] = None
+    # Bytes substituted.
+    size: int = 0
+    failed: bool = False
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(
+            path=self.path,
+            source=self.source,
+            start=round(self.start, 3),
+            duration=None if self.stop is None else round(self.stop - self.start, 3),
+            size=self.size,
+            failed=self.failed,
+        )
+
+
+class Activities:
+    """The state of the Nix activities seen on one or more log streams."""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self._clock = clock
+        self._origin = clock()
+        self.started = datetime.now(timezone.utc)
+        self._lock = threading.Lock()
+        self.steps: List[Step] = []
+        # Steps, and the activities copying or downloading for them, by
+        # activity ID.  IDs are unique per Nix process, so ‘feed’ takes a
+        # stream name to tell processes apart.
+        self._steps: Dict[Any, Step] = {}
+        self._parents: Dict[Any, Any] = {}
+
+    def _now(self) -> float:
+        return self._clock() - self._origin
+
+    def feed(self, line: str, stream: Any = None) -> Optional[str]:
+        """
+        Process a line of Nix's stderr, and return the text to show for
+        it, if any.  Lines that are not structured are returned as is.
+        """
+        line = line.rstrip("\n")
+        if not line.startswith("@nix "):
+            return line
+        try:
+            event = json.loads(line[5:])
+        except ValueError:
+            return line
+        with self._lock:
+            return self._handle(event, stream)
+
+    def _handle(self, event: Dict[str, Any], stream: Any) -> Optional[str]:
+        action = event.get("action")
+        key = (stream, event.get("id"))
+        step: Optional[Step] = None
+        if action == "msg":
+            msg = str(event.get("msg", ""))
+            m = _failed.search(msg)
+            if m is not None:
+                for s in self.steps:
+                    if s.kind == "build" and s.path == m.group(1):
+                        s.failed = True
+            return msg
+        if action == "start":
+            kind = event.get("type")
+            fields = event.get("fields", [])
+            if kind == ACT_BUILD and fields:
+                step = Step("build", fields[0], fields[1] or None, self._now())
+            elif kind == ACT_SUBSTITUTE and fields:
+                step = Step(
+                    "substitute",
+                    fields[0],
+                    fields[1] if len(fields) > 1 else None,
+                    self._now(),
+                )
+            if step is not None:
+                self.steps.append(step)
+                self._steps[key] = step
+            elif kind in (ACT_COPY_PATH, ACT_FILE_TRANSFER):
+                self._parents[key] = (stream, event.get("parent"))
+            return str(event["text"]) if event.get("text") else None
+        if action == "result":
+            kind = event.get("type")
+            fields = event.get("fields", [])
+            if kind == RES_BUILD_LOG_LINE and fields:
+                return str(fields[0])
+            if kind == RES_PROGRESS and fields and key in self._parents:
+                step = self._step_of(key)
+                if step is not None and step.kind == "substitute":
+                    step.size = max(step.size, int(fields[0]))
+            return None
+        if action == "stop":
+            step = self._steps.pop(key, None)
+            if step is not None:
+                step.stop = self._now()
+            self._parents.pop(key, None)
+        return None
+
+    def _step_of(self, key: Any) -> Optional[Step]:
+        """The step that activity ‘key’ is (indirectly) part of."""
+        seen = 0
+        while key in self._parents and seen < 10:
+            key = self._parents[key]
+            seen += 1
+        return self._steps.get(key)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            builds = [s for s in self.steps if s.kind == "build"]
+            substitutions = [s for s in self.steps if s.kind == "substitute"]
+            return dict(
+                built=sum(1 for s in builds if s.stop is not None and not s.failed),
+                failed=sum(1 for s in builds if s.failed),
+                substituted=sum(1 for s in substitutions if s.stop is not None),
+                substituted_size=sum(s.size for s in substitutions),
+                running=sum(1 for s in self.steps if s.stop is None),
+                build_time=round(
+                    sum(s.stop - s.start for s in builds if s.stop is not None), 3
+                ),
+            )
+
+    def status(self) -> str:
+        """A one-line summary of the progress so far."""
+        s = self.summary()
+        return (
+            "{built} built, {failed} failed, {substituted} substituted"
+            " ({0:.1f} MiB), {running} running".format(
+                s["substituted_size"] / (1024 * 1024), **s
+            )
+        )
+
+    def report(self, slowest: int = 10) -> Dict[str, Any]:
+        """A machine-readable report of all steps."""
+        summary = self.summary()
+        with self._lock:
+            builds = [s for s in self.steps if s.kind == "build"]
+            finished = [s for s in builds if s.stop is not None]
+            finished.sort(key=lambda s: s.start - (s.stop or s.start))
+            return dict(
+                started=self.started.isoformat(),
+                duration=round(self._now(), 3),
+                summary=summary,
+                slowest=[s.path for s in finished[:slowest]],
+                builds=[s.as_dict() for s in builds],
+                substitutions=[
+                    s.as_dict() for s in self.steps if s.kind == "substitute"
+                ],
+            )
@@ -39,8 +39,18 @@ WorkerResult = Tuple[
 
 
 def run_tasks(  # noqa: C901
-    nr_workers: int, tasks: Iterable[Task], worker_fun: Callable[[Task], Result]
+    nr_workers: int,
+    tasks: Iterable[Task],
+    worker_fun: Callable[[Task], Result],
+    next_task: Optional[Callable[[int], Optional[Task]]] = None,
 ) -> List[Result]:
+    """
+    Run ‘worker_fun’ on each of ‘tasks’ in ‘nr_workers’ threads (or one
+    per task if -1), in order.  With ‘next_task’, worker ‘i’ (counting
+    from 0) instead runs the tasks that next_task(i) returns, until it
+    returns None; it is called with a lock held, and must hand out each
+    of ‘tasks’ exactly once.
+    """
     task_queue: queue.Queue[Task] = queue.Queue()
     result_queue: queue.Queue[WorkerResult[Result]] = queue.Queue()
 
@@ -57,12 +67,22 @@ def run_tasks(  # noqa: C901
     if nr_workers < 1:
         raise Exception("number of worker threads must be at least 1")
 
-    def thread_fun() -> None:
+    next_lock = threading.Lock()
+
+    def take(worker: int) -> Optional[Task]:
+        if next_task is not None:
+            with next_lock:
+                return next_task(worker)
+        try:
+            return task_queue.get(False)
+        except queue.Empty:
+            return None
+
+    def thread_fun(worker: int) -> None:
         n = 0
         while True:
-            try:
-                t = task_queue.get(False)
-            except queue.Empty:
+            t = take(worker)
+            if t is None:
                 break
             n = n + 1
             work_result: WorkerResult[Result]
@@ -76,7 +96,7 @@ def run_tasks(  # noqa: C901
 
     threads = []
     for n in range(nr_workers):
-        thr = threading.Thread(target=thread_fun)
+        thr = threading.Thread(target=thread_fun, args=(n,))
         thr.daemon = True
         thr.start()
         threads.append(thr)
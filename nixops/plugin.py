@@ -5,6 +5,7 @@ from nixops.storage.memory import MemoryBackend
 import nixops.plugins
 from nixops.locks import LockDriver
 from nixops.locks.noop import NoopLock
+from nixops.locks.file import FileLock
 from typing import Dict, Type
 
 
@@ -13,7 +14,7 @@ class InternalPlugin(nixops.plugins.Plugin):
         return {"legacy": LegacyBackend, "memory": MemoryBackend}
 
     def lock_drivers(self) -> Dict[str, Type[LockDriver]]:
-        return {"noop": NoopLock}
+        return {"noop": NoopLock, "file": FileLock}
 
 
 @nixops.plugins.hookimpl
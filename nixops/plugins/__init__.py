@@ -7,27 +7,43 @@ from argparse import ArgumentParser, _SubParsersAction
 from nixops.storage import StorageBackend
 from nixops.locks import LockDriver
 from typing import Generator
+import importlib.metadata
+import threading
 import pluggy  # type: ignore
 import nixops
+import nixops.cache
 
 
 hookimpl = pluggy.HookimplMarker("nixops")
 """Marker to be imported and used in plugins (and for own implementations)"""
 
+# The plugin manager and the plugins are created once per process.
+_plugin_manager: Optional[pluggy.PluginManager] = None
+_plugins: Tuple[Plugin, ...] = ()
+_plugins_lock = threading.Lock()
+
 
 def get_plugin_manager() -> pluggy.PluginManager:
+    global _plugin_manager, _plugins
     from . import hookspecs
 
-    pm = pluggy.PluginManager("nixops")
-    pm.add_hookspecs(hookspecs)
-    pm.load_setuptools_entrypoints("nixops")
-    return pm
+    with _plugins_lock:
+        if _plugin_manager is None:
+            pm = pluggy.PluginManager("nixops")
+            pm.add_hookspecs(hookspecs)
+            for name, value in nixops.cache.entry_points("nixops"):
+                if pm.get_plugin(name) or pm.is_blocked(name):
+                    continue
+                ep = importlib.metadata.EntryPoint(name, value, "nixops")
+                pm.register(ep.load(), name=name)
+            _plugins = tuple(pm.hook.plugin())
+            _plugin_manager = pm
+        return _plugin_manager
 
 
 def get_plugins() -> Generator[Plugin, None, None]:
-    pm = get_plugin_manager()
-    for plugin in pm.hook.plugin():
-        yield plugin
+    get_plugin_manager()
+    yield from _plugins
 
 
 class DeploymentHooks:
@@ -85,7 +101,17 @@ class Plugin:
 
     def parser(self, parser: ArgumentParser, subparsers: _SubParsersAction) -> None:
         """
-        Extend the core nixops cli parser
+        Extend the core nixops cli parser, e.g. with new subcommands.
+        If any plugin implements this, the parsers of all the core
+        subcommands are built before it is called, so use
+        ‘subcommand_parser’ to add options to a core subcommand.
+        """
+        pass
+
+    def subcommand_parser(self, name: str, subparser: ArgumentParser) -> None:
+        """
+        Extend the parser of the core subcommand ‘name’.  This is only
+        called for the subcommand on the command line.
         """
         pass
 
@@ -98,6 +124,14 @@ class Plugin:
     def lock_drivers(self) -> Dict[str, Type[LockDriver]]:
         return {}
 
+    def resource_types(self) -> List[type]:
+        """
+        Register resource definition and state classes explicitly,
+        rather than relying on them being found in the class hierarchy
+        :return a list of ResourceDefinition and ResourceState subclasses
+        """
+        return []
+
     def storage_backends(self) -> Dict[str, Type[StorageBackend]]:
         """Extend the core nixops cli parser
         :return a set of plugin parser extensions
@@ -7,8 +7,9 @@ from argparse import ArgumentParser, _SubParsersAction
 
 from nixops.storage import StorageBackend
 from nixops.locks import LockDriver
-from . import get_plugins, MachineHooks, DeploymentHooks
+from . import get_plugins, MachineHooks, DeploymentHooks, Plugin
 import nixops.ansi
+import nixops.registry
 import nixops
 from typing import Type
 import sys
@@ -66,6 +67,12 @@ class PluginManager:
                     importlib.import_module(mod)
                 seen.add(mod)
 
+        for plugin in get_plugins():
+            for resource_type in plugin.resource_types():
+                nixops.registry.register_resource_type(resource_type)
+        # The imported modules may have defined new resource types.
+        nixops.registry.invalidate_types()
+
     @staticmethod
     def nixexprs() -> List[str]:
         nixexprs: List[str] = []
@@ -78,6 +85,16 @@ class PluginManager:
         for plugin in get_plugins():
             plugin.parser(parser, subparsers)
 
+    @staticmethod
+    def extends_parser() -> bool:
+        """Return whether any plugin implements the ‘parser’ hook."""
+        return any(type(plugin).parser is not Plugin.parser for plugin in get_plugins())
+
+    @staticmethod
+    def subcommand_parser(name: str, subparser: ArgumentParser) -> None:
+        for plugin in get_plugins():
+            plugin.subcommand_parser(name, subparser)
+
     @staticmethod
     def docs() -> Generator[Tuple[str, str], None, None]:
         for plugin in get_plugins():
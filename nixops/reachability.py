@@ -0,0 +1,214 @@
+"""
+A shared prober that waits for hosts to become reachable or unreachable
+on a TCP port.
+
+Machines waiting for a host to come up or go down (e.g. in ‘nixops
+reboot --wait’) register with the prober, which probes all of them from
+a single thread with non-blocking connects in one selector loop, rather
+than running an SSH client per machine per second.  Each host is probed
+with its own exponential backoff.
+"""
+
+import errno
+import selectors
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Seconds to wait for a connection attempt to complete.
+CONNECT_TIMEOUT = 1.0
+# Bounds of the delay between two probes of the same host, in seconds.
+MIN_DELAY = 0.1
+MAX_DELAY = 2.0
+
+Address = Tuple[str, int]
+
+
+@dataclass
+class HostStatus:
+    """What the prober knows about a host."""
+
+    # Whether the port accepted a connection on the last probe, or None
+    # if the host was never probed.
+    up: Optional[bool] = None
+    # Wall-clock times of the transitions to up and down, oldest first.
+    up_since: List[float] = field(default_factory=list)
+    down_since: List[float] = field(default_factory=list)
+
+
+class _Probe:
+    __slots__ = ("address", "family", "want_up", "event", "delay", "next_at", "sock")
+
+    def __init__(self, address: Address, family: int, want_up: bool) -> None:
+        self.address = address
+        self.family = family
+        self.want_up = want_up
+        self.event = threading.Event()
+        self.delay = MIN_DELAY
+        self.next_at = 0.0
+        # The socket of the connection attempt in progress, and when it
+        # times out.
+        self.sock: Optional[Tuple[socket.socket, float]] = None
+
+
+class Prober:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._probes: List[_Probe] = []
+        self._status: Dict[Address, HostStatus] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+
+    def status(self, host: str, port: int) -> HostStatus:
+        with self._lock:
+            return self._status.setdefault((host, port), HostStatus())
+
+    def wait(
+        self,
+        host: str,
+        port: int,
+        up: bool,
+        timeout: Optional[float] = None,
+        callback: Optional[Callable[[], None]] = None,
+        confirm: Optional[Callable[[], bool]] = None,
+    ) -> bool:
+        """
+        Wait until ‘host’ accepts connections on ‘port’ (if ‘up’) or
+        stops doing so.  If ‘confirm’ is given, it is called once the
+        port is in the wanted state, and waiting continues unless it
+        returns true.  ‘callback’ is called about once a second while
+        waiting.  Return whether the host reached the wanted state
+        within ‘timeout’ seconds.
+        """
+        family = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][0]
+        start = time.monotonic()
+
+        def expired() -> bool:
+            return timeout is not None and time.monotonic() - start >= timeout
+
+        while True:
+            probe = _Probe((host, port), family, up)
+            self._add(probe)
+            try:
+                while not probe.event.wait(1):
+                    if expired():
+                        return False
+                    if callback:
+                        callback()
+            finally:
+                self._remove(probe)
+            if confirm is None or confirm():
+                return True
+            if expired():
+                return False
+
+    def _add(self, probe: _Probe) -> None:
+        with self._lock:
+            self._probes.append(probe)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wake()
+
+    def _remove(self, probe: _Probe) -> None:
+        with self._lock:
+            if probe in self._probes:
+                self._probes.remove(probe)
+            self._close(probe)
+
+    def _wake(self) -> None:
+        try:
+            self._wake_w.send(b"x")
+        except BlockingIOError:
+            pass
+
+    def _close(self, probe: _Probe) -> None:
+        if probe.sock is not None:
+            (sock, _) = probe.sock
+            self._selector.unregister(sock)
+            sock.close()
+            probe.sock = None
+
+    def _record(self, address: Address, up: bool) -> None:
+        status = self._status.setdefault(address, HostStatus())
+        if status.up != up:
+            (status.up_since if up else status.down_since).append(time.time())
+        status.up = up
+
+    def _finish(self, probe: _Probe, up: bool) -> None:
+        """Handle the outcome of a connection attempt."""
+        self._close(probe)
+        self._record(probe.address, up)
+        if up == probe.want_up:
+            self._probes.remove(probe)
+            probe.event.set()
+        else:
+            probe.delay = min(probe.delay * 2, MAX_DELAY)
+            probe.next_at = time.monotonic() + probe.delay
+
+    def _connect(self, probe: _Probe) -> None:
+        sock = socket.socket(probe.family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(probe.address)
+        if err in (errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK):
+            probe.sock = (sock, time.monotonic() + CONNECT_TIMEOUT)
+            self._selector.register(sock, selectors.EVENT_WRITE, probe)
+        else:
+            sock.close()
+            self._finish(probe, err == 0)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._probes:
+                    self._thread = None
+                    return
+                now = time.monotonic()
+                for probe in list(self._probes):
+                    if probe.sock is None and probe.next_at <= now:
+                        self._connect(probe)
+                deadlines = [
+                    probe.sock[1] if probe.sock is not None else probe.next_at
+                    for probe in self._probes
+                ]
+            timeout = max(0.0, min(deadlines, default=now + MAX_DELAY) - now)
+
+            events = self._selector.select(timeout)
+
+            with self._lock:
+                for (key, _) in events:
+                    if key.fileobj is self._wake_r:
+                        try:
+                            while self._wake_r.recv(1024):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        continue
+                    probe = key.data
+                    if probe not in self._probes or probe.sock is None:
+                        continue
+                    (sock, _) = probe.sock
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    self._finish(probe, err == 0)
+                now = time.monotonic()
+                for probe in list(self._probes):
+                    if probe.sock is not None and probe.sock[1] <= now:
+                        self._finish(probe, False)
+
+
+_prober: Optional[Prober] = None
+_prober_lock = threading.Lock()
+
+
+def get_prober() -> Prober:
+    global _prober
+    with _prober_lock:
+        if _prober is None:
+            _prober = Prober()
+        return _prober
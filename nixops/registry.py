@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import sys
+import threading
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    TYPE_CHECKING,
+    Union,
+)
+
+import nixops.ansi
+
+if TYPE_CHECKING:
+    from nixops.resources import GenericResourceState
+
+
+class ResourceRegistry(Dict[str, "GenericResourceState"]):
+    """
+    The resources of a deployment, by name.
+
+    This is a dict that also maintains indexes of its resources: by type,
+    whether they are machines, whether they are obsolete and by index.
+    The obsolete flag and index of a resource live in the state file, so
+    reading them is expensive; the registry reads them once, when a
+    resource is added, and is told about later changes by the resource
+    once they are committed (see ResourceState._set_attrs()).
+
+    Resources may be changed or deleted by parallel workers, so updates
+    of the indexes are serialised.  They read the state file before
+    taking the lock, so that they never wait for the state file while
+    holding it.
+    """
+
+    def __init__(self, resources: Iterable[Tuple[str, GenericResourceState]] = ()):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._obsolete: Dict[str, bool] = {}
+        self._index: Dict[str, Optional[int]] = {}
+        self._by_type: Dict[str, Dict[str, GenericResourceState]] = {}
+        self._machines: Dict[str, GenericResourceState] = {}
+        self._by_index: Dict[int, Dict[str, GenericResourceState]] = {}
+        self._max_index: Optional[int] = None
+        # Names by resource object identity.
+        self._names: Dict[int, str] = {}
+        # Cached views, dropped on any change.
+        self._active: Optional[Dict[str, GenericResourceState]] = None
+        self._active_machines: Optional[Dict[str, GenericResourceState]] = None
+        for name, r in resources:
+            self[name] = r
+
+    def _add(
+        self,
+        name: str,
+        r: GenericResourceState,
+        obsolete: bool,
+        index: Optional[int],
+    ) -> None:
+        import nixops.deployment
+
+        self._names[id(r)] = name
+        self._obsolete[name] = obsolete
+        self._set_index(name, r, index)
+        self._by_type.setdefault(r.get_type(), {})[name] = r
+        if nixops.deployment.is_machine(r):
+            self._machines[name] = r
+        self._invalidate()
+
+    def _remove(self, name: str) -> None:
+        r = super().__getitem__(name)
+        del self._names[id(r)]
+        del self._obsolete[name]
+        self._set_index(name, r, None)
+        del self._index[name]
+        of_type = self._by_type[r.get_type()]
+        del of_type[name]
+        if not of_type:
+            del self._by_type[r.get_type()]
+        self._machines.pop(name, None)
+        self._invalidate()
+
+    def _set_index(
+        self, name: str, r: GenericResourceState, index: Optional[int]
+    ) -> None:
+        old = self._index.get(name)
+        if old is not None:
+            with_old = self._by_index[old]
+            del with_old[name]
+            if not with_old:
+                del self._by_index[old]
+                if old == self._max_index:
+                    self._max_index = None
+        self._index[name] = index
+        if index is not None:
+            self._by_index.setdefault(index, {})[name] = r
+            if self._max_index is not None and index > self._max_index:
+                self._max_index = index
+
+    def _invalidate(self) -> None:
+        self._active = None
+        self._active_machines = None
+
+    def __setitem__(self, name: str, r: GenericResourceState) -> None:
+        (obsolete, index) = (r.obsolete, r.index)
+        with self._lock:
+            if name in self:
+                self._remove(name)
+            super().__setitem__(name, r)
+            self._add(name, r, obsolete, index)
+
+    def __delitem__(self, name: str) -> None:
+        with self._lock:
+            self._remove(name)
+            super().__delitem__(name)
+
+    _missing = object()
+
+    def pop(self, name: str, default: Any = _missing) -> Any:
+        with self._lock:
+            if name not in self:
+                if default is self._missing:
+                    raise KeyError(name)
+                return default
+            r = self[name]
+            del self[name]
+            return r
+
+    def popitem(self) -> Tuple[str, GenericResourceState]:
+        name = next(reversed(self.keys()))
+        return name, self.pop(name)
+
+    def setdefault(self, name: str, default: Any = None) -> Any:
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for name, r in dict(*args, **kwargs).items():
+            self[name] = r
+
+    def clear(self) -> None:
+        for name in list(self):
+            del self[name]
+
+    def resource_changed(self, r: GenericResourceState, attrs: Iterable[str]) -> None:
+        """Update the indexes after attributes of ‘r’ changed in the state file."""
+        attrs = set(attrs)
+        obsolete = r.obsolete if "obsolete" in attrs else None
+        index = r.index if "index" in attrs else None
+        with self._lock:
+            name = self._names.get(id(r))
+            if name is None:
+                return
+            if obsolete is not None:
+                self._obsolete[name] = obsolete
+                self._invalidate()
+            if "index" in attrs:
+                self._set_index(name, r, index)
+
+    def is_obsolete(self, name: str) -> bool:
+        return self._obsolete[name]
+
+    def active(self) -> Dict[str, GenericResourceState]:
+        """The resources that are not obsolete.  Do not modify the result."""
+        with self._lock:
+            if self._active is None:
+                self._active = {n: r for n, r in self.items() if not self._obsolete[n]}
+            return self._active
+
+    def machines(self) -> Dict[str, GenericResourceState]:
+        """The machines, in the order they were added."""
+        with self._lock:
+            return {n: r for n, r in self.items() if n in self._machines}
+
+    def active_machines(self) -> Dict[str, GenericResourceState]:
+        """The machines that are not obsolete.  Do not modify the result."""
+        with self._lock:
+            if self._active_machines is None:
+                self._active_machines = {
+                    n: r for n, r in self.active().items() if n in self._machines
+                }
+            return self._active_machines
+
+    def of_type(self, type_name: str) -> Mapping[str, GenericResourceState]:
+        return self._by_type.get(type_name, {})
+
+    def with_index(self, index: int) -> Mapping[str, GenericResourceState]:
+        return self._by_index.get(index, {})
+
+    def next_free_index(self) -> int:
+        """Return the lowest index above the index of every resource."""
+        with self._lock:
+            if not self._by_index:
+                return 0
+            if self._max_index is None:
+                self._max_index = max(self._by_index)
+            return self._max_index + 1
+
+
+def resource_changed(r: Any, attrs: Union[Iterable[str], Mapping[str, Any]]) -> None:
+    """Tell the registry of the deployment of ‘r’ that attributes of ‘r’ changed."""
+    registry = getattr(getattr(r, "depl", None), "resources", None)
+    if isinstance(registry, ResourceRegistry):
+        registry.resource_changed(r, attrs)
+
+
+# Resource types registered explicitly, and a counter that is bumped
+# whenever the set of resource types may have changed.
+_explicit_types: List[type] = []
+_generation = 0
+
+
+def invalidate_types() -> None:
+    """Make the type registries look for resource types again."""
+    global _generation
+    _generation += 1
+
+
+def register_resource_type(cls: type) -> None:
+    """
+    Register a ResourceDefinition or ResourceState subclass explicitly.
+    It takes precedence over any class found in the class hierarchy with
+    the same type name.
+    """
+    if cls not in _explicit_types:
+        _explicit_types.append(cls)
+        invalidate_types()
+
+
+def _leaf_subclasses(cls: type) -> List[type]:
+    sub: List[type] = cls.__subclasses__()
+    return [cls] if not sub else [g for s in sub for g in _leaf_subclasses(s)]
+
+
+class TypeRegistry:
+    """
+    The classes implementing each resource type, by type name: the
+    explicitly registered subclasses of ‘base’, and otherwise the
+    subclasses of ‘base’ that have no subclasses of their own.
+
+    The registry is built on first use and rebuilt when new types are
+    registered, plugins are loaded, or a type name is not found.
+    """
+
+    def __init__(self, base: type, get_type: Callable[[Any], str]) -> None:
+        self._base = base
+        self._get_type = get_type
+        self._types: Dict[str, type] = {}
+        self._generation: Optional[int] = None
+        self._warned: Set[Tuple[str, type, type]] = set()
+
+    def _type_name(self, cls: type) -> Optional[str]:
+        try:
+            return self._get_type(cls)
+        except NotImplementedError:
+            return None
+
+    def _build(self) -> None:
+        types: Dict[str, type] = {}
+        for cls in _leaf_subclasses(self._base):
+            name = self._type_name(cls)
+            if name is None:
+                continue
+            other = types.get(name)
+            if other is None:
+                types[name] = cls
+            elif (name, other, cls) not in self._warned:
+                self._warned.add((name, other, cls))
+                sys.stderr.write(
+                    nixops.ansi.ansi_warn(
+                        "resource type ‘{0}’ is implemented by both {1} and {2}; "
+                        "using the former\n".format(
+                            name, other.__qualname__, cls.__qualname__
+                        )
+                    )
+                )
+
+        explicit: Dict[str, type] = {}
+        for cls in _explicit_types:
+            # Not issubclass(), which is not supported by some protocols.
+            if self._base not in cls.__mro__:
+                continue
+            name = self._type_name(cls)
+            if name is None:
+                raise Exception(
+                    "cannot register {0}, which has no type name".format(
+                        cls.__qualname__
+                    )
+                )
+            other = explicit.get(name)
+            if other is not None and other is not cls:
+                raise Exception(
+                    "resource type ‘{0}’ is registered by both {1} and {2}".format(
+                        name, other.__qualname__, cls.__qualname__
+                    )
+                )
+            explicit[name] = cls
+
+        types.update(explicit)
+        self._types = types
+        self._generation = _generation
+
+    def get(self, type_name: str) -> Optional[type]:
+        if self._generation != _generation:
+            self._build()
+        cls = self._types.get(type_name)
+        if cls is None:
+            # It may have been defined since the registry was built.
+            self._build()
+            cls = self._types.get(type_name)
+        return cls
+
+    def types(self) -> Dict[str, type]:
+        if self._generation != _generation:
+            self._build()
+        return dict(self._types)
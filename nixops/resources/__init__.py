@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import re
+import nixops.registry
 import nixops.util
 from threading import Event
 from nixops.monkey import Protocol, runtime_checkable
@@ -18,7 +19,7 @@ from typing import (
     Set,
 )
 from nixops.state import StateDict, RecordId
-from nixops.diff import Diff, Handler
+from nixops.diff import Diff, Handler, Plan
 from nixops.util import ImmutableMapping, ImmutableValidatedObject
 from nixops.logger import MachineLogger
 from typing_extensions import Literal
@@ -171,6 +172,10 @@ class ResourceState(Protocol[ResourceDefinitionType]):
                         "insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
                         (self.id, n, v),
                     )
+            names = list(attrs)
+            self.depl._db.after_commit(
+                lambda: nixops.registry.resource_changed(self, names)
+            )
 
     def _set_attr(self, name: str, value: Any) -> None:
         """Update one machine attribute in the state file."""
@@ -183,6 +188,9 @@ class ResourceState(Protocol[ResourceDefinitionType]):
                 "delete from ResourceAttrs where machine = ? and name = ?",
                 (self.id, name),
             )
+            self.depl._db.after_commit(
+                lambda: nixops.registry.resource_changed(self, [name])
+            )
 
     def _get_attr(self, name: str, default=nixops.util.undefined) -> Any:
         """Get a machine attribute from the state file."""
@@ -386,33 +394,49 @@ class DiffEngineResourceState(
         for handler in diff_engine.plan():
             handler.handle(allow_recreate)
 
-    def plan(self, defn: ResourceDefinitionType) -> None:
+    def plan(self, defn: ResourceDefinitionType) -> Optional[Plan]:
         if hasattr(self, "_state"):
             diff_engine = self.setup_diff_engine(defn)
-            diff_engine.plan(show=True)
+            plan: Plan = diff_engine.get_plan(show=True)
+            return plan
         else:
             self.logger.warn(
                 "resource type {} doesn't implement a plan operation".format(
                     self.get_type()
                 )
             )
+            return None
 
     def setup_diff_engine(self, defn: ResourceDefinitionType):
+        # Plan on a copy of the state, read in one go, rather than on the
+        # state file (see Deployment.state_snapshot()).
+        snapshot = self.depl.current_state_snapshot()
         diff_engine = Diff(
             depl=self.depl,
             logger=self.logger,
             defn=defn,
-            state=self._state,
+            state=(
+                snapshot.state(self.id)
+                if snapshot is not None
+                else self._state.snapshot()
+            ),
             res_type=self.get_type(),
+            snapshot=snapshot,
         )
         diff_engine.set_reserved_keys(self._reserved_keys)
         diff_engine.set_handlers(self.get_handlers())
         return diff_engine
 
     def get_handlers(self):
-        return [
-            getattr(self, h) for h in dir(self) if isinstance(getattr(self, h), Handler)
-        ]
+        handlers = []
+        for h in dir(self):
+            # Skip properties, which read the state file.
+            if isinstance(getattr(type(self), h, None), property):
+                continue
+            value = getattr(self, h)
+            if isinstance(value, Handler):
+                handlers.append(value)
+        return handlers
 
     def get_defn(self) -> ResourceDefinitionType:
         return self.depl.get_typed_definition(
@@ -0,0 +1,235 @@
+"""
+Scheduling the copies of closures to machines.
+
+Copies are run by a fixed number of workers.  Handing them out in the
+order of the machines lets a large copy to a slow machine that happens
+to come last dominate the total time.  Instead, the expected duration
+of each copy is estimated from the size of what it transfers and the
+throughput seen for the machine in earlier runs, and the copies are
+assigned to the workers longest first, each to the least loaded worker.
+A worker that runs out of copies takes (steals) the smallest remaining
+copy of the worker with the most remaining work, so that bad estimates
+do not leave workers idle.
+"""
+
+import collections
+import heapq
+import json
+import os
+import statistics
+import threading
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Generic,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    TypeVar,
+)
+
+import nixops.parallel
+import nixops.cache
+import nixops.util
+
+# Throughput assumed for machines without history, if no machine has any.
+DEFAULT_THROUGHPUT = 10 * 1024 * 1024
+
+# Weight of the newest measurement in the throughput of a machine.
+SMOOTHING = 0.5
+
+Task = TypeVar("Task")
+Result = TypeVar("Result")
+
+
+class ThroughputHistory:
+    """
+    The throughput, in bytes per second, of earlier copies to each host,
+    kept in NixOps' cache directory.
+    """
+
+    def __init__(self, path: Optional[str]) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._rates: Dict[str, float] = self._read()
+        self._updated: Dict[str, float] = {}
+
+    @classmethod
+    def load(cls) -> "ThroughputHistory":
+        """Load the history, or start an unsaved one if caching is disabled."""
+        cache_dir = nixops.cache.cache_dir("throughput")
+        return cls(os.path.join(cache_dir, "copy.json") if cache_dir else None)
+
+    def _read(self) -> Dict[str, float]:
+        if self._path is None:
+            return {}
+        try:
+            with open(self._path) as f:
+                rates = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {
+            k: float(v)
+            for k, v in rates.items()
+            if isinstance(v, (int, float)) and v > 0
+        }
+
+    def get(self, host: str) -> Optional[float]:
+        with self._lock:
+            return self._rates.get(host)
+
+    def record(self, host: str, size: int, seconds: float) -> None:
+        """Record that copying ‘size’ bytes to ‘host’ took ‘seconds’."""
+        if size <= 0 or seconds <= 0:
+            return
+        rate = size / seconds
+        with self._lock:
+            old = self._rates.get(host)
+            if old is not None:
+                rate = SMOOTHING * rate + (1 - SMOOTHING) * old
+            self._rates[host] = self._updated[host] = rate
+
+    def estimate(self, host: str, size: int) -> float:
+        """The expected number of seconds to copy ‘size’ bytes to ‘host’."""
+        with self._lock:
+            rate = self._rates.get(host)
+            if rate is None:
+                # Assume an unknown host is a typical one.
+                rate = (
+                    statistics.median(self._rates.values())
+                    if self._rates
+                    else DEFAULT_THROUGHPUT
+                )
+        return size / rate
+
+    def save(self) -> None:
+        """
+        Write the updated rates, keeping those written by others since.
+        The history is only a cache, so failing to write it is ignored.
+        """
+        if self._path is None or not self._updated:
+            return
+        with self._lock:
+            rates = self._read()
+            rates.update(self._updated)
+            nixops.cache.write_cache_file(self._path, json.dumps(rates, indent=2))
+
+
+def lpt_assign(
+    tasks: Sequence[Task], cost: Callable[[Task], float], nr_workers: int
+) -> List[List[Task]]:
+    """
+    Assign ‘tasks’ to ‘nr_workers’ workers, longest processing time
+    first: each task, in order of decreasing cost, goes to the worker
+    with the least work so far.  Ties keep the order of ‘tasks’.
+    """
+    costs = [cost(t) for t in tasks]
+    assigned: List[List[Task]] = [[] for _ in range(nr_workers)]
+    loads = [(0.0, i) for i in range(nr_workers)]
+    order = sorted(range(len(tasks)), key=lambda i: -costs[i])
+    for i in order:
+        (load, w) = heapq.heappop(loads)
+        assigned[w].append(tasks[i])
+        heapq.heappush(loads, (load + costs[i], w))
+    return assigned
+
+
+class Schedule(Generic[Task]):
+    """
+    Per-worker queues of tasks, assigned longest processing time first,
+    with work stealing.  The cost of each task is computed once, up
+    front, as it may change while the tasks run.  Not thread-safe.
+    """
+
+    def __init__(
+        self, tasks: Sequence[Task], cost: Callable[[Task], float], nr_workers: int
+    ) -> None:
+        self._tasks = list(tasks)
+        self._costs = [cost(t) for t in self._tasks]
+        # The queues hold indexes into ‘_tasks’.
+        self._queues: List[Deque[int]] = [
+            collections.deque(q)
+            for q in lpt_assign(
+                range(len(self._tasks)), lambda i: self._costs[i], nr_workers
+            )
+        ]
+        self._remaining = [sum(self._costs[i] for i in q) for q in self._queues]
+        # Number of tasks taken from other workers' queues.
+        self.steals = 0
+
+    def next(self, worker: int) -> Optional[Task]:
+        """The next task for ‘worker’, or None if all tasks were handed out."""
+        if self._queues[worker]:
+            i = self._queues[worker].popleft()
+            self._remaining[worker] -= self._costs[i]
+            return self._tasks[i]
+        victim = max(range(len(self._queues)), key=lambda w: self._remaining[w])
+        if not self._queues[victim]:
+            return None
+        i = self._queues[victim].pop()
+        self._remaining[victim] -= self._costs[i]
+        self.steals += 1
+        return self._tasks[i]
+
+
+def run_tasks(
+    nr_workers: int,
+    tasks: Iterable[Task],
+    worker_fun: Callable[[Task], Result],
+    cost: Callable[[Task], float],
+) -> List[Result]:
+    """
+    Like nixops.parallel.run_tasks(), but run the tasks in the order of
+    a Schedule according to their estimated ‘cost’.
+    """
+    task_list = list(tasks)
+    if not task_list:
+        return []
+    if nr_workers == -1 or nr_workers > len(task_list):
+        nr_workers = len(task_list)
+    if nr_workers < 1:
+        raise Exception("number of worker threads must be at least 1")
+    schedule = Schedule(task_list, cost, nr_workers)
+    return nixops.parallel.run_tasks(
+        nr_workers, task_list, worker_fun, next_task=schedule.next
+    )
+
+
+def simulate(
+    tasks: Sequence[Task],
+    duration: Callable[[Task], float],
+    nr_workers: int,
+    cost: Optional[Callable[[Task], float]] = None,
+) -> float:
+    """
+    Return how long running ‘tasks’ that take ‘duration’ seconds each
+    would take with ‘nr_workers’ workers.  With ‘cost’ (an estimate of
+    the duration), they are run in the order of a Schedule; otherwise in
+    the order given, like nixops.parallel.run_tasks() does.
+    """
+    nr_workers = min(nr_workers, len(tasks))
+    if nr_workers == 0:
+        return 0.0
+    schedule: Optional[Schedule[Task]] = (
+        Schedule(tasks, cost, nr_workers) if cost is not None else None
+    )
+    pending = collections.deque(tasks)
+
+    def next_task(worker: int) -> Optional[Task]:
+        if schedule is not None:
+            return schedule.next(worker)
+        return pending.popleft() if pending else None
+
+    # (time at which the worker becomes free, worker)
+    free = [(0.0, w) for w in range(nr_workers)]
+    makespan = 0.0
+    while free:
+        (now, w) = heapq.heappop(free)
+        task = next_task(w)
+        if task is None:
+            makespan = max(makespan, now)
+            continue
+        heapq.heappush(free, (now + duration(task), w))
+    return makespan
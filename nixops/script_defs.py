@@ -7,7 +7,6 @@ from nixops.locks import LockDriver, LockInterface
 
 import contextlib
 import nixops.statefile
-import prettytable  # type: ignore
 from argparse import ArgumentParser, _SubParsersAction, Namespace
 import os
 import pwd
@@ -17,21 +16,37 @@ import subprocess
 import nixops.parallel
 import nixops.util
 import nixops.known_hosts
+import nixops.transfer
 import time
 import logging
 import logging.handlers
 import json
 from tempfile import TemporaryDirectory
 import shlex
-from typing import Tuple, List, Optional, Union, Generator, Type, Set, Sequence
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Tuple,
+    List,
+    Optional,
+    Union,
+    Generator,
+    Type,
+    Set,
+    Sequence,
+)
 import nixops.ansi
 
 from nixops.plugins.manager import PluginManager
+from nixops.args import add_subparser, add_common_deployment_options  # noqa: F401
 
 from nixops.plugins import get_plugin_manager
 from nixops.evaluation import eval_network, NetworkEval, NixEvalError, NetworkFile
 from nixops.backends import MachineDefinition
 
+if TYPE_CHECKING:
+    import prettytable  # type: ignore
+
 
 PluginManager.load()
 
@@ -67,9 +82,14 @@ def set_common_depl(depl: nixops.deployment.Deployment, args: Namespace) -> None
 
 @contextlib.contextmanager
 def deployment(
-    args: Namespace, writable: bool, activityDescription: str
+    args: Namespace,
+    writable: bool,
+    activityDescription: str,
+    resources: Sequence[str] = (),
 ) -> Generator[nixops.deployment.Deployment, None, None]:
-    with network_state(args, writable, description=activityDescription) as sf:
+    with network_state(
+        args, writable, description=activityDescription, resources=resources
+    ) as sf:
         depl = open_deployment(sf, args)
         set_common_depl(depl, args)
         yield depl
@@ -97,8 +117,18 @@ def get_lock(network: NetworkEval) -> LockInterface:
 
 @contextlib.contextmanager
 def network_state(
-    args: Namespace, writable: bool, description: str, doLock: bool = True
+    args: Namespace,
+    writable: bool,
+    description: str,
+    doLock: bool = True,
+    resources: Sequence[str] = (),
 ) -> Generator[nixops.statefile.StateFile, None, None]:
+    """
+    Open the network's state file.  If ‘resources’ is non-empty, only
+    those resources are locked (for writing), provided the lock driver
+    and the storage backend support it; otherwise the whole network is
+    locked.
+    """
     network = eval_network(get_network_file(args))
     storage_backends = PluginManager.storage_backends()
     storage_class: Optional[Type[StorageBackend]] = storage_backends.get(
@@ -124,8 +154,20 @@ def network_state(
 
     with TemporaryDirectory("nixops") as statedir:
         statefile = statedir + "/state.nixops"
+        # Lock drivers not inheriting from LockDriver may lack the
+        # fine-grained methods.  Backends that upload a copy of the state
+        # file need the whole network locked, or the last writer would
+        # discard the changes of the others.
+        lock_resources = (
+            bool(resources)
+            and hasattr(lock, "lock_resources")
+            and getattr(storage, "concurrent_writers", False)
+        )
         if lock is not None:
-            lock.lock(description=description, exclusive=writable)
+            if lock_resources:
+                lock.lock_resources(description=description, resources=resources)
+            else:
+                lock.lock(description=description, exclusive=writable)
         try:
             storage.fetchToFile(statefile)
             if writable:
@@ -149,7 +191,10 @@ def network_state(
                     storage.uploadFromFile(statefile)
         finally:
             if lock is not None:
-                lock.unlock()
+                if lock_resources:
+                    lock.unlock_resources(resources=resources)
+                else:
+                    lock.unlock()
 
 
 def op_list_plugins(args: Namespace) -> None:
@@ -167,7 +212,9 @@ def op_list_plugins(args: Namespace) -> None:
     print(tbl)
 
 
-def create_table(headers: List[Tuple[str, str]]) -> prettytable.PrettyTable:
+def create_table(headers: List[Tuple[str, str]]) -> "prettytable.PrettyTable":
+    import prettytable  # type: ignore
+
     tbl = prettytable.PrettyTable([name for (name, align) in headers])
     for (name, align) in headers:
         tbl.align[name] = align
@@ -332,7 +379,7 @@ def op_info(args: Namespace) -> None:  # noqa: C901
             return "Revived"
         if d is None and m.obsolete:
             return "Obsolete"
-        if depl.configs_path != m.cur_configs_path:
+        if (depl.target_configs_path or depl.configs_path) != m.cur_configs_path:
             return "Outdated"
 
         return "Up-to-date"
@@ -614,7 +661,7 @@ def op_check(args: Namespace) -> None:  # noqa: C901
 
 
 def print_backups(depl, backups) -> None:
-    tbl = prettytable.PrettyTable(["Backup ID", "Status", "Info"])
+    tbl = create_table([("Backup ID", "c"), ("Status", "c"), ("Info", "c")])
     for k, v in sorted(backups.items(), reverse=True):
         tbl.add_row([k, v["status"], "\n".join(v["info"])])
     print(tbl)
@@ -697,7 +744,7 @@ def op_backup_status(args: Namespace) -> None:
 
 
 def op_restore(args: Namespace) -> None:
-    with deployment(args, True, "nixops restore") as depl:
+    with deployment(args, True, "nixops restore", resources=args.include or []) as depl:
         depl.restore(
             include=args.include or [],
             exclude=args.exclude or [],
@@ -707,7 +754,7 @@ def op_restore(args: Namespace) -> None:
 
 
 def op_deploy(args: Namespace) -> None:
-    with deployment(args, True, "nixops deploy") as depl:
+    with deployment(args, True, "nixops deploy", resources=args.include or []) as depl:
         if args.confirm:
             depl.logger.set_autoresponse("y")
         if args.evaluate_only:
@@ -728,12 +775,81 @@ def op_deploy(args: Namespace) -> None:
             allow_recreate=args.allow_recreate,
             force_reboot=args.force_reboot,
             max_concurrent_copy=args.max_concurrent_copy,
+            copy_method=args.copy_method,
+            tree_fanout=args.tree_fanout,
+            probe_closures=args.probe_closures,
+            adaptive_copy=args.adaptive_copy,
+            max_copy_bandwidth=args.max_copy_bandwidth,
             sync=not args.no_sync,
             always_activate=args.always_activate,
             repair=args.repair,
             dry_activate=args.dry_activate,
             max_concurrent_activate=args.max_concurrent_activate,
+            json_output=args.json,
+            distributed_build=args.distributed_build,
+            build_on_target=args.build_on_target,
+            build_per_machine=args.build_per_machine,
+            max_concurrent_build=args.max_concurrent_build,
         )
+        if args.dry_run:
+            print_transfer_estimates(depl.transfer_estimates, args.json)
+
+
+def print_transfer_estimates(
+    estimates: Dict[str, nixops.transfer.Estimate], json_output: bool
+) -> None:
+    if json_output:
+        for name, e in sorted(estimates.items()):
+            print(json.dumps(dict(machine=name, **e.as_dict()), sort_keys=True))
+        return
+
+    def mib(n: Optional[int]) -> str:
+        return "{0:.1f}".format(n / nixops.transfer.MiB) if n is not None else "?"
+
+    def count(n: Optional[int]) -> str:
+        return str(n) if n is not None else "?"
+
+    tbl = create_table(
+        [
+            ("Machine", "l"),
+            ("Paths", "r"),
+            ("MiB", "r"),
+            ("Builds", "r"),
+            ("Closure paths", "r"),
+            ("Closure MiB", "r"),
+            ("Free MiB", "r"),
+        ]
+    )
+    for name, e in sorted(estimates.items()):
+        tbl.add_row(
+            [
+                name + (" (!)" if e.insufficient_space else ""),
+                count(e.paths),
+                mib(e.size),
+                e.builds,
+                count(e.closure_paths),
+                mib(e.closure_size),
+                mib(e.free),
+            ]
+        )
+    known = [e for e in estimates.values() if e.size is not None]
+    unknown = sorted(name for name, e in estimates.items() if e.size is None)
+    if known:
+        tbl.add_row(
+            [
+                "total"
+                + (" (without {0})".format(", ".join(unknown)) if unknown else ""),
+                sum(e.paths or 0 for e in known),
+                mib(sum(e.size or 0 for e in known)),
+                sum(e.builds for e in known),
+                sum(e.closure_paths or 0 for e in known),
+                mib(sum(e.closure_size or 0 for e in known)),
+                "",
+            ]
+        )
+    print(tbl)
+    if estimates and not known:
+        raise Exception("cannot estimate the transfer to any machine")
 
 
 def op_send_keys(args: Namespace) -> None:
@@ -881,6 +997,8 @@ def op_unlock(args: Namespace) -> None:
 def op_import(args: Namespace) -> None:
     with network_state(args, True, "nixops import") as sf:
         existing = set(sf.query_deployments())
+        # Rewrite known_hosts once, rather than once per key.
+        keys = nixops.known_hosts.Batch()
 
         dump = json.loads(sys.stdin.read())
         for uuid, attrs in dump.items():
@@ -901,9 +1019,11 @@ def op_import(args: Namespace) -> None:
                         m, "public_host_key"
                     ):
                         if m.public_ipv4:
-                            nixops.known_hosts.add(m.public_ipv4, m.public_host_key)
+                            keys.add(m.public_ipv4, m.public_host_key)
                         if m.private_ipv4:
-                            nixops.known_hosts.add(m.private_ipv4, m.public_host_key)
+                            keys.add(m.private_ipv4, m.public_host_key)
+
+        keys.apply()
 
 
 def parse_machine(
@@ -1053,8 +1173,9 @@ def op_show_option(args: Namespace) -> None:
 def deployment_with_rollback(
     args: Namespace,
     activityDescription: str,
+    resources: Sequence[str] = (),
 ) -> Generator[nixops.deployment.Deployment, None, None]:
-    with deployment(args, True, activityDescription) as depl:
+    with deployment(args, True, activityDescription, resources=resources) as depl:
         if not depl.rollback_enabled:
             raise Exception(
                 "rollback is not enabled for this network; please set ‘network.enableRollback’ to ‘true’ and redeploy"
@@ -1089,7 +1210,9 @@ def op_delete_generation(args: Namespace) -> None:
 
 
 def op_rollback(args: Namespace) -> None:
-    with deployment_with_rollback(args, "nixops rollback") as depl:
+    with deployment_with_rollback(
+        args, "nixops rollback", resources=args.include or []
+    ) as depl:
         depl.rollback(
             generation=args.generation,
             include=args.include or [],
@@ -1098,6 +1221,11 @@ def op_rollback(args: Namespace) -> None:
             allow_reboot=args.allow_reboot,
             force_reboot=args.force_reboot,
             max_concurrent_copy=args.max_concurrent_copy,
+            copy_method=args.copy_method,
+            tree_fanout=args.tree_fanout,
+            probe_closures=args.probe_closures,
+            adaptive_copy=args.adaptive_copy,
+            max_copy_bandwidth=args.max_copy_bandwidth,
             max_concurrent_activate=args.max_concurrent_activate,
             sync=not args.no_sync,
         )
@@ -1127,22 +1255,10 @@ def op_copy_closure(args: Namespace) -> None:
         m.copy_closure_to(args.storepath)
 
 
-# Set up logging of all commands and output
+# Set up logging of all commands and output, except those whose
+# subcommand sets ‘syslog’ to False
 def setup_logging(args: Namespace) -> None:
-    if os.path.exists("/dev/log") and args.op not in [
-        op_ssh,
-        op_ssh_for_each,
-        op_scp,
-        op_mount,
-        op_info,
-        op_list_deployments,
-        op_list_generations,
-        op_backup_status,
-        op_show_console_output,
-        op_dump_nix_paths,
-        op_export,
-        op_show_physical,
-    ]:
+    if os.path.exists("/dev/log") and getattr(args, "syslog", True):
         # determine user
         try:
             user = subprocess.check_output(
@@ -1166,139 +1282,6 @@ def setup_logging(args: Namespace) -> None:
         nixops.util.TeeStdout()
 
 
-def add_subparser(
-    subparsers: _SubParsersAction, name: str, help: str
-) -> ArgumentParser:
-    subparser: ArgumentParser
-    subparser = subparsers.add_parser(name, help=help)
-    subparser.add_argument(
-        "--network",
-        dest="network_dir",
-        metavar="FILE",
-        default=os.getcwd(),
-        help="path to a directory containing either nixops.nix or flake.nix",
-    )
-    subparser.add_argument(
-        "--deployment",
-        "-d",
-        dest="deployment",
-        metavar="UUID_OR_NAME",
-        default=os.environ.get(
-            "NIXOPS_DEPLOYMENT", os.environ.get("CHARON_DEPLOYMENT", None)
-        ),
-        help="UUID or symbolic name of the deployment",
-    )
-    subparser.add_argument("--debug", action="store_true", help="enable debug output")
-    subparser.add_argument(
-        "--confirm",
-        action="store_true",
-        help="confirm dangerous operations; do not ask",
-    )
-
-    # Nix options that we pass along.
-    subparser.add_argument(
-        "-I",
-        nargs=1,
-        action="append",
-        dest="nix_path",
-        metavar="PATH",
-        help="append a directory to the Nix search path",
-    )
-    subparser.add_argument(
-        "--max-jobs",
-        "-j",
-        type=int,
-        metavar="N",
-        help="set maximum number of concurrent Nix builds",
-    )
-    subparser.add_argument(
-        "--cores",
-        type=int,
-        metavar="N",
-        help="sets the value of the NIX_BUILD_CORES environment variable in the invocation of builders",
-    )
-    subparser.add_argument(
-        "--keep-going", action="store_true", help="keep going after failed builds"
-    )
-    subparser.add_argument(
-        "--keep-failed",
-        "-K",
-        action="store_true",
-        help="keep temporary directories of failed builds",
-    )
-    subparser.add_argument(
-        "--show-trace",
-        action="store_true",
-        help="print a Nix stack trace if evaluation fails, or a python stack trace if nixops fails",
-    )
-    subparser.add_argument(
-        "--fallback", action="store_true", help="fall back on installation from source"
-    )
-    subparser.add_argument(
-        "--no-build-output",
-        action="store_true",
-        help="suppress output written by builders",
-    )
-    subparser.add_argument(
-        "--option",
-        nargs=2,
-        action="append",
-        dest="nix_options",
-        metavar=("NAME", "VALUE"),
-        help="set a Nix option",
-    )
-    subparser.add_argument(
-        "--read-only-mode",
-        action="store_true",
-        help="run Nix evaluations in read-only mode",
-    )
-
-    return subparser
-
-
-def add_common_deployment_options(subparser: ArgumentParser) -> None:
-    subparser.add_argument(
-        "--include",
-        nargs="+",
-        metavar="MACHINE-NAME",
-        help="perform deployment actions on the specified machines only",
-    )
-    subparser.add_argument(
-        "--exclude",
-        nargs="+",
-        metavar="MACHINE-NAME",
-        help="do not perform deployment actions on the specified machines",
-    )
-    subparser.add_argument(
-        "--check",
-        action="store_true",
-        help="do not assume that the recorded state is correct",
-    )
-    subparser.add_argument(
-        "--allow-reboot", action="store_true", help="reboot machines if necessary"
-    )
-    subparser.add_argument(
-        "--force-reboot", action="store_true", help="reboot machines unconditionally"
-    )
-    subparser.add_argument(
-        "--max-concurrent-copy",
-        type=int,
-        default=5,
-        metavar="N",
-        help="maximum number of concurrent nix-copy-closure processes",
-    )
-    subparser.add_argument(
-        "--max-concurrent-activate",
-        type=int,
-        default=-1,
-        metavar="N",
-        help="maximum number of concurrent machine activations",
-    )
-    subparser.add_argument(
-        "--no-sync", action="store_true", help="do not flush buffers to disk"
-    )
-
-
 def error(msg: str) -> None:
     sys.stderr.write(nixops.ansi.ansi_warn("error: ") + msg + "\n")
 
@@ -2,11 +2,80 @@ import json
 import collections
 import sqlite3
 import nixops.util
-from typing import Any, KeysView, List, Iterator, Tuple, NewType
+from typing import Any, Dict, KeysView, List, Iterator, Mapping, Tuple, NewType
 
 RecordId = NewType("RecordId", str)
 
 
+def _decode(value: str) -> Any:
+    try:
+        v = json.loads(value)
+        if isinstance(v, list):
+            v = tuple(v)
+        return v
+    except ValueError:
+        return value
+
+
+class StateSnapshot(Mapping[str, Any]):
+    """
+    A read-only copy of the attributes of a resource in the state file,
+    with the values decoded like StateDict does.
+    """
+
+    def __init__(self, rows: Dict[str, str]) -> None:
+        self.raw = rows
+        self._decoded: Dict[str, Any] = {}
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._decoded[key]
+        except KeyError:
+            pass
+        if key not in self.raw:
+            raise KeyError("couldn't find key {} in the state file".format(key))
+        value = self._decoded[key] = _decode(self.raw[key])
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.raw)
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+
+class DeploymentSnapshot:
+    """
+    A read-only copy of the attributes of all resources of a deployment,
+    read from the state file in one query.
+    """
+
+    def __init__(self, depl) -> None:
+        self._resources: Dict[RecordId, StateSnapshot] = {}
+        rows: Dict[RecordId, Dict[str, str]] = {}
+        with depl._db:
+            c = depl._db.cursor()
+            c.execute(
+                "select a.machine, a.name, a.value from ResourceAttrs a "
+                "join Resources r on r.id = a.machine where r.deployment = ?",
+                (depl.uuid,),
+            )
+            for (id, name, value) in c.fetchall():
+                rows.setdefault(id, {})[name] = value
+        self._resources = {id: StateSnapshot(attrs) for id, attrs in rows.items()}
+        # Resolved ‘res-’ references, see nixops.diff.Diff.
+        self.references: Dict[Tuple[str, str], Any] = {}
+
+    def state(self, id: RecordId) -> StateSnapshot:
+        """Return the attributes of the resource with the given id."""
+        return self._resources.get(id) or StateSnapshot({})
+
+    def attr(self, id: RecordId, name: str, default: Any, type: Any) -> Any:
+        """Return an attribute like nixops.util.attr_property would."""
+        value = self.state(id).raw.get(name, nixops.util.undefined)
+        return nixops.util.decode_attr(name, value, default, type)
+
+
 class StateDict(collections.abc.MutableMapping):
     """
     An implementation of a MutableMapping container providing
@@ -45,13 +114,7 @@ class StateDict(collections.abc.MutableMapping):
             )
             row: Tuple[str] = c.fetchone()
             if row is not None:
-                try:
-                    v = json.loads(row[0])
-                    if isinstance(v, list):
-                        v = tuple(v)
-                    return v
-                except ValueError:
-                    return row[0]
+                return _decode(row[0])
             raise KeyError("couldn't find key {} in the state file".format(key))
 
     def __delitem__(self, key: str) -> None:
@@ -79,3 +142,12 @@ class StateDict(collections.abc.MutableMapping):
 
     def __len__(self) -> int:
         return len(self.keys())
+
+    def snapshot(self) -> StateSnapshot:
+        """Return a copy of all attributes, read in one query."""
+        with self._db:
+            c = self._db.cursor()
+            c.execute(
+                "select name, value from ResourceAttrs where machine = ?", (self.id,)
+            )
+            return StateSnapshot(dict(c.fetchall()))
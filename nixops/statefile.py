@@ -6,7 +6,7 @@ import sqlite3
 import sys
 import threading
 import time
-from typing import Any, Optional, List, Type
+from typing import Any, Callable, Optional, List, Type
 from types import TracebackType
 import re
 
@@ -32,6 +32,7 @@ class Connection(sqlite3.Connection):
         self.db_file = file
         self.nesting = 0
         self.lock = threading.RLock()
+        self._after_commit: List[Callable[[], None]] = []
 
     # Implement Python's context management protocol so that "with db"
     # automatically commits or rolls back.  The difference with the
@@ -56,17 +57,38 @@ class Connection(sqlite3.Connection):
             self.must_rollback = True
         self.nesting = self.nesting - 1
         assert self.nesting >= 0
-        if self.nesting == 0:
-            if self.must_rollback:
-                try:
-                    self.rollback()
-                except sqlite3.ProgrammingError:
-                    pass
-            else:
-                sqlite3.Connection.__exit__(  # type: ignore
-                    self, exception_type, exception_value, exception_traceback
-                )
-        self.lock.release()
+        callbacks: List[Callable[[], None]] = []
+        try:
+            if self.nesting == 0:
+                (callbacks, self._after_commit) = (self._after_commit, [])
+                if self.must_rollback:
+                    try:
+                        self.rollback()
+                    except sqlite3.ProgrammingError:
+                        pass
+                else:
+                    sqlite3.Connection.__exit__(  # type: ignore
+                        self, exception_type, exception_value, exception_traceback
+                    )
+        finally:
+            self.lock.release()
+        # Outside the lock, so that callbacks may take other locks and
+        # then query the database.
+        for callback in callbacks:
+            callback()
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """
+        Call ‘callback’ when the outermost "with" ends, or right away
+        outside of one.  As the connection is in autocommit mode, the
+        statements executed before are committed by then, even if the
+        block failed, so ‘callback’ can rely on reading their effects.
+        """
+        with self.lock:
+            if self.nesting > 0:
+                self._after_commit.append(callback)
+                return
+        callback()
 
 
 def get_default_state_file() -> str:
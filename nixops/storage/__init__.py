@@ -16,6 +16,12 @@ able to integrate it.
 # StorageInterface type. It only matters for construction and clients don't have
 # to know about it.
 class StorageInterface(Protocol):
+    # concurrent_writers: whether several processes can write to the
+    # state at the same time, because the backend works on the state file
+    # in place instead of uploading a copy of it. Only then can a network
+    # be locked per resource (see LockInterface.lock_resources).
+    concurrent_writers: bool = False
+
     # fetchToFile: download the state file to the local disk.
     # Note: no arguments will be passed over kwargs. Making it part of
     # the type definition allows adding new arguments later.
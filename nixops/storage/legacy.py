@@ -13,6 +13,9 @@ class LegacyBackendOptions(ImmutableValidatedObject):
 class LegacyBackend(StorageBackend[LegacyBackendOptions]):
     __options = LegacyBackendOptions
 
+    # The state file is used in place, and SQLite serializes its writers.
+    concurrent_writers = True
+
     @staticmethod
     def options(**kwargs) -> LegacyBackendOptions:
         return LegacyBackendOptions(**kwargs)
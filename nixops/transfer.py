@@ -0,0 +1,790 @@
+"""
+Copying closures to many machines at once.
+
+nix-copy-closure serializes and compresses every store path once per
+target machine.  When many machines share most of their closure, that
+is mostly the same work over and over.  The fan-out transfer instead
+exports each missing store path once (with ‘nix-store --export’) into a
+cache, and streams the cached exports to every machine that lacks the
+path, where ‘nix-store --import’ reads them.
+
+The cache keeps exports in memory up to a limit, and spills the rest to
+files in the deployment's temporary directory.
+
+The tree transfer instead has the deployer copy each closure to a few
+machines, which then copy it to their peers (see tree_copy()).
+"""
+
+import collections
+import contextlib
+import io
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    TYPE_CHECKING,
+    Tuple,
+    Union,
+)
+
+import nixops.parallel
+
+if TYPE_CHECKING:
+    import nixops.backends
+
+# Bytes of exports to keep in memory before spilling them to disk.
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+MiB = 1024 * 1024
+
+# ‘nix-store --export’ writes each path preceded by the integer 1, and
+# ends the stream with the integer 0, both as 64-bit little endian.
+_END_OF_EXPORT = b"\0" * 8
+
+
+def _gzip() -> "zlib._Compress":
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+class _Budget:
+    """The memory still available for exports."""
+
+    def __init__(self, limit: int) -> None:
+        self._lock = threading.Lock()
+        self.available = limit
+
+    def take(self, n: int) -> bool:
+        with self._lock:
+            if n > self.available:
+                return False
+            self.available -= n
+            return True
+
+
+class Export:
+    """The export of a single store path, without the end marker."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.size = 0
+        self._data: Optional[io.BytesIO] = io.BytesIO()
+        self._file: Optional[str] = None
+        self._ready = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def _write(self, data: bytes, budget: _Budget, spill_dir: str) -> None:
+        if self._data is not None and not budget.take(len(data)):
+            # Spill to disk, and give back the memory we used.
+            self._file = os.path.join(
+                spill_dir, "export-" + os.path.basename(self.path)
+            )
+            with open(self._file, "wb") as f:
+                f.write(self._data.getbuffer())
+            budget.take(-self._data.tell())
+            self._data = None
+        if self._data is not None:
+            self._data.write(data)
+        else:
+            assert self._file is not None
+            with open(self._file, "ab") as f:
+                f.write(data)
+        self.size += len(data)
+
+    def wait(self) -> None:
+        self._ready.wait()
+        if self._error is not None:
+            raise Exception(
+                "cannot export ‘{0}’: {1}".format(self.path, self._error)
+            ) from self._error
+
+    def chunks(self) -> Iterator[bytes]:
+        self.wait()
+        if self._data is not None:
+            view = self._data.getbuffer()
+            for i in range(0, len(view), CHUNK_SIZE):
+                yield bytes(view[i : i + CHUNK_SIZE])
+        else:
+            assert self._file is not None
+            with open(self._file, "rb") as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+
+class ExportCache:
+    """
+    Exports of store paths, each made at most once, optionally
+    compressed as gzip members so that they can be concatenated.
+    """
+
+    def __init__(
+        self,
+        spill_dir: str,
+        compress: bool = True,
+        memory_limit: int = MEMORY_LIMIT,
+    ) -> None:
+        self._spill_dir = spill_dir
+        self.compress = compress
+        self._budget = _Budget(memory_limit)
+        self._lock = threading.Lock()
+        self._exports: Dict[str, Export] = {}
+        # Number of times each path was exported, for tests and reports.
+        self.exported: Dict[str, int] = {}
+
+    def get(self, path: str) -> Export:
+        """Return the export of ‘path’, exporting it if nobody did yet."""
+        with self._lock:
+            export = self._exports.get(path)
+            if export is not None:
+                return export
+            export = self._exports[path] = Export(path)
+            self.exported[path] = self.exported.get(path, 0) + 1
+        try:
+            self._export(export)
+        except BaseException as e:
+            export._error = e
+        finally:
+            export._ready.set()
+        return export
+
+    def prefetch(self, paths: Iterable[str]) -> threading.Thread:
+        """Export ‘paths’ in the background, in order."""
+
+        def worker() -> None:
+            for path in paths:
+                self.get(path)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        return thread
+
+    def _export(self, export: Export) -> None:
+        compressor = _gzip() if self.compress else None
+
+        def write(data: bytes) -> None:
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                export._write(data, self._budget, self._spill_dir)
+
+        with subprocess.Popen(
+            ["nix-store", "--export", export.path], stdout=subprocess.PIPE
+        ) as proc:
+            assert proc.stdout is not None
+            # Hold back the end marker.
+            tail = b""
+            while True:
+                chunk = proc.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                data = tail + chunk
+                write(data[:-8])
+                tail = data[-8:]
+        if proc.returncode != 0:
+            raise Exception("nix-store --export failed")
+        if tail != _END_OF_EXPORT:
+            raise Exception("unexpected end of nix-store --export output")
+        if compressor is not None:
+            export._write(compressor.flush(), self._budget, self._spill_dir)
+
+    def end_of_stream(self) -> bytes:
+        if self.compress:
+            compressor = _gzip()
+            return compressor.compress(_END_OF_EXPORT) + compressor.flush()
+        return _END_OF_EXPORT
+
+
+def _run_command(
+    machine: "nixops.backends.GenericMachineState", command: str, **kwargs: Any
+) -> Union[str, int]:
+    ssh = machine.get_ssh_for_copy_closure()
+    return ssh.run_command(command, user=machine.ssh_user, **kwargs)
+
+
+def query_requisites(paths: Sequence[str]) -> List[str]:
+    """The closure of ‘paths’, each path after its references."""
+    out = subprocess.check_output(
+        ["nix-store", "--query", "--requisites"] + list(paths), text=True
+    )
+    return out.split()
+
+
+def query_local_invalid(paths: Sequence[str]) -> Set[str]:
+    """The ‘paths’ that are not valid in the local store."""
+    if not paths:
+        return set()
+    out = subprocess.run(
+        ["nix-store", "--check-validity", "--print-invalid"] + list(paths),
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stdout
+    return set(out.split())
+
+
+def query_invalid(
+    machine: "nixops.backends.GenericMachineState", paths: Sequence[str]
+) -> Set[str]:
+    """The ‘paths’ that are not valid in the store of ‘machine’."""
+    if not paths:
+        return set()
+    # The paths are passed on stdin, as there may be too many for the
+    # command line.
+    with tempfile.TemporaryFile("w+") as f:
+        f.write("\n".join(paths) + "\n")
+        f.flush()
+        f.seek(0)
+        out = _run_command(
+            machine,
+            "xargs nix-store --check-validity --print-invalid",
+            capture_stdout=True,
+            stdin=f,
+        )
+    return set(str(out).split())
+
+
+def query_free_and_invalid(
+    machine: "nixops.backends.GenericMachineState", paths: Sequence[str]
+) -> Tuple[Optional[int], Set[str]]:
+    """
+    Return the free space in bytes of the file system holding the Nix
+    store of ‘machine’ (None if unknown), and which of ‘paths’ are not
+    valid there, with a single command.
+    """
+    with tempfile.TemporaryFile("w+") as f:
+        f.write("".join(p + "\n" for p in paths))
+        f.flush()
+        f.seek(0)
+        out = _run_command(
+            machine,
+            "df -Pk /nix/store | awk 'NR == 2 { print \"free:\" $4 }'; "
+            "xargs -r nix-store --check-validity --print-invalid",
+            capture_stdout=True,
+            stdin=f,
+        )
+    free: Optional[int] = None
+    invalid: Set[str] = set()
+    for line in str(out).split():
+        if line.startswith("free:"):
+            free = int(line[len("free:") :]) * 1024
+        else:
+            invalid.add(line)
+    return (free, invalid)
+
+
+@dataclass
+class DryRun:
+    """What realising a derivation would do."""
+
+    # The derivations that would be built.
+    builds: List[str] = field(default_factory=list)
+    # The paths that would be fetched from substituters, and their total
+    # download and unpacked (NAR) size in bytes.
+    fetches: List[str] = field(default_factory=list)
+    download: int = 0
+    unpacked: int = 0
+
+
+_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3, "TiB": 1024**4}
+
+# E.g. "these 2 paths will be fetched (1.50 MiB download, 6.00 MiB
+# unpacked):" or, in older versions of Nix, "these paths will be ...".
+_DRY_RUN_HEADER = re.compile(
+    r"(?:these (?:\d+ )?|this )(derivations?|paths?) will be (?:built|fetched)"
+    r"(?: \(([\d.]+) (\w+) download, ([\d.]+) (\w+) unpacked\))?:"
+)
+
+
+def parse_dry_run(output: str) -> DryRun:
+    """Parse the output of ‘nix-store --realise --dry-run’."""
+    result = DryRun()
+    current: Optional[List[str]] = None
+    for line in output.splitlines():
+        header = _DRY_RUN_HEADER.fullmatch(line.strip())
+        if header is not None:
+            if header.group(1).startswith("derivation"):
+                current = result.builds
+            else:
+                current = result.fetches
+                if header.group(2) is not None:
+                    result.download = int(
+                        float(header.group(2)) * _UNITS.get(header.group(3), 1)
+                    )
+                    result.unpacked = int(
+                        float(header.group(4)) * _UNITS.get(header.group(5), 1)
+                    )
+        elif current is not None and line.startswith("  /"):
+            current.append(line.strip())
+        else:
+            current = None
+    return result
+
+
+def dry_run_realise(drv: str) -> DryRun:
+    """What realising ‘drv’ locally would build and fetch."""
+    proc = subprocess.run(
+        ["nix-store", "--realise", "--dry-run", drv],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    return parse_dry_run(proc.stderr)
+
+
+@dataclass
+class Estimate:
+    """What copying a closure to a machine would transfer."""
+
+    # The paths and NAR size of the closure and of the part of it that the
+    # machine lacks, or None if unknown.  The closure of a configuration
+    # that is not built is unknown, and what the machine lacks of it is
+    # only estimated from the paths that would be fetched to build it.
+    closure_paths: Optional[int] = None
+    closure_size: Optional[int] = None
+    paths: Optional[int] = None
+    size: Optional[int] = None
+    # The number of derivations that would be built first, whose outputs
+    # are not included in ‘paths’ and ‘size’.
+    builds: int = 0
+    # Free bytes on the machine's Nix store, or None if unknown.
+    free: Optional[int] = None
+
+    @property
+    def insufficient_space(self) -> bool:
+        return self.free is not None and self.size is not None and self.size > self.free
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(
+            closure_paths=self.closure_paths,
+            closure_size=self.closure_size,
+            paths=self.paths,
+            size=self.size,
+            builds=self.builds,
+            free=self.free,
+            insufficient_space=self.insufficient_space,
+        )
+
+
+def estimate(
+    machines: Dict["nixops.backends.GenericMachineState", Optional[str]],
+    drvs: Mapping[str, str] = {},
+) -> Dict[str, Estimate]:
+    """
+    Estimate what copying each path in ‘machines’ to its machine would
+    transfer.  For paths that are not valid locally but have a derivation
+    in ‘drvs’, the estimate is based on what building them would fetch;
+    other paths (or None) cannot be estimated, but the free space of
+    their machines still is.  The machines are asked concurrently.
+    """
+    local = [p for p in set(machines.values()) if p is not None]
+    built = set(local) - query_local_invalid(local)
+    requisites = {p: query_requisites([p]) for p in built}
+    sizes = path_sizes(sorted({q for qs in requisites.values() for q in qs}))
+
+    dry_runs: Dict[str, DryRun] = {}
+    for path in local:
+        if path not in built and path in drvs:
+            try:
+                dry_runs[path] = dry_run_realise(drvs[path])
+            except subprocess.CalledProcessError:
+                pass
+
+    result: Dict[str, Estimate] = {}
+
+    def probe(m: "nixops.backends.GenericMachineState") -> None:
+        path = machines[m]
+        closure = requisites.get(path, []) if path is not None else []
+        unbuilt = dry_runs.get(path) if path is not None else None
+        e = Estimate()
+        try:
+            (e.free, invalid) = query_free_and_invalid(
+                m, unbuilt.fetches if unbuilt is not None else closure
+            )
+        except Exception as ex:
+            m.logger.warn("cannot query store paths and free space: {0}".format(ex))
+            result[m.name] = e
+            return
+        if path in built:
+            missing = [q for q in closure if q in invalid]
+            e.closure_paths = len(closure)
+            e.closure_size = sum(sizes[q] for q in closure)
+            e.paths = len(missing)
+            e.size = sum(sizes[q] for q in missing)
+        elif unbuilt is not None:
+            # Only the total size of the fetched paths is known.
+            missing = [q for q in unbuilt.fetches if q in invalid]
+            e.paths = len(missing)
+            e.size = (
+                unbuilt.unpacked * len(missing) // len(unbuilt.fetches)
+                if unbuilt.fetches
+                else 0
+            )
+            e.builds = len(unbuilt.builds)
+        result[m.name] = e
+
+    nixops.parallel.run_tasks(nr_workers=-1, tasks=iter(machines), worker_fun=probe)
+    return result
+
+
+def send(
+    machine: "nixops.backends.GenericMachineState",
+    cache: ExportCache,
+    paths: Sequence[str],
+) -> int:
+    """
+    Stream the exports of ‘paths’ to ‘machine’ and import them there.
+    Return the number of bytes sent.
+    """
+    (r, w) = os.pipe()
+    sent = 0
+    error: List[BaseException] = []
+
+    def writer() -> None:
+        nonlocal sent
+        try:
+            with os.fdopen(w, "wb") as f:
+                for path in paths:
+                    for chunk in cache.get(path).chunks():
+                        f.write(chunk)
+                        sent += len(chunk)
+                f.write(cache.end_of_stream())
+        except BaseException as e:
+            error.append(e)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    command = "nix-store --import"
+    if cache.compress:
+        command = "gzip -d | " + command
+    try:
+        with os.fdopen(r, "rb") as stdin:
+            _run_command(machine, command, stdin=stdin, capture_stdout=True)
+    finally:
+        thread.join()
+    if error and not isinstance(error[0], BrokenPipeError):
+        raise error[0]
+    return sent
+
+
+def fanout_copy(
+    machines: Dict["nixops.backends.GenericMachineState", str],
+    spill_dir: str,
+    nr_workers: int,
+    compress: bool = True,
+) -> Dict[str, int]:
+    """
+    Copy the closure of each path in ‘machines’ to its machine, exporting
+    every store path at most once.  Return the number of bytes sent to
+    each machine.
+    """
+    closures: Dict[str, List[str]] = {}
+    for path in set(machines.values()):
+        closures[path] = query_requisites([path])
+
+    missing: Dict[str, List[str]] = {}
+
+    def probe(m: "nixops.backends.GenericMachineState") -> None:
+        closure = closures[machines[m]]
+        invalid = query_invalid(m, closure)
+        missing[m.name] = [p for p in closure if p in invalid]
+
+    nixops.parallel.run_tasks(nr_workers=-1, tasks=iter(machines), worker_fun=probe)
+
+    # Export the paths needed by the most machines first.
+    counts: Dict[str, int] = {}
+    for paths in missing.values():
+        for p in paths:
+            counts[p] = counts.get(p, 0) + 1
+    cache = ExportCache(spill_dir, compress=compress)
+    cache.prefetch(sorted(counts, key=lambda p: -counts[p]))
+
+    sent: Dict[str, int] = {}
+
+    def copy(m: "nixops.backends.GenericMachineState") -> None:
+        paths = missing[m.name]
+        if not paths:
+            m.logger.log("closure already present")
+            sent[m.name] = 0
+            return
+        m.logger.log("importing {0} paths...".format(len(paths)))
+        sent[m.name] = send(m, cache, paths)
+
+    nixops.parallel.run_tasks(
+        nr_workers=nr_workers, tasks=iter(machines), worker_fun=copy
+    )
+    return sent
+
+
+@dataclass
+class Hop:
+    """A copy of a closure from one machine (or the deployer) to another."""
+
+    # The machine the closure was copied from, or None for the deployer.
+    source: Optional[str]
+    target: str
+    seconds: float
+    # The size of the closure, an upper bound of the bytes transferred.
+    size: int
+    # Whether copying from ‘source’ failed and the deployer copied it.
+    fell_back: bool = False
+
+    @property
+    def throughput(self) -> float:
+        return self.size / self.seconds if self.seconds > 0 else 0.0
+
+
+def path_sizes(paths: Sequence[str]) -> Dict[str, int]:
+    """The NAR size of each of ‘paths’."""
+    if not paths:
+        return {}
+    out = subprocess.check_output(
+        ["nix-store", "--query", "--size"] + list(paths), text=True
+    )
+    return dict(zip(paths, (int(n) for n in out.split())))
+
+
+def closure_size(path: str) -> int:
+    """The total NAR size of the closure of ‘path’."""
+    return sum(path_sizes(query_requisites([path])).values())
+
+
+@dataclass
+class Presence:
+    """What a machine already has of a closure."""
+
+    # Whether the top-level path, and hence its closure, is valid there.
+    present: bool
+    # The paths of the closure that are not, if probed.
+    missing: Optional[List[str]] = None
+
+
+def probe_presence(
+    machines: Dict["nixops.backends.GenericMachineState", str],
+    closures: bool = False,
+) -> Dict[str, Optional[Presence]]:
+    """
+    Ask every machine, concurrently and with one command each, whether
+    it has its path in ‘machines’, or with ‘closures’, which paths of its
+    closure it lacks.  The result is None for machines that could not be
+    asked.
+    """
+    requisites: Dict[str, List[str]] = {}
+    if closures:
+        for path in set(machines.values()):
+            requisites[path] = query_requisites([path])
+
+    result: Dict[str, Optional[Presence]] = {}
+
+    def probe(m: "nixops.backends.GenericMachineState") -> None:
+        path = machines[m]
+        try:
+            invalid = query_invalid(m, requisites.get(path, [path]))
+        except Exception as e:
+            m.logger.warn("cannot check which store paths are present: {0}".format(e))
+            result[m.name] = None
+            return
+        presence = Presence(present=path not in invalid)
+        if closures:
+            presence.missing = [p for p in requisites[path] if p in invalid]
+        result[m.name] = presence
+
+    nixops.parallel.run_tasks(nr_workers=-1, tasks=iter(machines), worker_fun=probe)
+    return result
+
+
+def build_tree(
+    names: Sequence[str], seeds: int, fanout: int
+) -> Dict[Optional[str], List[str]]:
+    """
+    Arrange ‘names’ in a tree, breadth first: the first ‘seeds’ are the
+    children of the root (None), and every other node has up to ‘fanout’
+    children.  Return the children of each node.
+    """
+    children: Dict[Optional[str], List[str]] = {None: list(names[:seeds])}
+    parents = collections.deque(names[:seeds])
+    for name in names[seeds:]:
+        parent = parents[0]
+        children.setdefault(parent, []).append(name)
+        if len(children[parent]) >= fanout:
+            parents.popleft()
+        parents.append(name)
+    return children
+
+
+def _peer_known_hosts(
+    machine: "nixops.backends.GenericMachineState", address: str
+) -> Optional[str]:
+    """The host keys of ‘machine’ in known_hosts format, for ‘address’."""
+    if machine.public_host_key:
+        return "{0} {1}".format(address, machine.public_host_key)
+    keys = machine.get_ssh_host_keys()
+    if keys is None:
+        return None
+    lines = [
+        address + " " + line.split(" ", 1)[1]
+        for line in keys.splitlines()
+        if " " in line and not line.startswith("#")
+    ]
+    return "\n".join(lines) if lines else None
+
+
+def peer_copy(
+    source: "nixops.backends.GenericMachineState",
+    target: "nixops.backends.GenericMachineState",
+    path: str,
+) -> None:
+    """
+    Copy the closure of ‘path’ from ‘source’ to ‘target’.  The source
+    logs in to the target with the deployer's forwarded SSH agent, and
+    only accepts the host key NixOps knows for the target.  Machines with
+    the same locality hint connect to each other's private address.
+    """
+    address: Optional[str] = None
+    hint = source.locality_hint()
+    if hint is not None and hint == target.locality_hint():
+        # Machines in the same network copy over it.
+        address = target.private_ipv4
+    if not address:
+        address = source.address_to(target)  # type: ignore
+    if not address:
+        raise Exception("no address of ‘{0}’".format(target.name))
+    known_hosts = _peer_known_hosts(target, address)
+    if known_hosts is None:
+        raise Exception("host key of ‘{0}’ is not known".format(target.name))
+    script = (
+        'f="$(mktemp)" && printf "%s\\n" {known_hosts} > "$f" && '
+        'NIX_SSHOPTS="-o UserKnownHostsFile=$f -o StrictHostKeyChecking=yes'
+        ' -o BatchMode=yes" nix-copy-closure --to {to} {path}; '
+        'rc=$?; rm -f "$f"; exit $rc'
+    ).format(
+        known_hosts=shlex.quote(known_hosts),
+        to=shlex.quote("{0}@{1}".format(target.ssh_user, address)),
+        path=shlex.quote(path),
+    )
+    ssh = source.get_ssh_for_copy_closure()
+    ssh.run_command(script, user=source.ssh_user, flags=["-A"])
+
+
+def tree_copy(
+    machines: Dict["nixops.backends.GenericMachineState", str],
+    nr_workers: int,
+    fanout: int,
+    seeds: int = 1,
+) -> List[Hop]:
+    """
+    Copy the closure of each path in ‘machines’ to its machine.  Machines
+    with the same path and locality hint get it from each other, in a
+    tree seeded by the deployer; others get it from the deployer.  If a
+    copy between machines fails, the deployer copies the closure
+    itself.  At most ‘nr_workers’ copies from the deployer run at a
+    time, fallbacks included.  Return the hops taken.
+    """
+    by_name = {m.name: m for m in machines}
+    groups: Dict[Any, List[str]] = {}
+    for m, path in machines.items():
+        hint = m.locality_hint()
+        key = (hint, path) if hint is not None else (m.name, path)
+        groups.setdefault(key, []).append(m.name)
+
+    children: Dict[Optional[str], List[str]] = {None: []}
+    for names in groups.values():
+        tree = build_tree(sorted(names), seeds, fanout)
+        children[None] += tree.pop(None)
+        children.update(tree)
+
+    sizes: Dict[str, int] = {}
+    sizes_lock = threading.Lock()
+
+    def size_of(path: str) -> int:
+        with sizes_lock:
+            if path not in sizes:
+                sizes[path] = closure_size(path)
+            return sizes[path]
+
+    hops: List[Hop] = []
+    direct_slots: ContextManager[Any] = (
+        threading.BoundedSemaphore(nr_workers)
+        if nr_workers > 0
+        else contextlib.nullcontext()
+    )
+
+    def distribute(
+        source: Optional["nixops.backends.GenericMachineState"],
+        m: "nixops.backends.GenericMachineState",
+    ) -> None:
+        path = machines[m]
+        start = time.monotonic()
+        fell_back = False
+        failed: Optional[Exception] = None
+        try:
+            if source is not None:
+                try:
+                    m.logger.log("copying closure from ‘{0}’...".format(source.name))
+                    peer_copy(source, m, path)
+                except Exception as e:
+                    m.logger.warn(
+                        "copying from ‘{0}’ failed ({1}), copying directly".format(
+                            source.name, e
+                        )
+                    )
+                    fell_back = True
+                    source = None
+            if source is None:
+                with direct_slots:
+                    start = time.monotonic()
+                    m.logger.log("copying closure...")
+                    m.copy_closure_to(path)
+        except Exception as e:
+            failed = e
+        else:
+            hop = Hop(
+                source=source.name if source is not None else None,
+                target=m.name,
+                seconds=time.monotonic() - start,
+                size=size_of(path),
+                fell_back=fell_back,
+            )
+            hops.append(hop)
+            m.logger.log(
+                "copied {0:.1f} MiB closure in {1:.1f}s ({2:.1f} MiB/s)".format(
+                    hop.size / MiB, hop.seconds, hop.throughput / MiB
+                )
+            )
+
+        # If this machine did not get the closure, its children get it
+        # from the deployer.
+        nixops.parallel.run_tasks(
+            nr_workers=fanout,
+            tasks=(by_name[c] for c in children.get(m.name, [])),
+            worker_fun=lambda c: distribute(m if failed is None else None, c),
+        )
+        if failed is not None:
+            raise failed
+
+    nixops.parallel.run_tasks(
+        nr_workers=nr_workers,
+        tasks=(by_name[c] for c in children[None]),
+        worker_fun=lambda m: distribute(None, m),
+    )
+    return hops
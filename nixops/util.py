@@ -15,8 +15,8 @@ import subprocess
 import logging
 import atexit
 import re
+import types
 import typing
-import typeguard  # type: ignore
 import shlex
 import collections.abc
 from inspect import isclass
@@ -87,21 +87,32 @@ V = TypeVar("V")
 class ImmutableMapping(Generic[K, V], Mapping[K, V]):
     """
     An immutable wrapper around dict's that also turns lists to tuples
+
+    The wrapped dict is shared, not copied, so it must not be modified
+    afterwards. Nested dicts and lists are converted when first accessed.
     """
 
     def __init__(self, base_dict: Dict):
-        def _transform_value(value: Any) -> Any:
-            if isinstance(value, list):
-                return tuple(_transform_value(i) for i in value)
-            elif isinstance(value, dict):
-                return self.__class__(value)
-            else:
-                return value
-
-        self._dict: Dict[K, V] = {k: _transform_value(v) for k, v in base_dict.items()}
+        self._dict: Dict[K, Any] = base_dict
+        # Converted nested values, by key.
+        self._converted: Dict[K, V] = {}
+
+    def _transform_value(self, value: Any) -> Any:
+        if isinstance(value, list):
+            return tuple(self._transform_value(i) for i in value)
+        elif isinstance(value, dict):
+            return self.__class__(value)
+        else:
+            return value
 
     def __getitem__(self, key: K) -> V:
-        return self._dict[key]
+        value: V = self._dict[key]
+        if isinstance(value, (list, dict)):
+            converted = self._converted.get(key)
+            if converted is None:
+                converted = self._converted[key] = self._transform_value(value)
+            return converted
+        return value
 
     def __iter__(self) -> Iterator[K]:
         return iter(self._dict)
@@ -116,7 +127,154 @@ class ImmutableMapping(Generic[K, V], Mapping[K, V]):
         return self[key]
 
     def __repr__(self) -> str:
-        return "<{} {}>".format(self.__class__.__name__, self._dict)
+        return "<{} {}>".format(self.__class__.__name__, dict(self.items()))
+
+
+class _Field:
+    """A compiled ImmutableValidatedObject attribute."""
+
+    __slots__ = ("ann", "default", "convert", "check")
+
+    def __init__(self, ann: Any, default: Any) -> None:
+        self.ann = ann
+        self.default = default
+        self.convert = _compile_converter(ann)
+        self.check = _compile_check(ann)
+
+    def validate(self, value: Any) -> Any:
+        if self.convert is not None:
+            value = self.convert(value)
+
+        # The fast check only accepts values that typeguard accepts too;
+        # typeguard has the final say (and the error message) otherwise.
+        if self.check is None or not self.check(value):
+            # typeguard is slow to import, so only do so when needed.
+            import typeguard  # type: ignore
+
+            typeguard.check_type(value, self.ann)
+
+        return value
+
+
+def _is_validated_object(ann: Any) -> bool:
+    return isclass(ann) and issubclass(ann, ImmutableValidatedObject)
+
+
+def _compile_converter(ann: Any) -> Optional[Callable[[Any], Any]]:
+    """
+    Return a function that converts nested dictionaries into the
+    ImmutableValidatedObject instances annotated by ‘ann’, or None if
+    there is nothing to convert.
+    """
+    if _is_validated_object(ann):
+        return lambda value: ann(**value)
+
+    # Support containers of ImmutableValidatedObjects
+    origin = typing.get_origin(ann)
+
+    if origin is collections.abc.Sequence:
+        subanns = [
+            subann if _is_validated_object(subann) else None
+            for subann in typing.get_args(ann)
+        ]
+        return lambda value: tuple(
+            v if subann is None else subann(**v) for v in value for subann in subanns
+        )
+
+    if origin is collections.abc.Mapping:
+        _, value_ann = typing.get_args(ann)
+        if _is_validated_object(value_ann):
+            return lambda value: {k: value_ann(**v) for k, v in value.items()}
+
+    return None
+
+
+def _compile_check(ann: Any) -> Optional[Callable[[Any], bool]]:
+    """
+    Return a cheap check for values of type ‘ann’, or None if there is
+    none. A value passing the check also passes typeguard.check_type(),
+    but not necessarily the other way around.
+    """
+    if ann is Any:
+        return lambda value: True
+
+    if ann in (None, types.NoneType):
+        return lambda value: value is None
+
+    origin = typing.get_origin(ann)
+    args = typing.get_args(ann)
+
+    if origin is None:
+        if not isclass(ann) or getattr(ann, "_is_protocol", False):
+            return None
+        try:
+            isinstance(None, ann)
+        except TypeError:
+            return None
+        return lambda value: isinstance(value, ann)
+
+    if origin in (Union, types.UnionType):
+        checks = [_compile_check(arg) for arg in args]
+        if any(check is None for check in checks):
+            return None
+        if len(checks) == 2:
+            # Most commonly Optional[...]
+            first, second = checks
+            return lambda value: first(value) or second(value)  # type: ignore
+        return lambda value: any(check(value) for check in checks)  # type: ignore
+
+    if origin is typing.Literal:
+        return lambda value: any(
+            value.__class__ is arg.__class__ and value == arg for arg in args
+        )
+
+    if origin in (collections.abc.Sequence, list):
+        if not args:
+            return lambda value: isinstance(value, origin)
+        item_check = _compile_check(args[0])
+        if item_check is None:
+            return None
+        return lambda value: isinstance(value, origin) and all(
+            item_check(v) for v in value  # type: ignore
+        )
+
+    if origin in (collections.abc.Mapping, dict):
+        if not args:
+            return lambda value: isinstance(value, origin)
+        key_check = _compile_check(args[0])
+        value_check = _compile_check(args[1])
+        if key_check is None or value_check is None:
+            return None
+        return lambda value: isinstance(value, origin) and all(
+            key_check(k) and value_check(v) for k, v in value.items()  # type: ignore
+        )
+
+    return None
+
+
+# The compiled fields of each ImmutableValidatedObject subclass.
+_schemas: Dict[type, Dict[str, _Field]] = {}
+
+
+def _schema(cls: type) -> Dict[str, _Field]:
+    schema = _schemas.get(cls)
+    if schema is None:
+        # Support inheritance
+        anno: Dict = {}
+        for x in reversed(cls.mro()):
+            anno.update(typing.get_type_hints(x))
+        anno.pop("_frozen", None)
+
+        # If a default value:
+        # class SomeSubClass(ImmutableValidatedObject):
+        #   x: int = 1
+        #
+        # is set this attribute is set on the class
+        schema = {
+            key: _Field(ann, getattr(cls, key, None)) for key, ann in anno.items()
+        }
+        _schemas[cls] = schema
+    return schema
 
 
 class ImmutableValidatedObject:
@@ -125,77 +283,39 @@ class ImmutableValidatedObject:
 
     It also converts nested dictionaries into new ImmutableValidatedObject
     instances (or the annotated subclass).
+
+    The type hints of each class are resolved and compiled into
+    converters and checks the first time it is instantiated.
     """
 
     _frozen: bool
 
     def __init__(self, *args: ImmutableValidatedObject, **kwargs):
 
-        kw = {}
-        for arg in args:
-            if not isinstance(arg, ImmutableValidatedObject):
-                raise TypeError("Arg not a Immutablevalidatedobject instance")
-            kw.update(dict(arg))
-        kw.update(kwargs)
+        kw = kwargs
+        if args:
+            kw = {}
+            for arg in args:
+                if not isinstance(arg, ImmutableValidatedObject):
+                    raise TypeError("Arg not a Immutablevalidatedobject instance")
+                kw.update(dict(arg))
+            kw.update(kwargs)
 
-        # Support inheritance
-        anno: Dict = {}
-        for x in reversed(self.__class__.mro()):
-            anno.update(typing.get_type_hints(x))
+        schema = _schema(self.__class__)
 
-        def _transform_value(key: Any, value: Any) -> Any:
-            ann = anno.get(key)
-
-            # Untyped, pass through
-            if not ann:
-                return value
-
-            if isclass(ann) and issubclass(ann, ImmutableValidatedObject):
-                value = ann(**value)
-
-            # Support containers of ImmutableValidatedObjects
-            match typing.get_origin(ann):
-
-                case collections.abc.Sequence:
-                    sequence: List = []
-                    for v in value:
-                        for subann in typing.get_args(ann):
-                            if isclass(subann) and issubclass(
-                                subann, ImmutableValidatedObject
-                            ):
-                                sequence.append(subann(**v))
-                            else:
-                                sequence.append(v)
-                    value = tuple(sequence)
-
-                case collections.abc.Mapping:
-                    _, value_ann = typing.get_args(ann)
-                    if isclass(value_ann) and issubclass(
-                        value_ann, ImmutableValidatedObject
-                    ):
-                        mapping: Dict = {}
-                        for k, v in value.items():
-                            mapping[k] = value_ann(**v)
-                        value = mapping
-
-            typeguard.check_type(value, ann)
+        values: Dict[str, Any] = {}
+        for key, field in schema.items():
+            values[key] = field.validate(kw.get(key, field.default))
 
-            return value
+        # Untyped, pass through
+        for key, value in kwargs.items():
+            if key not in values and key != "_frozen":
+                values[key] = value
 
-        for key in set(list(anno.keys()) + list(kwargs.keys())):
-            if key == "_frozen":
-                continue
-
-            # If a default value:
-            # class SomeSubClass(ImmutableValidatedObject):
-            #   x: int = 1
-            #
-            # is set this attribute is set on self before __init__ is called
-            default = getattr(self, key) if hasattr(self, key) else None
-            value = kw.get(key, default)
-            setattr(self, key, _transform_value(key, value))
-
-        self._frozen = True
+        # Bypass __setattr__, which is only there to keep the object
+        # immutable after this point.
+        self.__dict__.update(values)
+        self.__dict__["_frozen"] = True
 
     def __setattr__(self, name, value) -> None:
         if hasattr(self, "_frozen") and self._frozen:
@@ -230,7 +350,10 @@ class ImmutableValidatedObject:
 
 class NixopsEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, (ImmutableMapping, ImmutableValidatedObject)):
+        if isinstance(obj, ImmutableMapping):
+            # No need to convert the nested values just to encode them.
+            return obj._dict
+        if isinstance(obj, ImmutableValidatedObject):
             return dict(obj)
         return json.JSONEncoder.default(self, obj)
 
@@ -472,29 +595,33 @@ class Undefined:
 undefined = Undefined()
 
 
+def decode_attr(name: str, s: Any, default: Any, type: Optional[Any] = str) -> Any:
+    """Decode the value ‘s’ of an attr_property read from the state file."""
+    if s == undefined:
+        if default != undefined:
+            return copy.deepcopy(default)
+        raise Exception(
+            "deployment attribute ‘{0}’ missing from state file".format(name)
+        )
+    if s is None:
+        return None
+    elif type is str:
+        return s
+    elif type is int:
+        return int(s)
+    elif type is bool:
+        return True if s == "1" else False
+    elif type == "json":
+        return json.loads(s)
+    else:
+        assert False
+
+
 def attr_property(name: str, default: Any, type: Optional[Any] = str) -> Any:
     """Define a property that corresponds to a value in the NixOps state file."""
 
     def get(self) -> Any:
-        s: Any = self._get_attr(name, default)
-        if s == undefined:
-            if default != undefined:
-                return copy.deepcopy(default)
-            raise Exception(
-                "deployment attribute ‘{0}’ missing from state file".format(name)
-            )
-        if s is None:
-            return None
-        elif type is str:
-            return s
-        elif type is int:
-            return int(s)
-        elif type is bool:
-            return True if s == "1" else False
-        elif type == "json":
-            return json.loads(s)
-        else:
-            assert False
+        return decode_attr(name, self._get_attr(name, default), default, type)
 
     def set(self, x: Any) -> None:
         if x == default:
@@ -504,6 +631,9 @@ def attr_property(name: str, default: Any, type: Optional[Any] = str) -> Any:
         else:
             self._set_attr(name, x)
 
+    # Let snapshots of the state file (see nixops.state) decode it.
+    setattr(get, "attr_property", (name, default, type))
+
     return property(get, set)
 
 
@@ -0,0 +1,94 @@
+import subprocess
+import sys
+import unittest
+
+from typing import Any, List
+from unittest import mock
+
+from nixops.args import LazyOp, get_parser, parse_args
+
+
+def commands(argv: List[str]) -> Any:
+    return get_parser(argv)._subparsers._group_actions[0].choices  # type: ignore
+
+
+class ArgsTest(unittest.TestCase):
+    def test_lazy_op(self):
+        args = parse_args(["ssh", "machine", "--", "uptime"])
+        self.assertIsInstance(args.op, LazyOp)
+        self.assertEqual(args.op.__name__, "op_ssh")
+        self.assertEqual(args.machine, "machine")
+
+    def test_only_requested_command(self):
+        with mock.patch("nixops.args._have_plugins", return_value=False):
+            choices = commands(["ssh", "machine"])
+        self.assertEqual(list(choices), ["ssh"])
+
+    def test_plugin_options(self):
+        def subcommand_parser(name, subparser):
+            self.assertEqual(name, "deploy")
+            subparser.add_argument("--example", action="store_true")
+
+        manager = "nixops.plugins.manager.PluginManager"
+        with mock.patch("nixops.args._have_plugins", return_value=True), mock.patch(
+            manager + ".extends_parser", return_value=False
+        ), mock.patch(manager + ".subcommand_parser", side_effect=subcommand_parser):
+            self.assertEqual(list(commands(["deploy"])), ["deploy"])
+            args = parse_args(["deploy", "--example"])
+        self.assertTrue(args.example)
+
+    def test_plugin_parser_hook(self):
+        def parser(parser, subparsers):
+            subparsers.choices["deploy"].add_argument("--example", action="store_true")
+
+        manager = "nixops.plugins.manager.PluginManager"
+        with mock.patch("nixops.args._have_plugins", return_value=True), mock.patch(
+            manager + ".extends_parser", return_value=True
+        ), mock.patch(manager + ".parser", side_effect=parser), mock.patch(
+            manager + ".subcommand_parser"
+        ) as subcommand_parser:
+            args = parse_args(["deploy", "--example"])
+        self.assertTrue(args.example)
+        subcommand_parser.assert_called_once()
+
+    def test_syslog(self):
+        self.assertFalse(parse_args(["ssh", "machine"]).syslog)
+        self.assertFalse(hasattr(parse_args(["deploy"]), "syslog"))
+
+    def test_unknown_command(self):
+        with self.assertRaises(SystemExit):
+            parse_args(["no-such-command"])
+
+    def test_full_parser(self):
+        choices = commands(["--help"])
+        self.assertIn("deploy", choices)
+        self.assertIn("ssh-for-each", choices)
+
+    def test_parse_imports(self):
+        code = (
+            "import sys; from nixops.args import parse_args; "
+            "parse_args(['ssh', 'machine']); "
+            "print(' '.join(sys.modules))"
+        )
+        modules = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout.split()
+        for module in ["nixops.script_defs", "nixops.deployment", "typeguard"]:
+            self.assertNotIn(module, modules)
+
+    def test_build_on_target_conflicts(self):
+        args = parse_args(["deploy", "--build-on-target", "--include", "a"])
+        self.assertTrue(args.build_on_target)
+        for option in [
+            ["--adaptive-copy"],
+            ["--copy-method", "tree"],
+            ["--distributed-build"],
+        ]:
+            with self.assertRaises(SystemExit):
+                parse_args(["deploy", "--build-on-target"] + option)
+
+    def test_json_requires_plan_or_dry_run(self):
+        with self.assertRaises(SystemExit):
+            parse_args(["deploy", "--json"])
+        self.assertTrue(parse_args(["deploy", "--plan-only", "--json"]).json)
+        self.assertTrue(parse_args(["deploy", "--dry-run", "--json"]).json)
@@ -0,0 +1,130 @@
+import socket
+import threading
+import time
+import unittest
+from typing import List, Tuple
+from unittest import mock
+
+import nixops.bandwidth
+from nixops.bandwidth import (
+    MiB,
+    Controller,
+    RTTSampler,
+    Ticket,
+    link_options,
+    measure_rtt,
+)
+
+
+class ControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        clock = mock.patch.object(nixops.bandwidth.time, "monotonic", lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def round(self, controller, seconds, size=MiB, **kwargs):
+        """Run as many copies as allowed, each taking ‘seconds’."""
+        tickets = [controller.acquire() for _ in range(int(controller.limit))]
+        for ticket in tickets:
+            self.now += seconds / len(tickets)
+            controller.release(ticket, size, **kwargs)
+
+    def simulate(self, controller, copies, capacity, per_copy):
+        """
+        Run ‘copies’ copies of 1 MiB over a link of ‘capacity’ bytes per
+        second, each getting at most ‘per_copy’ of it.  Return the largest
+        number of copies that ran at the same time.
+        """
+        running: List[Tuple[Ticket, float]] = []
+        started = 0
+        peak = 0
+        while started < copies or running:
+            while started < copies and len(running) < int(controller.limit):
+                running.append((controller.acquire(), float(MiB)))
+                started += 1
+            peak = max(peak, len(running))
+            rate = min(per_copy, capacity / len(running))
+            (ticket, left) = min(running, key=lambda r: r[1])
+            self.now += left / rate
+            running = [(t, n - left) for (t, n) in running if t is not ticket]
+            controller.release(ticket, MiB)
+        return peak
+
+    def test_increase(self):
+        controller = Controller(5)
+        self.assertEqual(controller.limit, 2)
+        self.simulate(controller, 100, capacity=100 * MiB, per_copy=MiB)
+        self.assertEqual(controller.limit, 5)
+        self.assertEqual(controller.limits, [2, 3, 4, 5])
+
+    def test_failure(self):
+        controller = Controller(8)
+        self.simulate(controller, 200, capacity=100 * MiB, per_copy=MiB)
+        self.assertEqual(controller.limit, 8)
+        self.round(controller, 1.0, ok=False)
+        # All copies of the round failed, but they count as one signal.
+        self.assertEqual(controller.limit, 4)
+
+    def test_rtt(self):
+        controller = Controller(8)
+        for _ in range(4):
+            ticket = controller.acquire()
+            self.now += 1.0
+            controller.release(ticket, MiB, rtt=0.02, base_rtt=0.01)
+        limit = controller.limit
+        self.assertGreater(limit, 2)
+        ticket = controller.acquire()
+        self.now += 1.0
+        controller.release(ticket, MiB, rtt=0.1, base_rtt=0.01)
+        self.assertLess(controller.limit, limit)
+
+    def test_bandwidth_cap(self):
+        controller = Controller(8, bandwidth_cap=3 * MiB)
+        self.simulate(controller, 200, capacity=100 * MiB, per_copy=MiB)
+        self.assertLessEqual(int(controller.limit), 3)
+        self.assertLessEqual(max(controller.limits), 4)
+
+    def test_wait(self):
+        controller = Controller(1)
+        ticket = controller.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            controller.acquire()
+            acquired.set()
+
+        threading.Thread(target=acquire, daemon=True).start()
+        self.assertFalse(acquired.wait(0.1))
+        controller.release(ticket, MiB)
+        self.assertTrue(acquired.wait(5))
+
+
+class LinkTest(unittest.TestCase):
+    def test_link_options(self):
+        self.assertEqual(link_options(None, True), (False, False))
+        self.assertEqual(link_options(None, False), (True, True))
+        self.assertEqual(link_options(100 * MiB, False), (False, False))
+        self.assertEqual(link_options(10 * MiB, True), (True, False))
+        self.assertEqual(link_options(1 * MiB, True), (True, True))
+
+    def test_measure_rtt(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        address = server.getsockname()
+        rtt = measure_rtt(address)
+        self.assertIsNotNone(rtt)
+        server.close()
+        self.assertIsNone(measure_rtt(address))
+
+    def test_rtt_sampler(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(16)
+        self.addCleanup(server.close)
+        with RTTSampler(server.getsockname(), interval=0.05) as sampler:
+            time.sleep(0.3)
+        self.assertIsNotNone(sampler.baseline)
+        self.assertGreater(len(sampler.samples), 1)
+        self.assertIsNotNone(sampler.rtt)
@@ -0,0 +1,198 @@
+import contextlib
+import os
+import subprocess
+import tempfile
+import unittest
+from types import SimpleNamespace
+from typing import Any, List, Optional
+from unittest import mock
+
+import nixops.deployment
+import nixops.scheduling
+import nixops.statefile
+
+
+class FakeMachine:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.new_toplevel: Optional[str] = None
+        self.copied: List[str] = []
+        self.commands: List[str] = []
+        self.logger = SimpleNamespace(log=lambda msg: None, error=lambda msg: None)
+        self.state: Optional[str] = None
+        self.RESCUE = "rescue"
+
+    @contextlib.contextmanager
+    def pinned_ssh_flags(self):
+        yield
+
+    def copy_closure_to(self, path: str, use_substitutes: Any = None) -> None:
+        self.copied.append(path)
+
+    def run_command(
+        self, command: str, capture_stdout: bool = False, check: bool = True
+    ) -> str:
+        self.commands.append(command)
+        return "/nix/store/{0}-nixos-system\n".format(self.name)
+
+    def send_keys(self) -> None:
+        pass
+
+    def switch_to_configuration(self, method: str, sync: bool, command: str) -> int:
+        self.commands.append(command + " " + method)
+        return 0
+
+    def success(self, msg: str) -> None:
+        pass
+
+
+class BuildTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        statefile = nixops.statefile.StateFile(
+            os.path.join(self.dir.name, "state.nixops"), writable=True
+        )
+        self.addCleanup(statefile.close)
+        self.depl = statefile.create_deployment()
+        self.machines = {n: FakeMachine(n) for n in ("a", "b", "c")}
+        self.evals: List[Any] = []
+
+        def eval(nix_args={}, attr=None, **kwargs):
+            self.evals.append((attr, nix_args["names"]))
+            if attr == "toplevelDrvs":
+                return {n: "/nix/store/{0}.drv".format(n) for n in nix_args["names"]}
+            if attr == "machines.drvPath":
+                return "/nix/store/machines.drv"
+            return "/nix/store/machines"
+
+        patches: List[Any] = [
+            mock.patch.object(
+                nixops.deployment.Deployment,
+                "active_machines",
+                new_callable=mock.PropertyMock,
+                return_value=self.machines,
+            ),
+            mock.patch.object(self.depl, "eval", eval),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+
+class BuildOnTargetTest(BuildTest):
+    def test_build_on_targets(self):
+        configs_path = self.depl.build_on_targets(
+            include=[], exclude=["c"], max_concurrent_build=2
+        )
+        self.assertEqual(configs_path, "/nix/store/machines")
+        self.assertEqual(
+            self.evals,
+            [("toplevelDrvs", ["a", "b"]), ("machines.outPath", ["a", "b"])],
+        )
+        a = self.machines["a"]
+        self.assertEqual(a.copied, ["/nix/store/a.drv"])
+        root = "/nix/var/nix/gcroots/nixops-" + self.depl.uuid
+        self.assertEqual(
+            a.commands,
+            [
+                "nix-store --realise --add-root {0} /nix/store/a.drv > /dev/null"
+                " && readlink {0}".format(root)
+            ],
+        )
+        self.assertEqual(a.new_toplevel, "/nix/store/a-nixos-system")
+        self.assertEqual(self.machines["c"].copied, [])
+
+    def test_dry_run(self):
+        self.depl.build_on_targets(
+            include=[], exclude=[], max_concurrent_build=2, dry_run=True
+        )
+        self.assertTrue(all(not m.copied for m in self.machines.values()))
+
+    def test_activate_removes_gc_root(self):
+        root = "/nix/var/nix/gcroots/nixops-" + self.depl.uuid
+        defn = SimpleNamespace(always_activate=True)
+        for test in (False, True):
+            a = self.machines["a"]
+            a.commands = []
+            a.new_toplevel = "/nix/store/a-nixos-system"
+            with mock.patch.object(
+                self.depl, "_machine_definition_for_required", return_value=defn
+            ):
+                self.depl.activate_configs(
+                    "/nix/store/machines",
+                    include=["a"],
+                    exclude=[],
+                    allow_reboot=False,
+                    force_reboot=False,
+                    check=False,
+                    sync=False,
+                    always_activate=True,
+                    dry_activate=False,
+                    test=test,
+                    boot=False,
+                    max_concurrent_activate=1,
+                    remove_gc_root=True,
+                )
+            # The root goes once the profile is set, or, with --test,
+            # once the new configuration is running.
+            switch = a.commands.index(
+                "/nix/store/a-nixos-system/bin/switch-to-configuration "
+                + ("test" if test else "switch")
+            )
+            remove = a.commands.index("rm -f " + root)
+            self.assertEqual(remove > switch, test)
+
+
+class PerMachineBuildTest(BuildTest):
+    def test_build_per_machine(self):
+        built: List[str] = []
+
+        def realise(argv, log, activities):
+            self.assertIn("internal-json", argv)
+            drv = argv[-1]
+            if drv == "/nix/store/b.drv":
+                raise subprocess.CalledProcessError(1, argv)
+            return drv.replace(".drv", "")
+
+        with mock.patch.object(self.depl, "_realise", realise), mock.patch.object(
+            self.depl, "get_physical_spec", lambda: "{}"
+        ), mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.dir.name}):
+            configs_path = self.depl.build_configs(
+                include=[],
+                exclude=[],
+                per_machine=True,
+                on_built=lambda m: built.append(m.name),
+            )
+        self.assertEqual(configs_path, "/nix/store/machines")
+        self.assertEqual(sorted(built), ["a", "c"])
+        self.assertEqual(self.machines["a"].new_toplevel, "/nix/store/a")
+        self.assertEqual(self.depl.failed_builds, ["b"])
+        self.assertEqual(
+            self.evals,
+            [("toplevelDrvs", ["a", "b", "c"]), ("machines.drvPath", ["a", "c"])],
+        )
+        reports = os.path.join(self.dir.name, "nixops", "build-reports")
+        self.assertEqual(len(os.listdir(os.path.join(reports, self.depl.uuid))), 1)
+
+    def test_unwritable_report(self):
+        def realise(argv, log, activities):
+            raise subprocess.CalledProcessError(1, argv)
+
+        with mock.patch.object(self.depl, "_realise", realise), mock.patch.object(
+            self.depl, "get_physical_spec", lambda: "{}"
+        ), mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "/proc/nope"}):
+            with self.assertRaisesRegex(Exception, "unable to build all machine"):
+                self.depl.build_configs(include=[], exclude=[])
+        report = self.depl.build_report
+        assert report is not None
+        self.assertEqual(report["summary"]["built"], 0)
+
+    def test_copy_closure(self):
+        a = self.machines["a"]
+        a.new_toplevel = "/nix/store/a"
+        history = nixops.scheduling.ThroughputHistory(None)
+        with mock.patch("time.monotonic", side_effect=[10.0, 12.0]):
+            self.depl._copy_closure(a, 4096, history)  # type: ignore
+        self.assertEqual(a.copied, ["/nix/store/a"])
+        self.assertEqual(history.get("{0}/a".format(self.depl.uuid)), 2048)
@@ -0,0 +1,96 @@
+import unittest
+from typing import Any, List, Optional
+
+import nixops.builders
+from nixops.builders import Builder, BuildLog, parse_machines
+
+
+class FakeMachine:
+    def __init__(self, arch: str, load: Optional[List[str]]) -> None:
+        self.name = "web"
+        self.ssh_user = "root"
+        self.public_host_key = "ssh-ed25519 AAAA"
+        self.arch = arch
+        self.load = load
+
+    def run_command(self, command: str, **kwargs: Any) -> str:
+        return "16\n{0}\n".format(self.arch)
+
+    def get_load_avg(self) -> Optional[List[str]]:
+        return self.load
+
+    def get_ssh_name(self) -> str:
+        return "10.0.0.1"
+
+    def get_ssh_private_key_file(self) -> Optional[str]:
+        return "/tmp/id_web"
+
+
+class BuildersTest(unittest.TestCase):
+    def test_machines_file(self):
+        builder = Builder(
+            uri="root@10.0.0.1",
+            systems=["x86_64-linux", "i686-linux"],
+            max_jobs=4,
+            speed_factor=2,
+            supported_features=["kvm", "big-parallel"],
+            public_host_key="ssh-ed25519 AAAA",
+        )
+        line = builder.line()
+        self.assertEqual(
+            line.split()[:7],
+            [
+                "root@10.0.0.1",
+                "x86_64-linux,i686-linux",
+                "-",
+                "4",
+                "2",
+                "kvm,big-parallel",
+                "-",
+            ],
+        )
+        self.assertEqual(parse_machines("# builders\n\n" + line + "\n"), [builder])
+        self.assertEqual(
+            parse_machines("ssh://mac aarch64-darwin"),
+            [Builder(uri="ssh://mac", systems=["aarch64-darwin"])],
+        )
+
+    def test_probe(self):
+        machine: Any = FakeMachine("aarch64", ["3.60", "2.00", "1.00", "1/100", "42"])
+        builder = nixops.builders.probe(machine)
+        self.assertEqual(builder.uri, "root@10.0.0.1")
+        self.assertEqual(builder.systems, ["aarch64-linux"])
+        self.assertEqual(builder.ssh_key, "/tmp/id_web")
+        self.assertEqual(builder.max_jobs, 12)
+        self.assertEqual(builder.name, "web")
+
+        machine = FakeMachine("x86_64", None)
+        self.assertEqual(nixops.builders.probe(machine).max_jobs, 16)
+        machine = FakeMachine("mips", None)
+        with self.assertRaisesRegex(Exception, "unsupported architecture"):
+            nixops.builders.probe(machine)
+
+    def test_utilization(self):
+        log = BuildLog()
+        for line in [
+            "these derivations will be built:",
+            "  /nix/store/aaa-a.drv",
+            "building '/nix/store/aaa-a.drv' on 'ssh://root@10.0.0.1'...",
+            "building '/nix/store/bbb-b.drv' on 'root@10.0.0.1'...",
+            "building '/nix/store/ccc-c.drv'...",
+            "building '/nix/store/ddd-d.drv' on 'ssh://mac'...",
+        ]:
+            log.feed(line)
+        builders = [
+            Builder(uri="root@10.0.0.1", systems=[], machine="web"),
+            Builder(uri="root@10.0.0.2", systems=[], machine="db"),
+        ]
+        self.assertEqual(
+            log.utilization(builders),
+            [
+                ("web", 2, 0.5),
+                ("localhost", 1, 0.25),
+                ("ssh://mac", 1, 0.25),
+                ("db", 0, 0.0),
+            ],
+        )
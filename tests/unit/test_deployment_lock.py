@@ -0,0 +1,101 @@
+import os
+import tempfile
+import threading
+import unittest
+from io import StringIO
+from unittest import mock
+
+import nixops.statefile
+from nixops.deployment import DeploymentLock
+from nixops.logger import Logger
+
+
+class DeploymentLockTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "uuid")
+        self.log = StringIO()
+        self.logger = Logger(self.log)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def lock(self, resources=()):
+        return DeploymentLock(self.path, self.logger, resources)
+
+    def acquired_in_background(self, lock) -> threading.Event:
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def run():
+            with lock:
+                acquired.set()
+                release.wait()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        return acquired
+
+    def test_disjoint_resources_run_concurrently(self):
+        with self.lock(["a", "b"]):
+            acquired = self.acquired_in_background(self.lock(["c"]))
+            self.assertTrue(acquired.wait(5))
+        self.assertEqual(self.log.getvalue(), "")
+
+    def test_overlapping_resources_wait(self):
+        with self.lock(["a", "b"]):
+            acquired = self.acquired_in_background(self.lock(["b", "c"]))
+            self.assertFalse(acquired.wait(0.2))
+        self.assertTrue(acquired.wait(5))
+        self.assertIn("exclusive lock on resource ‘b’", self.log.getvalue())
+
+    def test_whole_deployment_excludes_resources(self):
+        with self.lock():
+            acquired = self.acquired_in_background(self.lock(["a"]))
+            self.assertFalse(acquired.wait(0.2))
+        self.assertTrue(acquired.wait(5))
+        self.assertIn("shared deployment lock", self.log.getvalue())
+
+    def test_resources_exclude_whole_deployment(self):
+        with self.lock(["a"]):
+            acquired = self.acquired_in_background(self.lock())
+            self.assertFalse(acquired.wait(0.2))
+        self.assertTrue(acquired.wait(5))
+        self.assertIn("exclusive deployment lock", self.log.getvalue())
+
+    def test_exclusive(self):
+        other = self.lock(["b"])
+        lock = self.lock(["a"])
+        with other, lock:
+            with lock.exclusive():
+                # Holders of other resources keep running...
+                self.assertTrue(self.acquired_in_background(self.lock(["c"])).wait(5))
+                # ...but wait for deployment-wide changes of their own.
+                upgraded = threading.Event()
+
+                def run():
+                    with other.exclusive():
+                        upgraded.set()
+
+                thread = threading.Thread(target=run, daemon=True)
+                thread.start()
+                self.assertFalse(upgraded.wait(0.2))
+            self.assertTrue(upgraded.wait(5))
+            thread.join()
+        self.assertIn("deployment-wide lock", self.log.getvalue())
+
+    def test_locked_resources(self):
+        statefile = nixops.statefile.StateFile(
+            os.path.join(self.dir.name, "state.nixops"), writable=True
+        )
+        self.addCleanup(statefile.close)
+        depl = statefile.create_deployment()
+        with mock.patch.dict(os.environ, {"HOME": self.dir.name}):
+            self.assertTrue(depl._locked("b"))
+            with depl._get_deployment_lock(["a"]):
+                self.assertTrue(depl._locked("a"))
+                self.assertFalse(depl._locked("b"))
+            with depl._get_deployment_lock():
+                self.assertTrue(depl._locked("b"))
@@ -0,0 +1,100 @@
+import itertools
+import random
+import unittest
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from nixops.diff import Diff, Handler
+from nixops.logger import Logger
+from io import StringIO
+
+
+def brute_force(handlers: List[Handler], keys: List[str]) -> Optional[List[Handler]]:
+    """The cover that used to be found by trying all combinations."""
+    for k in range(1, len(handlers) + 1):
+        for combination in itertools.combinations(handlers, k):
+            covered = set()
+            for h in combination:
+                covered.update(h.get_keys())
+            if set(keys) <= covered:
+                return list(combination)
+    return None
+
+
+class DiffTest(unittest.TestCase):
+    def diff(
+        self,
+        definition: Dict[str, Any],
+        state: Dict[str, Any],
+        handlers: List[Handler],
+    ) -> Diff:
+        logger = Logger(StringIO()).get_logger_for("resource")
+        diff: Diff = Diff(
+            depl=None,  # type: ignore
+            logger=logger,
+            defn=SimpleNamespace(resource_eval=definition),  # type: ignore
+            state=state,  # type: ignore
+            res_type="test",
+        )
+        diff.set_handlers(handlers)
+        return diff
+
+    def test_plan(self):
+        a = Handler(["a"])
+        ab = Handler(["a", "b"], after=[a])
+        c = Handler(["c", "d"], after=[ab])
+        diff = self.diff({"a": 1, "b": 2, "c": 3}, {"a": 1, "c": 4, "d": 5}, [a, ab, c])
+        plan = diff.get_plan()
+        self.assertEqual(plan.handlers, [ab, c])
+        self.assertEqual(
+            plan.as_dict()["changes"], {"b": "set", "c": "update", "d": "unset"}
+        )
+
+    def test_records(self):
+        diff = self.diff({"a": 1, "b": 2}, {"a": 3, "c": 4}, [Handler(["a", "b", "c"])])
+        records = sorted(diff.get_plan().records(), key=lambda r: r["key"])
+        self.assertEqual(
+            records,
+            [
+                {"key": "a", "action": "update", "old": 3, "new": 1},
+                {"key": "b", "action": "set", "old": None, "new": 2},
+                {"key": "c", "action": "unset", "old": 4, "new": None},
+            ],
+        )
+
+    def test_no_cover(self):
+        diff = self.diff({"a": 1, "b": 2}, {}, [Handler(["a"])])
+        with self.assertRaises(Exception) as cm:
+            diff.plan()
+        self.assertIn("'b'", str(cm.exception))
+
+    def test_cycle(self):
+        a = Handler(["a"])
+        b = Handler(["b"], after=[a])
+        a._dependencies.append(b)
+        diff = self.diff({"a": 1, "b": 2}, {}, [a, b])
+        with self.assertRaises(Exception) as cm:
+            diff.plan()
+        self.assertIn("cycle", str(cm.exception))
+
+    def test_same_cover_as_brute_force(self):
+        rng = random.Random(42)
+        names = ["k{0}".format(i) for i in range(10)]
+        for _ in range(200):
+            handlers = [
+                Handler(rng.sample(names, rng.randint(1, 4)))
+                for _ in range(rng.randint(1, 12))
+            ]
+            keys = rng.sample(names, rng.randint(1, 6))
+            diff = self.diff({k: 1 for k in keys}, {}, handlers)
+            expected = brute_force(handlers, keys)
+            if expected is None:
+                self.assertRaises(Exception, diff.plan)
+            else:
+                self.assertEqual(diff.plan(), expected)
+
+    def test_many_handlers(self):
+        names = ["k{0}".format(i) for i in range(40)]
+        handlers = [Handler([k]) for k in names] + [Handler(names[::2])]
+        diff = self.diff({k: 1 for k in names}, {}, handlers)
+        self.assertEqual(len(diff.plan()), 21)
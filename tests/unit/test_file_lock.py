@@ -0,0 +1,170 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from nixops.locks.file import FileLock, LockTimeout
+
+
+class FileLockTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "network.lock")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def driver(self, **kwargs):
+        return FileLock(FileLock.options(path=self.path, **kwargs))
+
+    def holders(self):
+        with open(self.path) as f:
+            return json.load(f)["holders"]
+
+    def test_path_required(self):
+        with self.assertRaisesRegex(Exception, "requires the ‘path’ option"):
+            FileLock(FileLock.options())
+
+    def test_shared_locks_are_concurrent(self):
+        a = self.driver()
+        b = self.driver(timeout=0)
+        a.lock(description="nixops info", exclusive=False)
+        b.lock(description="nixops ssh", exclusive=False)
+        self.assertFalse(b.metrics["contended"])
+        self.assertEqual(
+            sorted(h["description"] for h in self.holders()),
+            ["nixops info", "nixops ssh"],
+        )
+        a.unlock()
+        b.unlock()
+        self.assertEqual(self.holders(), [])
+
+    def test_exclusive_waits_for_shared(self):
+        a = self.driver()
+        a.lock(description="nixops info", exclusive=False)
+        with self.assertRaises(LockTimeout):
+            self.driver(timeout=0).lock(description="nixops deploy", exclusive=True)
+        a.unlock()
+        self.assertEqual(self.holders(), [])
+
+    def test_waiting_writer_is_not_starved(self):
+        reader = self.driver()
+        reader.lock(description="reader", exclusive=False)
+
+        writer = self.driver()
+        acquired = threading.Event()
+
+        def write():
+            writer.lock(description="writer", exclusive=True)
+            acquired.set()
+
+        thread = threading.Thread(target=write, daemon=True)
+        thread.start()
+        time.sleep(0.3)
+
+        # A new reader must queue up behind the waiting writer.
+        with self.assertRaises(LockTimeout):
+            self.driver(timeout=0).lock(description="late reader", exclusive=False)
+
+        reader.unlock()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertTrue(writer.metrics["contended"])
+        self.assertGreater(writer.metrics["wait_seconds"], 0.2)
+        writer.unlock()
+
+    def test_waiter_keeps_its_place(self):
+        holder = self.driver(lease=1)
+        holder.lock(description="holder", exclusive=True)
+
+        waiter = self.driver(lease=1)
+        acquired = threading.Event()
+
+        def wait():
+            waiter.lock(description="waiter", exclusive=True)
+            acquired.set()
+
+        thread = threading.Thread(target=wait, daemon=True)
+        thread.start()
+        # Longer than the lease, while the holder expires stale entries.
+        time.sleep(1.5)
+        with open(self.path) as f:
+            queue = json.load(f)["queue"]
+        self.assertEqual([e["description"] for e in queue], ["waiter"])
+        self.assertGreater(queue[0]["expires"], time.time())
+
+        holder.unlock()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        waiter.unlock()
+        with open(self.path) as f:
+            metrics = json.load(f)["metrics"]["exclusive"]
+        self.assertEqual(metrics["acquired"], 2)
+        self.assertEqual(metrics["contended"], 1)
+        self.assertGreater(metrics["max_wait"], 1.0)
+
+    def test_expired_lease_is_broken(self):
+        with open(self.path, "w") as f:
+            json.dump(
+                {
+                    "holders": [
+                        {
+                            "id": "stale",
+                            "description": "nixops deploy",
+                            "exclusive": True,
+                            "resources": None,
+                            "pid": os.getpid(),
+                            "host": socket.gethostname(),
+                            "since": time.time() - 100,
+                            "expires": time.time() - 1,
+                        }
+                    ],
+                    "queue": [],
+                },
+                f,
+            )
+        lock = self.driver(timeout=0)
+        lock.lock(description="nixops deploy", exclusive=True)
+        self.assertEqual([h["id"] for h in self.holders()], [lock._id])
+        lock.unlock()
+
+    def test_force_unlock(self):
+        self.driver().lock(description="nixops deploy", exclusive=True)
+        self.driver().unlock()
+        self.assertEqual(self.holders(), [])
+
+    def test_unlock_twice(self):
+        a = self.driver()
+        b = self.driver()
+        a.lock(description="nixops ssh", exclusive=False)
+        b.lock(description="nixops info", exclusive=False)
+        a.unlock()
+        a.unlock()
+        self.assertEqual([h["description"] for h in self.holders()], ["nixops info"])
+        b.unlock()
+
+    def test_resource_locks(self):
+        a = self.driver(resourceLocking=True)
+        a.lock_resources(description="deploy a", resources=["a"])
+        self.driver(resourceLocking=True, timeout=0).lock_resources(
+            description="deploy b", resources=["b"]
+        )
+        with self.assertRaises(LockTimeout):
+            self.driver(resourceLocking=True, timeout=0).lock_resources(
+                description="deploy a", resources=["a", "c"]
+            )
+        with self.assertRaises(LockTimeout):
+            self.driver(timeout=0).lock(description="deploy", exclusive=True)
+        a.unlock_resources(resources=["a"])
+
+    def test_resource_locks_disabled(self):
+        a = self.driver()
+        a.lock_resources(description="deploy a", resources=["a"])
+        with self.assertRaises(LockTimeout):
+            self.driver(timeout=0).lock_resources(
+                description="deploy b", resources=["b"]
+            )
+        a.unlock_resources(resources=["a"])
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import nixops.known_hosts
+
+
+class KnownHostsTest(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.TemporaryDirectory()
+        self.addCleanup(self.home.cleanup)
+        env = mock.patch.dict(os.environ, {"HOME": self.home.name})
+        env.start()
+        self.addCleanup(env.stop)
+        self.path = os.path.join(self.home.name, ".ssh", "known_hosts")
+
+    def write(self, contents):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as f:
+            f.write(contents)
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_add_creates_file(self):
+        nixops.known_hosts.add("10.0.0.1", "ssh-ed25519 AAAA")
+        self.assertEqual(self.read(), "10.0.0.1 ssh-ed25519 AAAA\n")
+
+    def test_add_replaces_key(self):
+        self.write("# comment\n10.0.0.1,10.0.0.2 ssh-ed25519 OLD\n")
+        nixops.known_hosts.add("10.0.0.1", "ssh-ed25519 NEW")
+        self.assertEqual(
+            self.read(),
+            "# comment\n10.0.0.2 ssh-ed25519 OLD\n10.0.0.1 ssh-ed25519 NEW\n",
+        )
+
+    def test_remove_only_matching_key(self):
+        self.write("10.0.0.1 ssh-ed25519 A\n10.0.0.1 ssh-rsa B\n")
+        nixops.known_hosts.remove("10.0.0.1", "ssh-rsa B")
+        self.assertEqual(self.read(), "10.0.0.1 ssh-ed25519 A\n")
+
+    def test_update(self):
+        self.write("10.0.0.1 ssh-ed25519 A\n")
+        nixops.known_hosts.update("10.0.0.1", "10.0.0.2", "ssh-ed25519 A")
+        self.assertEqual(self.read(), "10.0.0.2 ssh-ed25519 A\n")
+
+    def test_batch_matches_single_calls(self):
+        initial = "a,b ssh-ed25519 A\nc ssh-rsa C\n|1|hashed ssh-ed25519 H\n"
+        ops = [
+            ("add", "a", "ssh-ed25519 A2"),
+            ("remove", "c", "ssh-rsa C"),
+            ("add", "d", "ssh-ed25519 D"),
+            ("add", "d", "ssh-ed25519 D"),
+            ("remove", "b", "ssh-ed25519 A"),
+            ("add", "c", "ssh-rsa C"),
+        ]
+
+        self.write(initial)
+        for (op, ip, key) in ops:
+            getattr(nixops.known_hosts, op)(ip, key)
+        expected = self.read()
+
+        self.write(initial)
+        with mock.patch("os.rename", wraps=os.rename) as rename:
+            with nixops.known_hosts.batch() as b:
+                for (op, ip, key) in ops:
+                    getattr(b, op)(ip, key)
+            self.assertEqual(rename.call_count, 1)
+        self.assertEqual(self.read(), expected)
+
+    def test_batch_not_applied_on_error(self):
+        self.write("a ssh-ed25519 A\n")
+        with self.assertRaises(RuntimeError):
+            with nixops.known_hosts.batch() as b:
+                b.add("b", "ssh-ed25519 B")
+                raise RuntimeError()
+        self.assertEqual(self.read(), "a ssh-ed25519 A\n")
+
+    def test_unchanged_file_not_rewritten(self):
+        self.write("a ssh-ed25519 A\n")
+        with mock.patch("os.rename") as rename:
+            nixops.known_hosts.add("a", "ssh-ed25519 A")
+            rename.assert_not_called()
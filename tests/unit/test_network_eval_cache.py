@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import nixops.evaluation
+import nixops.cache
+from nixops.evaluation import NetworkFile, eval_network
+
+
+class NetworkEvalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = tempfile.TemporaryDirectory()
+        self.network = os.path.join(self.dir.name, "nixops.nix")
+        self.write(self.network, "{ network.storage.legacy = {}; }")
+        self.write(os.path.join(self.dir.name, "machine.nix"), "{ }")
+
+        env = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.cache.name})
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop("NIXOPS_NO_CACHE", None)
+
+        self.evals = 0
+        patcher = mock.patch.object(nixops.evaluation, "eval", self.fake_eval)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.dir.cleanup()
+        self.cache.cleanup()
+
+    def write(self, path, contents):
+        with open(path, "w") as f:
+            f.write(contents)
+
+    def fake_eval(self, networkExpr, attr, **kwargs):
+        self.assertEqual(attr, "networkInfo")
+        self.evals += 1
+        return {
+            "network": {"storage": {"legacy": {}}, "description": str(self.evals)},
+            "files": [networkExpr.network],
+        }
+
+    def evaluate(self):
+        # Start from a fresh process, as far as the cache is concerned.
+        nixops.evaluation._network_evals.clear()
+        return eval_network(NetworkFile(network=self.network))
+
+    def test_warm_cache(self):
+        self.assertEqual(self.evaluate().description, "1")
+        self.assertEqual(self.evaluate().description, "1")
+        self.assertEqual(self.evals, 1)
+
+    def test_in_process(self):
+        nixops.evaluation._network_evals.clear()
+        eval_network(NetworkFile(network=self.network))
+        os.environ["NIXOPS_NO_CACHE"] = "1"
+        eval_network(NetworkFile(network=self.network))
+        self.assertEqual(self.evals, 1)
+
+    def test_modified_file(self):
+        self.evaluate()
+        self.write(os.path.join(self.dir.name, "machine.nix"), "{ foo = 1; }")
+        self.assertEqual(self.evaluate().description, "2")
+        self.assertEqual(self.evaluate().description, "2")
+
+    def test_touched_file(self):
+        self.evaluate()
+        os.utime(self.network, ns=(0, 0))
+        self.evaluate()
+        self.assertEqual(self.evals, 1)
+
+    def test_new_file(self):
+        self.evaluate()
+        self.write(os.path.join(self.dir.name, "other.nix"), "{ }")
+        self.evaluate()
+        self.assertEqual(self.evals, 2)
+
+    def test_environment(self):
+        self.evaluate()
+        with mock.patch.dict(os.environ, {"NIX_PATH": "nixpkgs=/elsewhere"}):
+            self.evaluate()
+        self.assertEqual(self.evals, 2)
+
+    def test_disabled(self):
+        os.environ["NIXOPS_NO_CACHE"] = "1"
+        self.evaluate()
+        self.evaluate()
+        self.assertEqual(self.evals, 2)
+
+    def test_unwritable(self):
+        os.environ["XDG_CACHE_HOME"] = "/proc/nope"
+        self.assertEqual(self.evaluate().description, "1")
+        self.assertEqual(self.evaluate().description, "2")
+
+    def test_no_home(self):
+        del os.environ["XDG_CACHE_HOME"]
+        with mock.patch.dict(os.environ):
+            os.environ.pop("HOME", None)
+            self.assertIsNone(nixops.cache.cache_dir("network-eval"))
+            self.evaluate()
+            self.evaluate()
+        self.assertEqual(self.evals, 2)
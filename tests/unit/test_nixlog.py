@@ -0,0 +1,107 @@
+import json
+import unittest
+from typing import Any, Dict
+
+from nixops.nixlog import Activities
+
+
+def nix(**event: Any) -> str:
+    return "@nix " + json.dumps(event) + "\n"
+
+
+class ActivitiesTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.activities = Activities(clock=lambda: self.now)
+
+    def feed(self, *events: Dict[str, Any]) -> list:
+        return [self.activities.feed(nix(**e)) for e in events]
+
+    def test_build(self):
+        texts = self.feed(
+            dict(
+                action="start",
+                id=1,
+                type=105,
+                text="building '/nix/store/aaa-foo.drv'",
+                fields=["/nix/store/aaa-foo.drv", "", 1, 1],
+            ),
+            dict(action="result", id=1, type=101, fields=["compiling foo"]),
+            dict(action="result", id=1, type=104, fields=["buildPhase"]),
+        )
+        self.assertEqual(
+            texts, ["building '/nix/store/aaa-foo.drv'", "compiling foo", None]
+        )
+        self.assertEqual(self.activities.summary()["running"], 1)
+        self.now += 30
+        self.feed(dict(action="stop", id=1))
+        summary = self.activities.summary()
+        self.assertEqual(summary["built"], 1)
+        self.assertEqual(summary["running"], 0)
+        self.assertEqual(summary["build_time"], 30)
+        report = self.activities.report()
+        self.assertEqual(report["slowest"], ["/nix/store/aaa-foo.drv"])
+        self.assertEqual(report["builds"][0]["source"], None)
+        self.assertEqual(report["builds"][0]["duration"], 30)
+
+    def test_failed(self):
+        self.feed(
+            dict(
+                action="start",
+                id=1,
+                type=105,
+                fields=["/nix/store/aaa-foo.drv", "ssh://builder", 1, 1],
+            ),
+            dict(
+                action="msg",
+                level=0,
+                msg="error: builder for '/nix/store/aaa-foo.drv' failed with exit"
+                " code 2",
+            ),
+            dict(action="stop", id=1),
+        )
+        self.assertEqual(self.activities.summary()["failed"], 1)
+        self.assertEqual(self.activities.summary()["built"], 0)
+        self.assertEqual(
+            self.activities.report()["builds"][0]["source"], "ssh://builder"
+        )
+
+    def test_substitute(self):
+        self.feed(
+            dict(
+                action="start",
+                id=1,
+                type=108,
+                text="copying path '/nix/store/bbb-bar' from 'https://cache'",
+                fields=["/nix/store/bbb-bar", "https://cache"],
+            ),
+            dict(action="start", id=2, type=100, parent=1, fields=[]),
+            dict(action="start", id=3, type=101, parent=2, fields=[]),
+            dict(action="result", id=3, type=105, fields=[500, 1000, 0, 0]),
+            dict(action="result", id=2, type=105, fields=[2048, 2048, 0, 0]),
+            dict(action="stop", id=3),
+            dict(action="stop", id=2),
+            dict(action="stop", id=1),
+        )
+        summary = self.activities.summary()
+        self.assertEqual(summary["substituted"], 1)
+        self.assertEqual(summary["substituted_size"], 2048)
+        self.assertEqual(
+            self.activities.status(),
+            "0 built, 0 failed, 1 substituted (0.0 MiB), 0 running",
+        )
+
+    def test_streams(self):
+        start = dict(action="start", id=1, type=105, fields=["/nix/store/a.drv", ""])
+        self.activities.feed(nix(**start), stream="x")
+        self.activities.feed(nix(**dict(start, fields=["/nix/store/b.drv", ""])), "y")
+        self.activities.feed(nix(action="stop", id=1), stream="y")
+        report = self.activities.report()
+        self.assertEqual(
+            [(b["path"], b["duration"]) for b in report["builds"]],
+            [("/nix/store/a.drv", None), ("/nix/store/b.drv", 0)],
+        )
+
+    def test_plain(self):
+        self.assertEqual(self.activities.feed("warning: dirty\n"), "warning: dirty")
+        self.assertEqual(self.activities.feed("@nix {garbage\n"), "@nix {garbage")
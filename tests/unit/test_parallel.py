@@ -39,6 +39,21 @@ class ParallelTest(unittest.TestCase):
             ["ok", "ok"],
         )
 
+    def test_next_task(self):
+        tasks = [ExampleTask(name, lambda: None) for name in "abc"]
+        order = list(reversed(tasks))
+        workers = []
+
+        def next_task(worker):
+            workers.append(worker)
+            return order.pop(0) if order else None
+
+        self.assertEqual(
+            run_tasks(1, tasks, lambda task: task.name, next_task=next_task),
+            ["c", "b", "a"],
+        )
+        self.assertEqual(set(workers), {0})
+
     def test_one_exception(self):
         self.assertRaises(
             Exception,
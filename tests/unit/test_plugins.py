@@ -0,0 +1,95 @@
+import os
+import sys
+import tempfile
+import textwrap
+import unittest
+from typing import Any, List
+from unittest import mock
+
+import nixops.plugins
+
+
+class PluginRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = tempfile.TemporaryDirectory()
+
+        with open(os.path.join(self.dir.name, "example_nixops_plugin.py"), "w") as f:
+            f.write(
+                textwrap.dedent(
+                    """
+                    import nixops.plugins
+
+                    class ExamplePlugin(nixops.plugins.Plugin):
+                        pass
+
+                    @nixops.plugins.hookimpl
+                    def plugin():
+                        return ExamplePlugin()
+                    """
+                )
+            )
+        dist_info = os.path.join(self.dir.name, "example_nixops_plugin-1.0.dist-info")
+        os.mkdir(dist_info)
+        with open(os.path.join(dist_info, "METADATA"), "w") as f:
+            f.write("Name: example-nixops-plugin\nVersion: 1.0\n")
+        self.entry_points = os.path.join(dist_info, "entry_points.txt")
+        with open(self.entry_points, "w") as f:
+            f.write("[nixops]\nexample = example_nixops_plugin\n")
+
+        patches: List[Any] = [
+            mock.patch.object(sys, "path", [self.dir.name] + sys.path),
+            mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.cache.name}),
+            mock.patch.object(nixops.plugins, "_plugin_manager", None),
+            mock.patch.object(nixops.plugins, "_plugins", ()),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        os.environ.pop("NIXOPS_NO_CACHE", None)
+
+    def tearDown(self):
+        sys.modules.pop("example_nixops_plugin", None)
+        self.dir.cleanup()
+        self.cache.cleanup()
+
+    def reset(self):
+        nixops.plugins._plugin_manager = None
+        nixops.plugins._plugins = ()
+
+    def plugin_names(self):
+        return [type(p).__name__ for p in nixops.plugins.get_plugins()]
+
+    def test_memoized(self):
+        self.assertIs(
+            nixops.plugins.get_plugin_manager(), nixops.plugins.get_plugin_manager()
+        )
+        first = list(nixops.plugins.get_plugins())
+        self.assertEqual(first, list(nixops.plugins.get_plugins()))
+        self.assertIn("ExamplePlugin", self.plugin_names())
+
+    def test_index(self):
+        self.plugin_names()
+        self.reset()
+        with mock.patch("importlib.metadata.distributions") as distributions:
+            self.assertIn("ExamplePlugin", self.plugin_names())
+            distributions.assert_not_called()
+
+    def test_index_invalidated(self):
+        self.plugin_names()
+        self.reset()
+        os.utime(self.entry_points, ns=(0, 0))
+        with mock.patch(
+            "importlib.metadata.distributions", return_value=[]
+        ) as distributions:
+            self.assertNotIn("ExamplePlugin", self.plugin_names())
+            distributions.assert_called()
+
+    def test_index_disabled(self):
+        os.environ["NIXOPS_NO_CACHE"] = "1"
+        self.assertIn("ExamplePlugin", self.plugin_names())
+        self.assertFalse(os.path.exists(os.path.join(self.cache.name, "nixops")))
+
+    def test_index_unwritable(self):
+        with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "/proc/nope"}):
+            self.assertIn("ExamplePlugin", self.plugin_names())
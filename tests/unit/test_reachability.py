@@ -0,0 +1,94 @@
+import socket
+import threading
+import time
+import unittest
+
+from nixops.reachability import Prober
+
+
+class ProberTest(unittest.TestCase):
+    def setUp(self):
+        self.prober = Prober()
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_up(self):
+        self.server.listen()
+        self.assertTrue(self.prober.wait("127.0.0.1", self.port, up=True, timeout=5))
+        status = self.prober.status("127.0.0.1", self.port)
+        self.assertTrue(status.up)
+        self.assertEqual(len(status.up_since), 1)
+
+    def test_down(self):
+        self.server.close()
+        self.assertTrue(self.prober.wait("127.0.0.1", self.port, up=False, timeout=5))
+        self.assertFalse(self.prober.status("127.0.0.1", self.port).up)
+
+    def test_timeout(self):
+        self.server.close()
+        start = time.monotonic()
+        self.assertFalse(self.prober.wait("127.0.0.1", self.port, up=True, timeout=1))
+        self.assertLess(time.monotonic() - start, 3)
+
+    def test_transitions(self):
+        ticks = []
+
+        def come_up():
+            time.sleep(0.5)
+            self.server.listen()
+
+        threading.Thread(target=come_up).start()
+        self.assertTrue(
+            self.prober.wait(
+                "127.0.0.1",
+                self.port,
+                up=True,
+                timeout=10,
+                callback=lambda: ticks.append(1),
+            )
+        )
+        status = self.prober.status("127.0.0.1", self.port)
+        self.assertEqual(len(status.down_since), 1)
+        self.assertEqual(len(status.up_since), 1)
+        self.assertLess(status.down_since[0], status.up_since[0])
+
+    def test_confirm(self):
+        self.server.listen()
+        confirmations = []
+
+        def confirm():
+            confirmations.append(1)
+            return len(confirmations) == 2
+
+        self.assertTrue(
+            self.prober.wait(
+                "127.0.0.1", self.port, up=True, timeout=10, confirm=confirm
+            )
+        )
+        self.assertEqual(len(confirmations), 2)
+
+    def test_many_hosts(self):
+        self.server.listen()
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+
+        results = {}
+
+        def wait(port, up):
+            results[(port, up)] = self.prober.wait("127.0.0.1", port, up, timeout=5)
+
+        threads = [
+            threading.Thread(target=wait, args=(port, up))
+            for port, up in [(self.port, True), (closed_port, False)] * 10
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {(self.port, True): True, (closed_port, False): True})
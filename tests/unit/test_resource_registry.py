@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+
+import nixops.parallel
+import nixops.statefile
+
+
+class ResourceRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.statefile = nixops.statefile.StateFile(
+            os.path.join(self.dir.name, "state.nixops"), writable=True
+        )
+        self.depl = self.statefile.create_deployment()
+        self.machine = self.depl._create_resource("machine", "none")
+        self.keypair = self.depl._create_resource("keypair", "ssh-keypair")
+
+    def tearDown(self):
+        self.statefile.close()
+        self.dir.cleanup()
+
+    def test_views(self):
+        self.assertEqual(list(self.depl.active_resources), ["machine", "keypair"])
+        self.assertEqual(list(self.depl.active_machines), ["machine"])
+        self.assertEqual(list(self.depl.resources.of_type("ssh-keypair")), ["keypair"])
+
+        self.machine.obsolete = True
+        self.assertEqual(list(self.depl.active_resources), ["keypair"])
+        self.assertEqual(list(self.depl.active_machines), [])
+        self.assertEqual(list(self.depl.machines), ["machine"])
+
+        self.machine.obsolete = False
+        self.assertEqual(list(self.depl.active_machines), ["machine"])
+
+    def test_rename_and_delete(self):
+        self.depl.rename("machine", "other")
+        self.assertEqual(list(self.depl.active_machines), ["other"])
+        self.depl.delete_resource(self.keypair)
+        self.assertEqual(list(self.depl.active_resources), ["other"])
+        self.assertEqual(dict(self.depl.resources.of_type("ssh-keypair")), {})
+
+    def test_after_commit(self):
+        with self.depl._db:
+            self.machine.obsolete = True
+            self.depl.delete_resource(self.keypair)
+            self.assertEqual(list(self.depl.active_resources), ["machine", "keypair"])
+        self.assertEqual(list(self.depl.active_resources), [])
+        self.assertEqual(list(self.depl.machines), ["machine"])
+
+    def test_parallel_delete(self):
+        resources = [
+            self.depl._create_resource("r{0}".format(n), "ssh-keypair")
+            for n in range(20)
+        ]
+        for n, r in enumerate(resources):
+            r.index = n
+        nixops.parallel.run_tasks(
+            nr_workers=-1, tasks=resources, worker_fun=self.depl.delete_resource
+        )
+        self.assertEqual(list(self.depl.active_resources), ["machine", "keypair"])
+        self.assertEqual(list(self.depl.resources.of_type("ssh-keypair")), ["keypair"])
+        self.assertEqual(self.depl._get_free_resource_index(), 0)
+
+    def test_free_index(self):
+        self.assertEqual(self.depl._get_free_resource_index(), 0)
+        self.keypair.index = 3
+        self.assertEqual(self.depl._get_free_resource_index(), 4)
+        self.machine.index = self.depl._get_free_resource_index()
+        self.assertEqual(self.machine.index, 4)
+        self.assertEqual(list(self.depl.resources.with_index(4)), ["machine"])
+        self.depl.delete_resource(self.machine)
+        self.assertEqual(self.depl._get_free_resource_index(), 4)
+
+    def test_reopen(self):
+        self.machine.index = 1
+        self.keypair.obsolete = True
+        depl = self.statefile.open_deployment(self.depl.uuid)
+        self.assertEqual(list(depl.active_resources), ["machine"])
+        self.assertEqual(depl._get_free_resource_index(), 2)
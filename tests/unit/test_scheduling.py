@@ -0,0 +1,144 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import nixops.parallel
+from nixops.scheduling import (
+    Schedule,
+    ThroughputHistory,
+    lpt_assign,
+    run_tasks,
+    simulate,
+)
+
+
+class LptTest(unittest.TestCase):
+    def test_assign(self):
+        self.assertEqual(
+            lpt_assign([1, 5, 2, 4, 3], cost=float, nr_workers=2),
+            [[5, 2, 1], [4, 3]],
+        )
+
+    def test_steal(self):
+        schedule = Schedule([10, 1, 1, 1], cost=float, nr_workers=2)
+        self.assertEqual(schedule.next(0), 10)
+        self.assertEqual(schedule.next(1), 1)
+        self.assertEqual(schedule.next(1), 1)
+        self.assertEqual(schedule.next(1), 1)
+        self.assertEqual(schedule.steals, 0)
+        self.assertIsNone(schedule.next(0))
+
+        schedule = Schedule([4, 3, 2, 1], cost=float, nr_workers=2)
+        # Worker 1 finishes its tasks (3 and 2) while worker 0 is still
+        # busy with 4, and takes 1 from worker 0.
+        self.assertEqual(schedule.next(0), 4)
+        self.assertEqual(schedule.next(1), 3)
+        self.assertEqual(schedule.next(1), 2)
+        self.assertEqual(schedule.next(1), 1)
+        self.assertEqual(schedule.steals, 1)
+        self.assertIsNone(schedule.next(0))
+
+    def test_costs_snapshot(self):
+        # The cost of a task changes while the tasks run, e.g. as the
+        # throughput history is updated.
+        drift = [0.0]
+        calls = []
+
+        def cost(t):
+            calls.append(t)
+            return t + drift[0]
+
+        schedule = Schedule([4, 3, 2, 1], cost=cost, nr_workers=2)
+        self.assertEqual(sorted(calls), [1, 2, 3, 4])
+        drift[0] = 100.0
+        self.assertEqual(schedule.next(1), 3)
+        self.assertEqual(schedule.next(1), 2)
+        self.assertEqual(schedule.next(1), 1)
+        self.assertEqual(schedule.next(0), 4)
+        self.assertEqual(len(calls), 4)
+
+    def test_simulate(self):
+        tasks = [1.0] * 8 + [8.0]
+        self.assertEqual(simulate(tasks, float, nr_workers=2), 12.0)
+        self.assertEqual(simulate(tasks, float, nr_workers=2, cost=float), 8.0)
+        self.assertEqual(simulate([], float, nr_workers=2), 0.0)
+
+
+class RunTasksTest(unittest.TestCase):
+    def task(self, name, cost):
+        return SimpleNamespace(name=name, cost=cost)
+
+    def test_order(self):
+        tasks = [self.task(str(i), i) for i in range(5)]
+        started = []
+        lock = threading.Lock()
+
+        def worker(t):
+            with lock:
+                started.append(t.name)
+            return t.name
+
+        results = run_tasks(1, tasks, worker, cost=lambda t: t.cost)
+        self.assertEqual(started, ["4", "3", "2", "1", "0"])
+        self.assertEqual(sorted(results), ["0", "1", "2", "3", "4"])
+
+    def test_exceptions(self):
+        def worker(t):
+            if t.cost > 0:
+                raise Exception(t.name)
+
+        tasks = [self.task("a", 0), self.task("b", 1), self.task("c", 2)]
+        with self.assertRaises(nixops.parallel.MultipleExceptions) as cm:
+            run_tasks(2, tasks, worker, cost=lambda t: t.cost)
+        self.assertEqual(sorted(cm.exception.exceptions), ["b", "c"])
+        with self.assertRaisesRegex(Exception, "^b$"):
+            run_tasks(2, tasks[:2], worker, cost=lambda t: t.cost)
+
+
+class ThroughputHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        env = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.dir.name})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def test_record(self):
+        history = ThroughputHistory.load()
+        history.record("a", 1000, 1.0)
+        history.record("a", 3000, 1.0)
+        self.assertEqual(history.get("a"), 2000)
+        self.assertEqual(history.estimate("a", 4000), 2.0)
+        # Unknown hosts are assumed to be as fast as a typical one.
+        history.record("b", 4000, 1.0)
+        self.assertEqual(history.estimate("c", 3000), 1.0)
+
+    def test_save(self):
+        history = ThroughputHistory.load()
+        history.record("a", 1000, 1.0)
+        other = ThroughputHistory.load()
+        other.record("b", 2000, 1.0)
+        other.save()
+        history.save()
+        history = ThroughputHistory.load()
+        self.assertEqual(history.get("a"), 1000)
+        self.assertEqual(history.get("b"), 2000)
+
+    def test_corrupt(self):
+        history = ThroughputHistory.load()
+        history.record("a", 1000, 1.0)
+        history.save()
+        assert history._path is not None
+        with open(history._path, "w") as f:
+            json.dump({"a": "fast", "b": -1}, f)
+        self.assertIsNone(ThroughputHistory.load().get("a"))
+
+    def test_save_unwritable(self):
+        history = ThroughputHistory(os.path.join("/proc/nope", "copy.json"))
+        history.record("a", 1000, 1.0)
+        history.save()
+        self.assertEqual(history.get("a"), 1000)
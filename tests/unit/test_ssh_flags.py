@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+from typing import Any
+from unittest import mock
+
+import nixops.statefile
+
+
+class SSHFlagsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.statefile = nixops.statefile.StateFile(
+            os.path.join(self.dir.name, "state.nixops"), writable=True
+        )
+        self.addCleanup(self.statefile.close)
+        depl = self.statefile.create_deployment()
+        machine: Any = depl._create_resource("machine", "none")
+        machine.target_host = "10.0.0.1"
+        machine.ssh_options = []
+        self.host_key = "10.0.0.1 ssh-ed25519 AAAA"
+        machine.get_ssh_host_keys = lambda: self.host_key
+        self.machine = machine
+
+        self.global_file = os.path.join(self.dir.name, "ssh_known_hosts")
+        with open(self.global_file, "w") as f:
+            f.write("example.org ssh-ed25519 BBBB\n")
+
+        self.ssh_g_calls = 0
+        patcher = mock.patch("subprocess.Popen", self.fake_popen)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_popen(self, args, **kwargs):
+        self.assertEqual(args[:2], ["ssh", "-G"])
+        self.ssh_g_calls += 1
+        proc = mock.MagicMock()
+        proc.__enter__.return_value.stdout = iter(
+            [
+                "hostname {0}\n".format(args[2]),
+                "globalknownhostsfile " + self.global_file,
+            ]
+        )
+        return proc
+
+    def known_hosts(self):
+        path = self.machine.get_known_hosts_file()
+        with open(path) as f:
+            return f.read()
+
+    def test_memoized(self):
+        self.machine.get_ssh_flags()
+        with mock.patch("os.fdopen", wraps=os.fdopen) as fdopen:
+            self.machine.get_ssh_flags()
+            self.machine.get_ssh_flags()
+            fdopen.assert_not_called()
+        self.assertEqual(self.ssh_g_calls, 1)
+        self.assertIn("BBBB", self.known_hosts())
+
+    def test_host_key_changed(self):
+        self.known_hosts()
+        self.host_key = "10.0.0.1 ssh-ed25519 CCCC"
+        self.assertIn("CCCC", self.known_hosts())
+        self.assertEqual(self.ssh_g_calls, 1)
+
+    def test_ssh_name_changed(self):
+        self.known_hosts()
+        self.machine.target_host = "10.0.0.2"
+        self.known_hosts()
+        self.assertEqual(self.ssh_g_calls, 2)
+
+    def test_global_file_changed(self):
+        self.known_hosts()
+        with open(self.global_file, "w") as f:
+            f.write("example.org ssh-ed25519 DDDD\n")
+        os.utime(self.global_file, ns=(0, 0))
+        contents = self.known_hosts()
+        self.assertIn("DDDD", contents)
+        self.assertNotIn("BBBB", contents)
+
+    def test_pinned(self):
+        with mock.patch.object(
+            self.machine, "get_ssh_flags", wraps=self.machine.get_ssh_flags
+        ) as get_ssh_flags:
+            with self.machine.pinned_ssh_flags():
+                flags = self.machine.ssh._get_flags()
+                self.assertEqual(self.machine.ssh._get_flags(), flags)
+            self.assertEqual(get_ssh_flags.call_count, 1)
+            self.machine.ssh._get_flags()
+            self.assertEqual(get_ssh_flags.call_count, 2)
+
+    def test_tcp_address(self):
+        self.assertEqual(self.machine._tcp_address(), ("10.0.0.1", 22))
+        self.machine.ssh_port = 2222
+        self.assertEqual(self.machine._tcp_address(), ("10.0.0.1", 2222))
+        self.machine.ssh_port = None
+        for options in [["-p", "2200"], ["-p2200"], ["-o", "Port=2200"]]:
+            self.machine.ssh_options = options
+            self.assertEqual(self.machine._tcp_address(), ("10.0.0.1", 2200))
+        self.machine.ssh_options = ["-p", "ssh"]
+        self.assertIsNone(self.machine._tcp_address())
+        self.machine.ssh_options = ["-o", "ProxyJump=bastion"]
+        self.assertIsNone(self.machine._tcp_address())
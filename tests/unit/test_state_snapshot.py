@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+from io import StringIO
+from types import SimpleNamespace
+from typing import Any, List
+
+import nixops.statefile
+from nixops.diff import Diff, Handler
+from nixops.logger import Logger
+from nixops.state import StateDict
+
+
+class StateSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.statefile = nixops.statefile.StateFile(
+            os.path.join(self.dir.name, "state.nixops"), writable=True
+        )
+        self.depl = self.statefile.create_deployment()
+        machine: Any = self.depl._create_resource("machine", "none")
+        machine.state = machine.UP
+        machine.vm_id = "vm-1"
+        machine._set_attr("custom", '["a", "b"]')
+        machine.ssh_options = ["-v"]
+        self.machine = machine
+        self.other = self.depl._create_resource("other", "none")
+
+        self.queries: List[str] = []
+        self.depl._db.set_trace_callback(self.queries.append)
+
+    def tearDown(self):
+        self.depl._db.set_trace_callback(None)
+        self.statefile.close()
+        self.dir.cleanup()
+
+    def diff(self, definition, state, snapshot=None) -> Diff:
+        diff: Diff = Diff(
+            depl=self.depl,
+            logger=Logger(StringIO()).get_logger_for("resource"),
+            defn=SimpleNamespace(resource_eval=definition),  # type: ignore
+            state=state,
+            res_type="test",
+            snapshot=snapshot,
+        )
+        diff.set_handlers([Handler(["vm", "custom", "pending", "plain"])])
+        return diff
+
+    def test_state_dict_snapshot(self):
+        snapshot = StateDict(self.depl, self.machine.id).snapshot()
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(snapshot["custom"], ("a", "b"))
+        self.assertEqual(snapshot["vmId"], "vm-1")
+        self.assertEqual(dict(snapshot), dict(StateDict(self.depl, self.machine.id)))
+        with self.assertRaises(KeyError):
+            snapshot["missing"]
+
+    def test_references(self):
+        definition = {
+            "vm": "res-machine.none.vm_id",
+            "custom": "res-machine.none.ssh_options",
+            "pending": "res-other.none.vm_id",
+            "plain": 1,
+        }
+        expected = self.diff(definition, StateDict(self.depl, self.other.id))
+        expected_keys = {k: expected.get_resource_definition(k) for k in definition}
+        self.assertEqual(
+            expected_keys,
+            {"vm": "vm-1", "custom": ["-v"], "pending": "computed", "plain": 1},
+        )
+
+        self.queries.clear()
+        with self.depl.state_snapshot() as snapshot:
+            diff = self.diff(definition, snapshot.state(self.other.id), snapshot)
+            self.assertEqual(len(diff.plan()), 1)
+            self.assertEqual(
+                {k: diff.get_resource_definition(k) for k in definition},
+                expected_keys,
+            )
+        self.assertEqual(len(self.queries), 1)
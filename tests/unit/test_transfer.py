@@ -0,0 +1,443 @@
+import gzip
+import os
+import stat
+import struct
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from unittest import mock
+
+import nixops.deployment
+import nixops.statefile
+import nixops.transfer
+from nixops.transfer import ExportCache, build_tree
+
+FAKE_NIX_STORE = """\
+#!/bin/sh
+# nix-store --export PATH: a fake export whose body is the path, repeated.
+printf '\\001\\000\\000\\000\\000\\000\\000\\000'
+for i in $(seq 100); do printf '%s' "$2"; done
+printf '\\000\\000\\000\\000\\000\\000\\000\\000'
+"""
+
+END = struct.pack("<Q", 0)
+
+
+def body(path: str) -> bytes:
+    return struct.pack("<Q", 1) + path.encode() * 100
+
+
+class FakeMachine:
+    """A machine whose ‘nix-store --import’ records what it was sent."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.ssh_user = "root"
+        self.received = b""
+        self.logger = SimpleNamespace(log=lambda msg: None)
+
+    def get_ssh_for_copy_closure(self) -> Any:
+        return self
+
+    def run_command(self, command: str, user: str, stdin: Any, **kwargs: Any) -> str:
+        data = stdin.read()
+        if command.startswith("gzip -d"):
+            data = gzip.decompress(data)
+        self.received = data
+        return ""
+
+
+class TransferTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        bin_dir = os.path.join(self.dir.name, "bin")
+        os.mkdir(bin_dir)
+        nix_store = os.path.join(bin_dir, "nix-store")
+        with open(nix_store, "w") as f:
+            f.write(FAKE_NIX_STORE)
+        os.chmod(nix_store, stat.S_IRWXU)
+        env = mock.patch.dict(
+            os.environ, {"PATH": bin_dir + os.pathsep + os.environ["PATH"]}
+        )
+        env.start()
+        self.addCleanup(env.stop)
+        self.spill = os.path.join(self.dir.name, "spill")
+        os.mkdir(self.spill)
+
+    def test_export_once(self):
+        cache = ExportCache(self.spill, compress=False)
+        exports = []
+
+        def get():
+            exports.append(cache.get("/nix/store/aaa-foo"))
+
+        threads = [threading.Thread(target=get) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(cache.exported, {"/nix/store/aaa-foo": 1})
+        self.assertEqual(b"".join(exports[0].chunks()), body("/nix/store/aaa-foo"))
+
+    def test_spill(self):
+        cache = ExportCache(self.spill, compress=False, memory_limit=2000)
+        paths = ["/nix/store/aaa-foo", "/nix/store/bbb-bar"]
+        for p in paths:
+            self.assertEqual(b"".join(cache.get(p).chunks()), body(p))
+        self.assertEqual(os.listdir(self.spill), ["export-bbb-bar"])
+
+    def test_send(self):
+        for compress in (False, True):
+            cache = ExportCache(self.spill, compress=compress)
+            paths = ["/nix/store/aaa-foo", "/nix/store/bbb-bar"]
+            machines = [FakeMachine("a"), FakeMachine("b")]
+            for m in machines:
+                nixops.transfer.send(m, cache, paths)  # type: ignore
+                self.assertEqual(m.received, body(paths[0]) + body(paths[1]) + END)
+            self.assertEqual(cache.exported, {p: 1 for p in paths})
+
+    def test_fanout_copy(self):
+        closures = {
+            "/nix/store/top-a": ["/nix/store/lib", "/nix/store/top-a"],
+            "/nix/store/top-b": ["/nix/store/lib", "/nix/store/top-b"],
+        }
+        a = FakeMachine("a")
+        b = FakeMachine("b")
+        c = FakeMachine("c")
+        present = {"b": {"/nix/store/lib"}, "c": set(closures["/nix/store/top-a"])}
+
+        def query_invalid(m: Any, paths: List[str]) -> set:
+            return set(paths) - present.get(m.name, set())
+
+        with mock.patch.object(
+            nixops.transfer, "query_requisites", lambda ps: closures[ps[0]]
+        ), mock.patch.object(nixops.transfer, "query_invalid", query_invalid):
+            sent = nixops.transfer.fanout_copy(
+                {a: "/nix/store/top-a", b: "/nix/store/top-b", c: "/nix/store/top-a"},  # type: ignore
+                spill_dir=self.spill,
+                nr_workers=2,
+                compress=False,
+            )
+        self.assertEqual(
+            a.received, body("/nix/store/lib") + body("/nix/store/top-a") + END
+        )
+        self.assertEqual(b.received, body("/nix/store/top-b") + END)
+        self.assertEqual(c.received, b"")
+        self.assertEqual(sent["c"], 0)
+
+
+class TreeMachine:
+    def __init__(self, name: str, hint: Optional[str]) -> None:
+        self.name = name
+        self.hint = hint
+        self.copied = 0
+        self.cur_toplevel: Optional[str] = None
+        self.logger = SimpleNamespace(log=lambda msg: None, warn=lambda msg: None)
+
+    def locality_hint(self) -> Optional[str]:
+        return self.hint
+
+    def copy_closure_to(self, path: str) -> None:
+        self.copied += 1
+
+
+class TreeTest(unittest.TestCase):
+    def test_build_tree(self):
+        self.assertEqual(
+            build_tree(["a", "b", "c", "d", "e", "f"], seeds=2, fanout=2),
+            {None: ["a", "b"], "a": ["c", "d"], "b": ["e", "f"]},
+        )
+        self.assertEqual(
+            build_tree(["a", "b", "c", "d"], seeds=1, fanout=1),
+            {None: ["a"], "a": ["b"], "b": ["c"], "c": ["d"]},
+        )
+
+    def tree_copy(self, machines, fail=()):
+        peer_copies = []
+
+        def peer_copy(source, target, path):
+            if target.name in fail:
+                raise Exception("no route")
+            peer_copies.append((source.name, target.name))
+
+        with mock.patch.object(
+            nixops.transfer, "peer_copy", peer_copy
+        ), mock.patch.object(nixops.transfer, "closure_size", lambda path: 1000):
+            hops = nixops.transfer.tree_copy(machines, nr_workers=5, fanout=2)
+        return (hops, sorted(peer_copies))
+
+    def test_tree_copy(self):
+        a, b, c = [TreeMachine(n, "10.0.0.0/24") for n in "abc"]
+        d = TreeMachine("d", "10.0.1.0/24")
+        e = TreeMachine("e", None)
+        f = TreeMachine("f", "10.0.0.0/24")
+        machines: Any = {a: "/x", b: "/x", c: "/x", d: "/x", e: "/x", f: "/y"}
+        (hops, peer_copies) = self.tree_copy(machines)
+        self.assertEqual(peer_copies, [("a", "b"), ("a", "c")])
+        self.assertEqual([m.name for m in machines if m.copied], ["a", "d", "e", "f"])
+        self.assertEqual(len(hops), 6)
+        self.assertTrue(all(h.size == 1000 for h in hops))
+
+    def test_fallback(self):
+        a, b, c = [TreeMachine(n, "net") for n in "abc"]
+        machines: Any = {a: "/x", b: "/x", c: "/x"}
+        (hops, peer_copies) = self.tree_copy(machines, fail={"b"})
+        self.assertEqual(peer_copies, [("a", "c")])
+        self.assertEqual(b.copied, 1)
+        self.assertEqual(
+            [(h.source, h.target) for h in hops if h.fell_back], [(None, "b")]
+        )
+
+    def test_fallbacks_are_limited(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        class SlowMachine(TreeMachine):
+            def copy_closure_to(self, path: str) -> None:
+                with lock:
+                    running.append(self.name)
+                    peak.append(len(running))
+                threading.Event().wait(0.02)
+                with lock:
+                    running.remove(self.name)
+
+        machines: Any = {SlowMachine(n, "net"): "/x" for n in "abcdefg"}
+
+        def peer_copy(source, target, path):
+            raise Exception("no route")
+
+        with mock.patch.object(
+            nixops.transfer, "peer_copy", peer_copy
+        ), mock.patch.object(nixops.transfer, "closure_size", lambda path: 1000):
+            hops = nixops.transfer.tree_copy(machines, nr_workers=1, fanout=3)
+        self.assertEqual(len(hops), 7)
+        self.assertEqual(max(peak), 1)
+
+    def test_peer_address(self):
+        scripts: List[str] = []
+        ssh = SimpleNamespace(run_command=lambda script, **kw: scripts.append(script))
+
+        def machine(name: str, private: str, hint: str) -> Any:
+            m = TreeMachine(name, hint)
+            m.private_ipv4 = private  # type: ignore
+            m.public_host_key = "ssh-ed25519 AAAA"  # type: ignore
+            m.ssh_user = "root"  # type: ignore
+            m.address_to = lambda r: "203.0.113.1"  # type: ignore
+            m.get_ssh_for_copy_closure = lambda: ssh  # type: ignore
+            return m
+
+        a = machine("a", "10.0.0.1", "10.0.0.0/24")
+        b = machine("b", "10.0.0.2", "10.0.0.0/24")
+        c = machine("c", "10.0.1.2", "10.0.1.0/24")
+        nixops.transfer.peer_copy(a, b, "/x")
+        nixops.transfer.peer_copy(a, c, "/x")
+        self.assertIn("root@10.0.0.2", scripts[0])
+        self.assertIn("root@203.0.113.1", scripts[1])
+
+
+class ProbeTest(unittest.TestCase):
+    closures = {"/top": ["/lib", "/top"]}
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.statefile = nixops.statefile.StateFile(
+            os.path.join(self.dir.name, "state.nixops"), writable=True
+        )
+        self.addCleanup(self.statefile.close)
+        self.depl = self.statefile.create_deployment()
+        self.valid = {"a": {"/lib", "/top"}, "b": {"/lib"}, "c": set()}
+        self.queries: List[List[str]] = []
+
+        def query_invalid(m, paths):
+            self.queries.append(paths)
+            if m.name == "c":
+                raise Exception("unreachable")
+            return set(paths) - self.valid[m.name]
+
+        patches: List[Any] = [
+            mock.patch.object(nixops.transfer, "query_invalid", query_invalid),
+            mock.patch.object(
+                nixops.transfer, "query_requisites", lambda ps: self.closures[ps[0]]
+            ),
+            mock.patch.object(
+                nixops.transfer, "path_sizes", lambda ps: {p: 1024 for p in ps}
+            ),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def machines(self) -> Any:
+        return [TreeMachine(n, None) for n in "abc"]
+
+    def test_toplevel(self):
+        presence = nixops.transfer.probe_presence(
+            {m: "/top" for m in self.machines()}  # type: ignore
+        )
+        self.assertEqual(self.queries, [["/top"]] * 3)
+        self.assertTrue(presence["a"].present)  # type: ignore
+        self.assertFalse(presence["b"].present)  # type: ignore
+        self.assertIsNone(presence["b"].missing)  # type: ignore
+        self.assertIsNone(presence["c"])
+
+    def test_closures(self):
+        presence = nixops.transfer.probe_presence(
+            {m: "/top" for m in self.machines()}, closures=True  # type: ignore
+        )
+        self.assertEqual(presence["a"].missing, [])  # type: ignore
+        self.assertEqual(presence["b"].missing, ["/top"])  # type: ignore
+
+    def test_skip_present(self):
+        machines = self.machines()
+        for m in machines:
+            m.new_toplevel = "/top"
+        delta_sizes: Dict[str, int] = {}
+        remaining = self.depl._skip_present_closures(
+            machines, probe_closures=True, delta_sizes=delta_sizes
+        )
+        self.assertEqual([m.name for m in remaining], ["b", "c"])
+        self.assertEqual(delta_sizes, {"b": 1024})
+        with mock.patch.object(nixops.transfer, "closure_size", lambda path: 2048):
+            sizes = self.depl._copy_sizes(remaining, delta_sizes)
+        self.assertEqual(sizes, {"b": 1024, "c": 2048})
+
+    def test_skip_present_summary(self):
+        machines = self.machines()
+        for m in machines:
+            m.new_toplevel = "/top"
+        with mock.patch.object(self.depl.logger, "log") as log:
+            self.depl._skip_present_closures(machines, probe_closures=True)
+        self.assertEqual(
+            [c.args[0] for c in log.call_args_list],
+            [
+                "1 of 3 machines already have their configuration; not copying"
+                " 0.0 MiB to them",
+                "the other machines already have 1 paths (0.0 MiB) of their"
+                " configuration",
+            ],
+        )
+
+    def test_skip_present_collected(self):
+        machines = self.machines()
+        for m in machines:
+            m.new_toplevel = "/top"
+        present = nixops.deployment.PresentClosures()
+        with mock.patch.object(self.depl.logger, "log") as log:
+            for m in machines:
+                self.depl._skip_present_closures([m], True, present=present)
+            # Nothing is reported until all machines have been checked.
+            self.assertEqual(log.call_args_list, [])
+            self.depl._report_present_closures(present)
+        self.assertEqual(
+            [c.args[0] for c in log.call_args_list],
+            [
+                "1 of 3 machines already have their configuration; not copying"
+                " 0.0 MiB to them",
+                "the other machines already have 1 paths (0.0 MiB) of their"
+                " configuration",
+            ],
+        )
+
+    def test_skip_present_unchanged_only(self):
+        machines = self.machines()
+        for m in machines:
+            m.new_toplevel = "/top"
+        machines[0].cur_toplevel = "/top"
+        machines[1].cur_toplevel = "/old"
+        remaining = self.depl._skip_present_closures(machines, probe_closures=False)
+        self.assertEqual(self.queries, [["/top"]])
+        self.assertEqual([m.name for m in remaining], ["b", "c"])
+
+
+class EstimateTest(unittest.TestCase):
+    def test_query_free_and_invalid(self):
+        m: Any = SimpleNamespace(ssh_user="root")
+        ssh = mock.Mock()
+        ssh.run_command.return_value = "free:2048\n/nix/store/b\n"
+        m.get_ssh_for_copy_closure = lambda: ssh
+        (free, invalid) = nixops.transfer.query_free_and_invalid(
+            m, ["/nix/store/a", "/nix/store/b"]
+        )
+        self.assertEqual(free, 2048 * 1024)
+        self.assertEqual(invalid, {"/nix/store/b"})
+
+    def test_estimate(self):
+        closures = {"/top": ["/lib", "/top"]}
+        remote = {
+            "a": (10**9, {"/top"}),
+            "b": (100, {"/lib", "/top"}),
+            "c": (5, set()),
+        }
+        a, b, c = [TreeMachine(n, None) for n in "abc"]
+        with mock.patch.object(
+            nixops.transfer, "query_local_invalid", lambda ps: set(ps) - {"/top"}
+        ), mock.patch.object(
+            nixops.transfer, "query_requisites", lambda ps: closures[ps[0]]
+        ), mock.patch.object(
+            nixops.transfer, "path_sizes", lambda ps: {p: 1000 for p in ps}
+        ), mock.patch.object(
+            nixops.transfer,
+            "query_free_and_invalid",
+            lambda m, paths: remote[m.name],
+        ):
+            estimates = nixops.transfer.estimate(
+                {a: "/top", b: "/top", c: "/unbuilt"}  # type: ignore
+            )
+        self.assertEqual(
+            estimates["a"].as_dict(),
+            dict(
+                closure_paths=2,
+                closure_size=2000,
+                paths=1,
+                size=1000,
+                builds=0,
+                free=10**9,
+                insufficient_space=False,
+            ),
+        )
+        self.assertTrue(estimates["b"].insufficient_space)
+        self.assertIsNone(estimates["c"].size)
+        self.assertEqual(estimates["c"].free, 5)
+
+    def test_estimate_unbuilt(self):
+        a, b = [TreeMachine(n, None) for n in "ab"]
+        remote = {"a": (10**9, {"/f1", "/f2"}), "b": (10**9, {"/f2"})}
+        dry_run = nixops.transfer.DryRun(
+            builds=["/top.drv"], fetches=["/f1", "/f2"], unpacked=4000
+        )
+        with mock.patch.object(
+            nixops.transfer, "query_local_invalid", lambda ps: set(ps)
+        ), mock.patch.object(
+            nixops.transfer, "dry_run_realise", lambda drv: dry_run
+        ), mock.patch.object(
+            nixops.transfer,
+            "query_free_and_invalid",
+            lambda m, paths: remote[m.name],
+        ):
+            estimates = nixops.transfer.estimate(
+                {a: "/top", b: "/top"}, {"/top": "/top.drv"}  # type: ignore
+            )
+        self.assertEqual((estimates["a"].paths, estimates["a"].size), (2, 4000))
+        self.assertEqual((estimates["b"].paths, estimates["b"].size), (1, 2000))
+        self.assertEqual(estimates["a"].builds, 1)
+        self.assertIsNone(estimates["a"].closure_paths)
+
+    def test_parse_dry_run(self):
+        for output in [
+            "these derivations will be built:\n  /nix/store/a.drv\n"
+            "these paths will be fetched (1.50 MiB download, 6.00 MiB unpacked):\n"
+            "  /nix/store/b\n  /nix/store/c\n",
+            "this derivation will be built:\n  /nix/store/a.drv\n"
+            "these 2 paths will be fetched (1.50 MiB download, 6.00 MiB"
+            " unpacked):\n  /nix/store/b\n  /nix/store/c\n",
+        ]:
+            dry_run = nixops.transfer.parse_dry_run(output)
+            self.assertEqual(dry_run.builds, ["/nix/store/a.drv"])
+            self.assertEqual(dry_run.fetches, ["/nix/store/b", "/nix/store/c"])
+            self.assertEqual(dry_run.download, 1536 * 1024)
+            self.assertEqual(dry_run.unpacked, 6 * 1024**2)
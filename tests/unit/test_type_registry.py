@@ -0,0 +1,87 @@
+import unittest
+from io import StringIO
+from typing import Any, List
+from unittest import mock
+
+import nixops.registry
+from nixops.registry import TypeRegistry, register_resource_type
+
+
+class Base:
+    type_name = ""
+
+    @classmethod
+    def get_type(cls) -> str:
+        if not cls.type_name:
+            raise NotImplementedError("get_type")
+        return cls.type_name
+
+
+class TypeRegistryTest(unittest.TestCase):
+    def setUp(self):
+        class Root(Base):
+            pass
+
+        class Abstract(Root):
+            pass
+
+        class Foo(Abstract):
+            type_name = "foo"
+
+        class Unnamed(Abstract):
+            pass
+
+        self.root = Root
+        self.foo = Foo
+        self.registry = TypeRegistry(Root, lambda cls: cls.get_type())
+
+        self.stderr = StringIO()
+        patches: List[Any] = [
+            mock.patch.object(nixops.registry, "_explicit_types", []),
+            mock.patch("sys.stderr", self.stderr),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_leaf_classes(self):
+        self.assertIs(self.registry.get("foo"), self.foo)
+        self.assertIsNone(self.registry.get("bar"))
+        self.assertEqual(list(self.registry.types()), ["foo"])
+
+    def test_defined_later(self):
+        self.registry.get("foo")
+
+        class Bar(self.root):  # type: ignore
+            type_name = "bar"
+
+        self.assertIs(self.registry.get("bar"), Bar)
+
+    def test_duplicate(self):
+        class OtherFoo(self.root):  # type: ignore
+            type_name = "foo"
+
+        self.assertIs(self.registry.get("foo"), self.foo)
+        self.registry.get("bar")
+        self.assertEqual(self.stderr.getvalue().count("‘foo’"), 1)
+
+    def test_explicit(self):
+        class OtherFoo(self.root):  # type: ignore
+            type_name = "foo"
+
+        class Unrelated(Base):
+            type_name = "foo"
+
+        self.registry.get("foo")
+        register_resource_type(OtherFoo)
+        register_resource_type(Unrelated)
+        self.assertIs(self.registry.get("foo"), OtherFoo)
+
+    def test_explicit_duplicate(self):
+        class OtherFoo(self.root):  # type: ignore
+            type_name = "foo"
+
+        register_resource_type(self.foo)
+        register_resource_type(OtherFoo)
+        with self.assertRaises(Exception):
+            self.registry.get("foo")
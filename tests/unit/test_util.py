@@ -1,4 +1,4 @@
-from typing import Any, Sequence, Mapping
+from typing import Any, Dict, List, Optional, Sequence, Mapping
 import json
 from nixops.logger import Logger
 from io import StringIO
@@ -75,6 +75,25 @@ class TestUtilTest(unittest.TestCase):
 
         self.assertRaises(TypeError, _assign)
 
+    def test_immutable_dict_lazy(self):
+        d: Dict[str, Any] = {"nested": {"x": [{"y": 1}]}, "foo": "bar"}
+        i: util.ImmutableMapping[str, Any] = util.ImmutableMapping(d)
+
+        # Values are converted on first access, once.
+        self.assertEqual(i._converted, {})
+        self.assertIs(i["nested"], i["nested"])
+        self.assertIs(i.nested, i["nested"])
+        self.assertEqual(list(i._converted), ["nested"])
+        self.assertEqual(i["nested"]["x"][0]["y"], 1)
+
+        # The input is shared rather than copied.
+        self.assertIs(i._dict, d)
+        self.assertIs(i["nested"]._dict, d["nested"])
+
+        self.assertEqual(
+            i, util.ImmutableMapping({"nested": {"x": ({"y": 1},)}, "foo": "bar"})
+        )
+
     def test_immutable_object(self):
         class SubResource(util.ImmutableValidatedObject):
             x: int
@@ -132,3 +151,30 @@ class TestUtilTest(unittest.TestCase):
         mapped = WithMapping(mapping={"aaa": {"x": 1}, "bbb": {"x": 2}})
         for _, v in mapped.mapping.items():
             self.assertIsInstance(v, SubResource)
+
+    def test_immutable_object_validation(self):
+        class Typed(util.ImmutableValidatedObject):
+            port: Optional[int]
+            ratio: float
+            names: Sequence[str]
+            options: Mapping[str, Any]
+
+        t = Typed(port=None, ratio=1, names=("a", "b"), options={"x": 1}, extra=[1])
+        # Not covered by the fast checks, but accepted by typeguard.
+        self.assertEqual(t.ratio, 1)
+        # Untyped attributes are passed through.
+        self.assertEqual(getattr(t, "extra"), [1])
+        self.assertEqual(
+            sorted(dict(t)), ["extra", "names", "options", "port", "ratio"]
+        )
+
+        invalid: List[Dict[str, Any]] = [
+            {"port": "22"},
+            {"ratio": "1"},
+            {"names": [1]},
+            {"options": {1: "x"}},
+        ]
+        for kwargs in invalid:
+            args: Dict[str, Any] = dict(port=22, ratio=1.0, names=(), options={})
+            args.update(kwargs)
+            self.assertRaises(typeguard.TypeCheckError, lambda: Typed(**args))